@@ -0,0 +1,425 @@
+"""Benchmark deploying to simulated hosts.
+
+Start a number of simulated hosts (see `simhosts.py`) with the injected
+latency and bandwidth, and then run the following scenarios against them
+in-process for a number of runs:
+
+- `install`: install a new version of a synthetic distribution, whose
+  dependencies (of `--dist-size` megabytes in `--dist-files` files) are
+  the same in all versions, while its application file is not
+- `list`: list the installed versions
+- `rollback`: rollback to the previous version
+- `deploy`: archive, build (on the first host) and install
+  `examples/web_app`, if the toolbin of platter is specified
+- `pipeline`: deploy `examples/web_app` as two projects at once by
+  pipelining their stages, installing on all hosts in parallel unless
+  specified otherwise, if the toolbin of platter is specified
+
+Report the wall time of each scenario, the time spent on each host (from
+the trace of Cooly), and the bytes moved to and from the hosts. The
+results can be saved by `--output`, and compared with a `--baseline` to
+catch regressions.
+
+Usage:
+
+    $ python benchmarks/deploy.py [--hosts 3] [--runs 5] [--latency 20]
+          [--bandwidth 10] [--dist-size 20] [--toolbin /path/to/toolbin]
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import hashlib
+import tarfile
+import argparse
+import tempfile
+import contextlib
+import subprocess
+from collections import OrderedDict
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+EXAMPLE_PROJECT = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'examples',
+                               'web_app')
+SCENARIOS = ('install', 'list', 'rollback', 'deploy', 'pipeline')
+
+# The options of `install` which copy files from host to host by fixed
+# paths under `/tmp`, which the simulated hosts share (see `simhosts.py`)
+UNSUPPORTED_INSTALL_OPTIONS = ('fanout',)
+
+DIST_NAME = 'Bench-App-0.0.%s'
+INSTALL_SCRIPT = '''\
+#!/bin/bash
+set -e
+here=$(cd "$(dirname "$0")" && pwd)
+mkdir -p "$1"
+cp -R "$here/lib" "$here/app.py" "$1/"
+'''
+
+SSH_CONFIG = '''\
+Host *
+    StrictHostKeyChecking no
+    UserKnownHostsFile /dev/null
+    IdentityFile %(key)s
+    LogLevel ERROR
+'''
+# The wrappers of the OpenSSH clients, which make them use the config
+SSH_WRAPPER = '#!/bin/sh\nexec %(program)s -F %(config)s "$@"\n'
+
+
+def percentile(values, p):
+    """Get the `p` percentile of `values` by the nearest rank."""
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def deterministic_block(seed, size):
+    """Get `size` incompressible but reproducible bytes."""
+    chunks = []
+    digest = hashlib.sha512(str(seed).encode('utf-8')).digest()
+    while len(chunks) * len(digest) < size:
+        digest = hashlib.sha512(digest).digest()
+        chunks.append(digest)
+    return b''.join(chunks)[:size]
+
+
+def make_dist(output, version, size, files):
+    """Make version `version` of the synthetic distribution in `output`,
+    and return the path to it.
+    """
+    name = DIST_NAME % version
+    source = os.path.join(output, name)
+    lib = os.path.join(source, 'lib')
+    os.makedirs(lib)
+    file_size = size // files
+    block = deterministic_block('dependencies', min(file_size, 1 << 20))
+    for i in range(files):
+        with open(os.path.join(lib, 'dep-%s.bin' % i), 'wb') as f:
+            written = 0
+            while written < file_size:
+                data = block[:file_size - written]
+                f.write(data)
+                written += len(data)
+    with open(os.path.join(source, 'app.py'), 'w') as f:
+        f.write('VERSION = %r\n' % version)
+    with open(os.path.join(source, 'install.sh'), 'w') as f:
+        f.write(INSTALL_SCRIPT)
+    os.chmod(os.path.join(source, 'install.sh'), 0o755)
+
+    dist = source + '.tar.gz'
+    with tarfile.open(dist, 'w:gz') as tar:
+        tar.add(source, name)
+    shutil.rmtree(source)
+    return dist
+
+
+class Environment(object):
+    """The isolated environment of the benchmark in `workdir`, with its
+    own home directory, SSH clients and simulated hosts.
+    """
+
+    def __init__(self, workdir, hosts, latency, bandwidth):
+        self.workdir = workdir
+        self.home = os.path.join(workdir, 'home')
+        self.bin = os.path.join(workdir, 'bin')
+        os.makedirs(os.path.join(self.home, '.ssh'))
+        os.makedirs(self.bin)
+
+        import paramiko
+        key = os.path.join(self.home, '.ssh', 'id_rsa')
+        paramiko.RSAKey.generate(2048).write_private_key_file(key)
+        config = os.path.join(workdir, 'ssh_config')
+        with open(config, 'w') as f:
+            f.write(SSH_CONFIG % {'key': key})
+        for name in ('ssh', 'scp'):
+            program = subprocess.check_output(['which', name]).strip()
+            wrapper = os.path.join(self.bin, name)
+            with open(wrapper, 'w') as f:
+                f.write(SSH_WRAPPER % {'program': program.decode('utf-8'),
+                                       'config': config})
+            os.chmod(wrapper, 0o755)
+
+        # Isolate Cooly, Fabric and the hosts from the user's settings
+        os.environ['HOME'] = self.home
+        os.environ['PATH'] = self.bin + os.pathsep + os.environ['PATH']
+
+        self.server = subprocess.Popen(
+            [sys.executable, os.path.join(BENCHMARKS_DIR, 'simhosts.py'),
+             '--workdir', workdir, '--hosts', str(hosts),
+             '--latency', str(latency), '--bandwidth', str(bandwidth)],
+            stdout=subprocess.PIPE
+        )
+        self.hosts = OrderedDict()
+        for _ in range(hosts):
+            name, port = self.server.stdout.readline().split()
+            self.hosts['bench@127.0.0.1:%s' % int(port)] = name.decode(
+                'utf-8'
+            )
+
+    def bytes_moved(self):
+        """Get the total bytes moved to and from all hosts so far."""
+        total = 0
+        for name in self.hosts.values():
+            path = os.path.join(self.workdir, 'stats', name + '.json')
+            with open(path) as f:
+                stats = json.load(f)
+            total += stats['bytes_in'] + stats['bytes_out']
+        return total
+
+    def close(self):
+        self.server.kill()
+        self.server.wait()
+
+
+def host_durations(trace_path, hosts):
+    """Get the time spent on each of `hosts` from the trace, from the
+    start of its first span to the end of its last one.
+    """
+    spans = {}
+    with open(trace_path) as f:
+        for line in f:
+            event = json.loads(line)
+            host = event.get('args', {}).get('host')
+            if event['ph'] != 'X' or host not in hosts:
+                continue
+            start, end = event['ts'], event['ts'] + event['dur']
+            first, last = spans.get(host, (start, end))
+            spans[host] = (min(first, start), max(last, end))
+    return [(end - start) / 1e6 for start, end in spans.values()]
+
+
+@contextlib.contextmanager
+def redirect_output(path):
+    """Redirect the standard output and error, including the ones of the
+    subprocesses, to the file `path`.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    with open(path, 'a') as f:
+        os.dup2(f.fileno(), 1)
+        os.dup2(f.fileno(), 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in zip((1, 2), saved):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+def run_scenario(env, name, function, runs, verbose=False):
+    """Run `function(i)` for run i in `runs`, and return the results."""
+    from cooly import trace
+
+    walls, host_times = [], []
+    bytes_before = env.bytes_moved()
+    log = os.path.join(env.workdir, 'benchmark.log')
+    for i in runs:
+        print('Running %s #%s' % (name, i))
+        trace_path = os.path.join(env.workdir, '%s-%s.jsonl' % (name, i))
+        trace.start(trace_path)
+        start = time.time()
+        try:
+            if verbose:
+                function(i)
+            else:
+                with redirect_output(log):
+                    function(i)
+        except (Exception, SystemExit):
+            print('Error: %s #%s failed, see %s' % (name, i, log))
+            raise
+        finally:
+            walls.append(time.time() - start)
+            trace.finish()
+        host_times.extend(host_durations(trace_path, env.hosts))
+    # Wait for the statistics of the last sessions to be saved
+    time.sleep(0.2)
+    return OrderedDict([
+        ('runs', len(walls)),
+        ('wall_p50', percentile(walls, 50)),
+        ('wall_max', max(walls)),
+        ('host_p50', percentile(host_times, 50)),
+        ('host_p99', percentile(host_times, 99)),
+        ('bytes', env.bytes_moved() - bytes_before),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=3,
+                        help='The number of simulated hosts. Defaults to 3.')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='The number of runs of each scenario. Defaults '
+                             'to 5.')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='The latency (in milliseconds) of each request '
+                             'to a host. Defaults to 20.')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='The bandwidth (in megabytes per second) of '
+                             'the link to each host. Defaults to '
+                             'unlimited.')
+    parser.add_argument('--dist-size', type=float, default=20,
+                        help='The size (in megabytes) of the synthetic '
+                             'distribution. Defaults to 20.')
+    parser.add_argument('--dist-files', type=int, default=50,
+                        help='The number of the dependency files in the '
+                             'synthetic distribution. Defaults to 50.')
+    parser.add_argument('--toolbin',
+                        help='The toolbin of platter, to run the `deploy` '
+                             'scenario. Defaults to skipping it.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='The comma-separated scenarios to run. '
+                             'Defaults to all of them.')
+    parser.add_argument('--install-options', default='{}',
+                        help='The JSON object of the extra keyword '
+                             'arguments of `install` (e.g. '
+                             '\'{"parallel": 3, "transfer": "delta"}\').')
+    parser.add_argument('--output',
+                        help='The file to save the results to as JSON.')
+    parser.add_argument('--baseline',
+                        help='The results saved previously, to fail if the '
+                             'median wall time of any scenario regresses '
+                             'beyond the tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='The tolerated ratio of regression. Defaults '
+                             'to 0.2.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the working directory for inspection.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the output of Cooly instead of logging '
+                             'it into the working directory.')
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    for name in ('deploy', 'pipeline'):
+        if name in scenarios and not args.toolbin:
+            print('Skipping the `%s` scenario without `--toolbin`' % name)
+            scenarios.remove(name)
+    install_options = json.loads(args.install_options)
+    for name in UNSUPPORTED_INSTALL_OPTIONS:
+        if install_options.get(name):
+            parser.error('`%s` can not be simulated, since the simulated '
+                         'hosts share `/tmp`' % name)
+
+    workdir = tempfile.mkdtemp(prefix='cooly-benchmark-')
+    env = Environment(workdir, args.hosts, args.latency / 1000.0,
+                      args.bandwidth * 1024 * 1024)
+    try:
+        # Cooly is imported once the environment is isolated
+        from cooly import api
+
+        hosts = list(env.hosts)
+        path = os.path.join(workdir, 'hosts', '@HOST@', 'app')
+        dists = os.path.join(workdir, 'dists')
+        os.makedirs(dists)
+        versions = range(args.runs)
+        print('Making %s versions of a %sMB distribution'
+              % (args.runs, args.dist_size))
+        dist_paths = [
+            make_dist(dists, i, int(args.dist_size * 1024 * 1024),
+                      args.dist_files)
+            for i in versions
+        ]
+
+        def install(i):
+            api.install(dist_paths[i], hosts, path, max_versions=args.runs,
+                        **install_options)
+
+        def list_versions(i):
+            api.list(hosts, path)
+
+        def rollback(i):
+            api.rollback(hosts, path, 'LATEST~1')
+
+        def deploy(i):
+            output = os.path.join(workdir, 'deploy-%s' % i)
+            os.makedirs(output)
+            api.deploy({
+                'archive': {'repo': 'file://' + EXAMPLE_PROJECT,
+                            'output': output, 'store': False},
+                'build': {'host': hosts[0], 'toolbin': args.toolbin,
+                          'output': output, 'store': False},
+                'install': dict(install_options, hosts=hosts,
+                                path=path + '-web', max_versions=args.runs),
+            })
+
+        def pipeline(i):
+            projects = []
+            for name in ('web-a', 'web-b'):
+                output = os.path.join(workdir, 'pipeline-%s-%s' % (i, name))
+                os.makedirs(output)
+                projects.append((name, {
+                    'archive': {'repo': 'file://' + EXAMPLE_PROJECT,
+                                'output': output, 'store': False},
+                    'build': {'host': hosts[0], 'toolbin': args.toolbin,
+                              'output': output, 'store': False},
+                    # The parallel installation forks in the worker
+                    'install': dict({'parallel': len(hosts)},
+                                    hosts=hosts, path=path + '-' + name,
+                                    max_versions=args.runs,
+                                    **install_options),
+                }))
+            api.deploy_projects(projects)
+
+        functions = {'install': install, 'list': list_versions,
+                     'rollback': rollback, 'deploy': deploy,
+                     'pipeline': pipeline}
+        results = OrderedDict()
+        for name in scenarios:
+            runs = versions[1:] if name == 'rollback' else versions
+            if not runs:
+                continue
+            results[name] = run_scenario(env, name, functions[name], runs,
+                                         args.verbose)
+    except (Exception, SystemExit):
+        # Keep the log of the failure
+        args.keep = True
+        raise
+    finally:
+        env.close()
+        if args.keep:
+            print('The working directory is kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print('')
+    print('%-10s %5s %10s %10s %10s %10s %14s' % (
+        'scenario', 'runs', 'wall p50', 'wall max', 'host p50', 'host p99',
+        'bytes moved'
+    ))
+    for name, result in results.items():
+        print('%-10s %5s %9.3fs %9.3fs %9.3fs %9.3fs %14s' % (
+            name, result['runs'], result['wall_p50'], result['wall_max'],
+            result['host_p50'], result['host_p99'], result['bytes']
+        ))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            limit = baseline[name]['wall_p50'] * (1 + args.tolerance)
+            if result['wall_p50'] > limit:
+                print('Error: the median wall time of `%s` regressed from '
+                      '%.3fs to %.3fs' % (name, baseline[name]['wall_p50'],
+                                          result['wall_p50']))
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
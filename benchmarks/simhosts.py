@@ -0,0 +1,326 @@
+"""Simulated hosts for the deploy benchmark.
+
+Each host is an SSH server (by paramiko) on a local port, which accepts
+any user, runs the commands by bash, and serves SFTP on the local
+filesystem. Since all hosts share the filesystem, the token `@HOST@` in
+the commands and in the SFTP paths is replaced by the name of each host
+(e.g. `host-0`), to give each host directories of its own. Other paths,
+including `/tmp`, are shared by all hosts, so the modes which stage files
+at fixed paths there and copy them from host to host (fan-out and push)
+can not be simulated: a relayed file is always found in place already.
+
+The link to each host adds `latency` to the start of each command and to
+each SFTP request except reads and writes, and is limited to `bandwidth`
+bytes per second (shared by both directions). The bytes moved to and
+from each host are written to `<workdir>/stats/<name>.json` whenever a
+command or an SFTP session ends.
+
+Usage:
+
+    $ python benchmarks/simhosts.py --workdir DIR [--hosts 3]
+          [--latency 0.02] [--bandwidth 10000000]
+
+It prints a line of `<name> <port>` for each host once they all listen,
+and then serves until it is killed.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+import paramiko
+from paramiko import (ServerInterface, SFTPServerInterface, SFTPServer,
+                      SFTPAttributes, SFTPHandle, SFTP_OK, AUTH_SUCCESSFUL,
+                      OPEN_SUCCEEDED)
+
+
+HOST_TOKEN = '@HOST@'
+CHUNK_SIZE = 32768
+
+
+class Link(object):
+    """The simulated network link to a host."""
+
+    def __init__(self, name, stats_path, latency=0, bandwidth=0):
+        self.name = name
+        self.stats_path = stats_path
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.available_at = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def transfer(self, size, inbound):
+        """Account for `size` bytes moved to (if `inbound`) or from the
+        host, and wait until the link has carried them.
+        """
+        with self.lock:
+            if inbound:
+                self.bytes_in += size
+            else:
+                self.bytes_out += size
+            if not self.bandwidth:
+                return
+            now = time.time()
+            self.available_at = (max(now, self.available_at) +
+                                 float(size) / self.bandwidth)
+            wait = self.available_at - now
+        time.sleep(wait)
+
+    def localize(self, text):
+        return text.replace(HOST_TOKEN, self.name)
+
+    def save_stats(self):
+        with self.lock:
+            stats = {'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+        with open(self.stats_path + '.tmp', 'w') as f:
+            json.dump(stats, f)
+        os.rename(self.stats_path + '.tmp', self.stats_path)
+
+
+class Server(ServerInterface):
+
+    def __init__(self, link, home):
+        self.link = link
+        self.home = home
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_auth_none(self, username):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_password(self, username, password):
+        return AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'none,password,publickey'
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        thread = threading.Thread(target=self.execute,
+                                  args=(channel, command))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def execute(self, channel, command):
+        link = self.link
+        link.delay()
+        env = dict(os.environ, HOME=self.home)
+        process = subprocess.Popen(
+            ['/bin/bash', '-c', link.localize(command)], cwd=self.home,
+            env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT
+        )
+
+        def feed():
+            try:
+                while True:
+                    data = channel.recv(CHUNK_SIZE)
+                    if not data:
+                        break
+                    link.transfer(len(data), inbound=True)
+                    process.stdin.write(data)
+            except (IOError, socket.error):
+                pass
+            finally:
+                process.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        for data in iter(lambda: os.read(process.stdout.fileno(),
+                                         CHUNK_SIZE), b''):
+            link.transfer(len(data), inbound=False)
+            channel.sendall(data)
+        channel.send_exit_status(process.wait())
+        channel.close()
+        link.save_stats()
+
+
+class Handle(SFTPHandle):
+
+    def __init__(self, link, flags):
+        SFTPHandle.__init__(self, flags)
+        self.link = link
+
+    def read(self, offset, length):
+        data = SFTPHandle.read(self, offset, length)
+        if isinstance(data, bytes):
+            self.link.transfer(len(data), inbound=False)
+        return data
+
+    def write(self, offset, data):
+        self.link.transfer(len(data), inbound=True)
+        return SFTPHandle.write(self, offset, data)
+
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    def chattr(self, attr):
+        return SFTP_OK
+
+    def close(self):
+        SFTPHandle.close(self)
+        self.link.save_stats()
+
+
+class SFTP(SFTPServerInterface):
+
+    def __init__(self, server, *args, **kwargs):
+        SFTPServerInterface.__init__(self, server, *args, **kwargs)
+        self.link = server.link
+        self.home = server.home
+
+    def local_path(self, path):
+        self.link.delay()
+        return os.path.join(self.home, self.link.localize(path))
+
+    def list_folder(self, path):
+        path = self.local_path(path)
+        try:
+            attrs = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(
+                    os.lstat(os.path.join(path, name))
+                )
+                attr.filename = name
+                attrs.append(attr)
+            return attrs
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self.local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self.local_path(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = Handle(self.link, flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self.call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self.call(os.rename, oldpath, self.local_path(newpath))
+
+    def mkdir(self, path, attr):
+        return self.call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self.call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        if attr.st_mode is not None:
+            return self.call(os.chmod, path, attr.st_mode)
+        return SFTP_OK
+
+    def call(self, function, path, *args):
+        try:
+            function(self.local_path(path), *args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def canonicalize(self, path):
+        return os.path.normpath(os.path.join(self.home, path or '.'))
+
+
+class SFTPSession(SFTPServer):
+
+    def finish_subsystem(self):
+        try:
+            self.sock.send_exit_status(0)
+        except Exception:
+            pass
+        SFTPServer.finish_subsystem(self)
+
+
+def serve(sock, key, link, home):
+    while True:
+        client, _ = sock.accept()
+        transport = paramiko.Transport(client)
+        transport.add_server_key(key)
+        transport.set_subsystem_handler('sftp', SFTPSession, SFTP)
+        transport.start_server(server=Server(link, home))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workdir', required=True,
+                        help='The directory to keep the homes and the '
+                             'stats of the hosts in.')
+    parser.add_argument('--hosts', type=int, default=3,
+                        help='The number of hosts. Defaults to 3.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='The latency (in seconds) of each request. '
+                             'Defaults to 0.')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='The bandwidth (in bytes per second) of the '
+                             'link to each host. Defaults to unlimited.')
+    args = parser.parse_args()
+
+    stats_dir = os.path.join(args.workdir, 'stats')
+    if not os.path.isdir(stats_dir):
+        os.makedirs(stats_dir)
+    key = paramiko.RSAKey.generate(2048)
+    for i in range(args.hosts):
+        name = 'host-%s' % i
+        home = os.path.join(args.workdir, 'hosts', name)
+        if not os.path.isdir(home):
+            os.makedirs(home)
+        link = Link(name, os.path.join(stats_dir, name + '.json'),
+                    args.latency, args.bandwidth)
+        link.save_stats()
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(100)
+        thread = threading.Thread(target=serve, args=(sock, key, link, home))
+        thread.daemon = True
+        thread.start()
+        print('%s %s' % (name, sock.getsockname()[1]))
+    sys.stdout.flush()
+
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == '__main__':
+    main()
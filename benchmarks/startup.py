@@ -0,0 +1,84 @@
+"""Benchmark the startup time of the `cooly` command.
+
+Run `cooly --help` a number of times, and fail if the median time spent
+on top of a bare Python interpreter exceeds the budget, or if any of the
+heavyweight modules is imported at startup.
+
+Usage:
+
+    $ python benchmarks/startup.py [--runs 20] [--budget 0.1]
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+
+# The modules which must not be imported by `cooly --help`
+HEAVYWEIGHT_MODULES = ('fabric', 'paramiko', 'Crypto', 'cryptography', 'yaml')
+
+CLI_HELP = 'from cooly.cli import cli; cli(prog_name="cooly")'
+LIST_MODULES = 'import sys, cooly.cli; print("\\n".join(sys.modules))'
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_command(args, runs):
+    """Run `args` for `runs` times, and return the median time."""
+    timings = []
+    with open('/dev/null', 'w') as devnull:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull)
+            timings.append(time.time() - start)
+    return median(timings)
+
+
+def imported_heavyweight_modules():
+    """Get the heavyweight modules imported along with `cooly.cli`."""
+    output = subprocess.check_output([sys.executable, '-c', LIST_MODULES])
+    toplevel_names = set(
+        name.split('.', 1)[0] for name in output.decode('utf-8').splitlines()
+    )
+    return sorted(toplevel_names.intersection(HEAVYWEIGHT_MODULES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20,
+                        help='The number of runs. Defaults to 20.')
+    parser.add_argument('--budget', type=float, default=0.1,
+                        help='The maximum median time (in seconds) spent '
+                             'on top of a bare interpreter. Defaults to '
+                             '0.1.')
+    args = parser.parse_args()
+
+    baseline = time_command([sys.executable, '-c', 'pass'], args.runs)
+    total = time_command([sys.executable, '-c', CLI_HELP, '--help'],
+                         args.runs)
+    overhead = total - baseline
+    print('python -c pass:  %.3fs' % baseline)
+    print('cooly --help:    %.3fs' % total)
+    print('overhead:        %.3fs (budget %.3fs)' % (overhead, args.budget))
+
+    failed = False
+    modules = imported_heavyweight_modules()
+    if modules:
+        print('Error: heavyweight modules imported at startup: %s'
+              % ', '.join(modules))
+        failed = True
+    if overhead > args.budget:
+        print('Error: the startup overhead exceeds the budget')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
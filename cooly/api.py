@@ -0,0 +1,254 @@
+"""The Python API of Cooly.
+
+All stages run in the current process, so that they can be called from
+another program (e.g. a long-running orchestrator) as well as from the
+`cooly` command:
+
+    from cooly import api
+
+    api.deploy({
+        'archive': {'repo': 'file:///path/to/repository'},
+        'build': {'toolbin': '/path/to/toolbin', 'output': '/tmp/dists'},
+        'install': {'hosts': ['user@server'], 'path': '/path/to/install',
+                    'max_versions': 5},
+    })
+"""
+
+import os
+import contextlib
+from collections import OrderedDict
+
+from fabric.api import env
+from fabric.main import load_settings
+from fabric.network import disconnect_all
+
+from cooly import fabfile, ssh, trace
+from cooly import workspace as build_workspace
+
+
+DEFAULT_TREE_ISH = 'HEAD'
+DEFAULT_NAME_FORMAT = '{name}-{version}-{tree_ish}-{datetime:%Y%m%d%H%M%S}'
+DEFAULT_ARCHIVE_OUTPUT = '/tmp'
+DEFAULT_WHEEL_CACHE = '~/.cache/cooly'
+
+# The separator between a host and its platform
+PLATFORM_SEPARATOR = '='
+
+
+# The depth of the nested sessions
+session_depth = 0
+
+
+@contextlib.contextmanager
+def session():
+    """A context manager to run the stages in, like the `fab` command does.
+
+    The Fabric settings are loaded from `~/.fabricrc` when the outermost
+    session starts, and the connections are kept alive unless specified
+    otherwise. When it ends, the background downloads are waited for and
+    all connections are closed, so that the connections are shared by all
+    stages in it. With multiplexing enabled, the remote operations go over
+    the master connections instead, which are shared with the processes
+    forked to run on hosts in parallel and with other sessions too (see
+    `cooly.ssh`).
+    """
+    global session_depth
+    if session_depth == 0:
+        env.update(load_settings(env.rcfile))
+        if not env.keepalive:
+            env.keepalive = ssh.settings['keepalive']
+    session_depth += 1
+    try:
+        yield
+    finally:
+        session_depth -= 1
+        if session_depth == 0:
+            try:
+                fabfile.wait_for_local_copies()
+            finally:
+                disconnect_all()
+
+
+def normalize_hosts(hosts):
+    """Normalize `hosts`, which is either a single hostname or a sequence
+    of hostnames, to a list of hostnames (without their platforms).
+    """
+    if not hosts:
+        return []
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+    return [host.split(PLATFORM_SEPARATOR, 1)[0] for host in hosts]
+
+
+def split_platforms(hosts):
+    """Group `hosts` (as of `normalize_hosts`), each of which may be
+    tagged with its platform in the form of `HOST=PLATFORM`, by their
+    platforms (None for the untagged ones).
+    """
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+    groups = OrderedDict()
+    for host in hosts or ():
+        if host and PLATFORM_SEPARATOR in host:
+            host, platform = host.split(PLATFORM_SEPARATOR, 1)
+        else:
+            platform = None
+        groups.setdefault(platform, []).append(host)
+    return groups
+
+
+def archive(repo, tree_ish=None, name_format=None, output=None, store=None,
+            compression=None, mirror_dir=None, mirror_depth=None,
+            mirror_filter=None, mirror_max_size=None):
+    """Archive the package from `repo`, and return the path to it."""
+    with session(), trace.span('archive', 'stage'):
+        return fabfile.archive(
+            repo, tree_ish or DEFAULT_TREE_ISH,
+            name_format or DEFAULT_NAME_FORMAT,
+            output or DEFAULT_ARCHIVE_OUTPUT, store, compression,
+            mirror_dir, mirror_depth, mirror_filter, mirror_max_size
+        )
+
+
+def build(pkg, toolbin, output, host=None, requirements=None,
+          pre_script=None, post_script=None, wheel_cache=None, store=None,
+          layers=None, push=None, relay=None, local_copy=None, stream=None,
+          compression=None, shared_wheel_cache=None,
+          shared_wheel_cache_max_size=None, workspace=None, resumable=None,
+          platform=None):
+    """Build the package `pkg`, and return the path to the distribution
+    (in the form of `HOST:PATH` if it is pushed).
+
+    If the `platform` of `host` is specified, the distribution built on
+    any build host of the same platform is reused.
+    """
+    with session(), trace.span('build', 'stage'):
+        return fabfile.build(
+            pkg, host=host, toolbin=toolbin, output=output,
+            requirements=requirements, pre_script=pre_script,
+            post_script=post_script,
+            wheel_cache=wheel_cache or DEFAULT_WHEEL_CACHE, use_store=store,
+            use_layers=layers, push=push, relay=relay,
+            local_copy=local_copy, stream=stream, compression=compression,
+            shared_wheel_cache=shared_wheel_cache,
+            shared_wheel_cache_max_size=shared_wheel_cache_max_size,
+            workspace=workspace, use_resumable=resumable,
+            platform=platform
+        )
+
+
+def install(dist, hosts, path, pre_command=None, post_command=None,
+            max_versions=None, parallel=None, wave=None, canary=None,
+            max_failure_ratio=None, transfer=None, fanout=None, batch=None,
+            dedup=None, prune=None, two_phase=None):
+    """Install the distribution `dist` on `hosts`, keeping at most
+    `max_versions` versions (which is required) in `path`.
+    """
+    with session(), trace.span('install', 'stage'):
+        return fabfile.install(
+            dist, normalize_hosts(hosts), path, pre_command, post_command,
+            max_versions, parallel, wave, canary, max_failure_ratio,
+            transfer, fanout, batch, dedup, prune, two_phase
+        )
+
+
+def deploy(config):
+    """Deploy the package according to `config`, which is a mapping with
+    the same structure as the configuration file: the `archive`, `build`
+    and `install` sections hold the keyword arguments of the respective
+    stages.
+
+    The `build` section may also hold a pool of build `hosts`, and the
+    install hosts may be tagged with their platforms. If the install hosts
+    are of multiple platforms, the builds for them are scheduled across
+    the pool by `deploy_projects`. Otherwise, the only build runs in the
+    current process, always on the first build host of the platform in the
+    pool (the other hosts of the platform are not used).
+    """
+    archive_args, build_args, install_args = (
+        dict(config.get(part) or {})
+        for part in ('archive', 'build', 'install')
+    )
+    # Fail before archiving and building, rather than after
+    fabfile.check_max_versions(install_args.get('max_versions'))
+    if build_args.get('workspace') and archive_args.get('repo'):
+        build_args['workspace'] = build_workspace.project_path(
+            build_args['workspace'], archive_args['repo']
+        )
+    platforms = split_platforms(install_args.get('hosts'))
+    if len(platforms) > 1:
+        return deploy_projects([('default', config)])
+
+    pool = build_args.pop('hosts', None)
+    platform = next(iter(platforms), None)
+    if pool:
+        hosts = split_platforms(pool).get(platform)
+        if not hosts:
+            raise RuntimeError('No build hosts for the platform of the '
+                               'install hosts: %s' % platform)
+        if len(hosts) > 1:
+            print('Building on %s, the first of %s build hosts of the '
+                  'platform' % (hosts[0], len(hosts)))
+        build_args.update(host=hosts[0], platform=platform)
+    # Keep the distributions of different platforms apart, as
+    # `deploy_projects` does
+    if platform and build_args.get('output'):
+        build_args['output'] = os.path.join(build_args['output'], platform)
+
+    with session(), trace.span('deploy', 'stage'):
+        pkg = archive(**archive_args)
+        dist = build(pkg, **build_args)
+        try:
+            install(dist, **install_args)
+        finally:
+            # Remove the pushed distribution once the local copy is done,
+            # even if the installation failed
+            fabfile.wait_for_local_copies()
+            fabfile.remove_pushed_dist(dist)
+
+
+def deploy_projects(projects, max_builds_per_host=None,
+                    max_installs_per_host=None):
+    """Deploy multiple projects at once, where `projects` is a sequence of
+    the names of the projects and their configurations (as of `deploy`).
+
+    The stages of different projects are pipelined in worker processes,
+    running at most `max_builds_per_host` builds on each build host and
+    at most `max_installs_per_host` installations on each install host at
+    the same time (both default to 1). Each project is built for the
+    platform of each group of its install hosts, on its build hosts of
+    the same platform.
+    """
+    from cooly import pipeline
+    with session(), trace.span('deploy', 'stage', projects=len(projects)):
+        pipeline.deploy_projects(projects, max_builds_per_host,
+                                 max_installs_per_host)
+
+
+def list(hosts, path, parallel=None, cached=False):
+    """List all available versions in `path` on `hosts` (or locally if
+    no hosts are specified).
+
+    The manifests of the versions read from the hosts are cached locally.
+    If `cached` is true, the versions are listed from the cache only.
+    """
+    with session(), trace.span('list', 'stage'):
+        return fabfile.list(normalize_hosts(hosts), path, parallel, cached)
+
+
+def prune(hosts, path, max_versions, parallel=None):
+    """Remove all but the latest `max_versions` versions in `path` on
+    `hosts` (or locally if no hosts are specified), and the current one.
+    """
+    with session(), trace.span('prune', 'stage'):
+        return fabfile.prune(normalize_hosts(hosts), path, max_versions,
+                             parallel)
+
+
+def rollback(hosts, path, version, post_command=None, parallel=None):
+    """Rollback the current version in `path` on `hosts` (or locally if
+    no hosts are specified) to `version`.
+    """
+    with session(), trace.span('rollback', 'stage'):
+        return fabfile.rollback(normalize_hosts(hosts), path, post_command,
+                                version, parallel)
@@ -0,0 +1,71 @@
+"""Compile the installation on a host into a single shell script.
+
+Instead of running each step as a separate remote command, which costs
+at least one round trip per step, the whole plan is rendered into one
+script and run at once. The script reports the status and the time of
+each step by printing a line in the form of:
+
+    COOLY-STEP <name> <status> <milliseconds>
+"""
+
+import pipes
+
+
+STEP_MARK = 'COOLY-STEP'
+
+PROLOGUE = '''\
+cooly_step() {
+    local name=$1 start=$(date +%%s%%N) status
+    (eval "$2")
+    status=$?
+    echo "%(mark)s $name $status $(( ($(date +%%s%%N) - start) / 1000000 ))"
+    [ $status -eq 0 ] || exit $status
+}
+trap %(cleanup)s EXIT
+'''
+
+
+class Step(object):
+    """The result of a step run by the script."""
+
+    def __init__(self, name, status, milliseconds):
+        self.name = name
+        self.status = status
+        self.milliseconds = milliseconds
+
+    @property
+    def succeeded(self):
+        return self.status == 0
+
+    def __repr__(self):
+        return '<Step %s: %s in %sms>' % (self.name, self.status,
+                                          self.milliseconds)
+
+
+def render_install_script(steps, cleanup_paths, stdin_step=None):
+    """Render the script to run `steps`, which is a list of (name,
+    command) pairs, in order. The script exits as soon as a step fails,
+    and always removes `cleanup_paths` on exit.
+
+    Only the step named `stdin_step` (if any) reads the input of the
+    script (e.g. a streamed distribution), and the other steps read
+    nothing, so that they can not consume it.
+    """
+    cleanup = 'rm -rf %s' % ' '.join(pipes.quote(p) for p in cleanup_paths)
+    lines = [PROLOGUE % {'mark': STEP_MARK, 'cleanup': pipes.quote(cleanup)}]
+    for name, command in steps:
+        lines.append('cooly_step %s %s%s\n' % (
+            name, pipes.quote(command),
+            '' if name == stdin_step else ' </dev/null'
+        ))
+    return ''.join(lines)
+
+
+def parse_steps(output):
+    """Parse the steps reported in the `output` of the script."""
+    steps = []
+    for line in output.splitlines():
+        if line.startswith(STEP_MARK + ' '):
+            name, status, milliseconds = line.split()[1:4]
+            steps.append(Step(name, int(status), int(milliseconds)))
+    return steps
@@ -1,45 +1,39 @@
 import os
-import sys
 import functools
-import subprocess
 
 import click
-import yaml
 
+from cooly import ssh
+from cooly.trace import start as start_trace
 
-binpath = os.path.dirname(sys.executable)
-FABCMD = os.path.join(binpath, 'fab')
 
-pkgpath = os.path.dirname(os.path.abspath(__file__))
-FABFILE = os.path.join(pkgpath, 'fabfile.py')
+# Note: Heavyweight modules (e.g. `yaml`, and Fabric which `cooly.api`
+# depends on) are imported by the commands which need them, to keep the
+# startup of `cooly` fast.
 
 
-def fab(cmd, *args):
-    """Run `cmd` with `args` via the fab command."""
-    unicode_args = [
-        unicode(
-            ';'.join(arg) if arg and isinstance(arg, (list, tuple)) else arg
-        )
-        for arg in args
-    ]
-    full_cmd = [
-        FABCMD, '-f', FABFILE,
-        '%s:%s' % (cmd, ','.join(unicode_args))
-    ]
-    return subprocess.call(full_cmd)
-
-
-def merge_arguments_with_config(part=None, requires=()):
+def merge_arguments_with_config(part=None, requires=(), multiple=False,
+                                shared=()):
     """A command decorator.
 
     This decorator let the command prefer the arguments specified
     on command line to the values from the configuration file.
+
+    If `multiple` is true, the command accepts multiple configuration
+    files, each of which is either the one of a project, or a project set
+    listing the configuration files of its projects (relative to itself)
+    as `projects`. The command is then called with the list of the names
+    and the arguments of all projects, and the `shared` arguments which
+    are not merged.
     """
     def get_config_values(config):
         """Get all valid values from the configuration file."""
+        import yaml
+        # Prefer the much faster loader of LibYAML if available
+        loader = getattr(yaml, 'CLoader', yaml.Loader)
         try:
             with open(config) as f:
-                config_values = yaml.load(f)
+                config_values = yaml.load(f, Loader=loader)
         except IOError:
             raise click.UsageError('Could not find the configuration file '
                                    '"%s"!' % config)
@@ -54,30 +48,57 @@ def merge_arguments_with_config(part=None, requires=()):
                                    'configuration file! Please correct them.')
         return config_values
 
+    def expand_project_sets(configs):
+        """Replace the project sets in `configs` with their projects."""
+        projects = []
+        for config in configs:
+            config_values = get_config_values(config)
+            if 'projects' not in config_values:
+                projects.append((config, config_values))
+                continue
+            base = os.path.dirname(config)
+            projects.extend(expand_project_sets(
+                os.path.join(base, path)
+                for path in config_values['projects'] or ()
+            ))
+        return projects
+
     NULL_VALUES = (None, (), [])
 
+    def merge(config_values, kwargs):
+        arguments = dict(kwargs)
+        # Update null arguments if `config_values` is specified
+        if config_values is not None:
+            for arg, value in arguments.iteritems():
+                if value in NULL_VALUES:
+                    if part:
+                        c_part, c_arg = part, arg
+                    else:
+                        c_part, c_arg = arg.split('_', 1)
+                    c_value = config_values.get(c_part, {}).get(c_arg)
+                    arguments[arg] = c_value
+        # Validate required arguments
+        for arg in requires:
+            if arguments[arg] in NULL_VALUES:
+                raise click.UsageError(
+                    'Missing argument "%s".%r' % (arg, arguments[arg])
+                )
+        return arguments
+
     def wrapper(command):
         @functools.wraps(command)
         def decorator(config, **kwargs):
-            arguments = kwargs
-            # Update null arguments if `config` is specified
-            if config is not None:
-                config_values = get_config_values(config)
-                for arg, value in arguments.iteritems():
-                    if value in NULL_VALUES:
-                        if part:
-                            c_part, c_arg = part, arg
-                        else:
-                            c_part, c_arg = arg.split('_', 1)
-                        c_value = config_values.get(c_part, {}).get(c_arg)
-                        arguments[arg] = c_value
-            # Validate required arguments
-            for arg in requires:
-                if arguments[arg] in NULL_VALUES:
-                    raise click.UsageError(
-                        'Missing argument "%s".%r' % (arg, arguments[arg])
-                    )
-            return command(**arguments)
+            if not multiple:
+                config_values = (get_config_values(config)
+                                 if config is not None else None)
+                return command(**merge(config_values, kwargs))
+            shared_arguments = {arg: kwargs.pop(arg) for arg in shared}
+            projects = expand_project_sets(config) or [(None, None)]
+            return command(
+                [(name, merge(config_values, kwargs))
+                 for name, config_values in projects],
+                **shared_arguments
+            )
         return decorator
     return wrapper
 
@@ -96,8 +117,35 @@ def add_param_dict(command):
     'auto_envvar_prefix': 'COOLY'
 })
 @click.version_option()
-def cli():
+@click.option('--ssh-control-dir', type=click.Path(),
+              help='The local directory to keep the sockets of the shared '
+                   'SSH connections, which all remote commands and '
+                   'transfers multiplex over, across stages, parallel '
+                   'workers and invocations. Only the local SSH agent, keys '
+                   'and configuration authenticate them. An empty value '
+                   'disables the sharing, and falls back to the connections '
+                   'of Fabric. Defaults to `%s`.'
+                   % ssh.CONTROL_DIR)
+@click.option('--ssh-control-persist', type=int,
+              help='The number of seconds to keep a shared SSH connection '
+                   'open after its last use, so that the following commands '
+                   'can reuse it. 0 closes it immediately. Defaults to %s.'
+                   % ssh.CONTROL_PERSIST)
+@click.option('--ssh-keepalive', type=int,
+              help='The number of seconds between the keepalive messages '
+                   'sent over SSH connections. 0 disables them. Defaults to '
+                   '%s.' % ssh.KEEPALIVE)
+@click.option('--trace', type=click.Path(dir_okay=False),
+              help='The file to write the timing trace of the stages and '
+                   'operations on each server to, as a Chrome trace (to be '
+                   'loaded by `chrome://tracing` or Perfetto), or as JSON '
+                   'lines if the name ends with `.jsonl`. Defaults to no '
+                   'trace.')
+def cli(ssh_control_dir, ssh_control_persist, ssh_keepalive, trace):
     """Cooly helps you deploy Python projects."""
+    ssh.configure(ssh_control_dir, ssh_control_persist, ssh_keepalive)
+    if trace:
+        start_trace(trace)
 
 
 @add_param_dict
@@ -118,14 +166,42 @@ def cli():
 @click.option('--output', type=click.Path(),
               help='The destination directory to store the archive. '
                    'Defaults to `/tmp`.')
+@click.option('--store/--no-store', default=None,
+              help='Whether to reuse the archive previously created from '
+                   'the same tree in the destination directory. Defaults '
+                   'to `--store`.')
+@click.option('--compression',
+              help='The compression of the archive in the form of '
+                   '`NAME[:LEVEL[:THREADS]]`, where NAME is one of gzip, '
+                   'pigz, zstd, lz4 and none (e.g. `zstd:3:8`). The '
+                   'programs of the codec (except none) must be available '
+                   'locally and on the build server. Defaults to `gzip`.')
+@click.option('--mirror-dir', type=click.Path(),
+              help='The local directory to cache the bare mirrors of '
+                   'remote repositories in, which are fetched '
+                   'incrementally and archived from directly. An empty '
+                   'value mirrors the repository into a temporary '
+                   'directory every time. Defaults to '
+                   '`~/.cache/cooly/mirrors`.')
+@click.option('--mirror-depth', type=int,
+              help='The depth of the history to mirror, which must include '
+                   'the tree or commit to archive. Defaults to the whole '
+                   'history.')
+@click.option('--mirror-filter',
+              help='The filter of the objects to mirror for partial clones '
+                   '(e.g. `blob:none`), whose missing objects are fetched '
+                   'when archiving. Defaults to all objects.')
+@click.option('--mirror-max-size', type=int,
+              help='The maximum total size (in megabytes) of the cached '
+                   'mirrors, beyond which the least recently used ones are '
+                   'removed. Defaults to be unlimited.')
 @merge_arguments_with_config('archive', requires=('repo',))
-def archive(repo, tree_ish, name_format, output):
+def archive(repo, tree_ish, name_format, output, store, compression,
+            mirror_dir, mirror_depth, mirror_filter, mirror_max_size):
     """Archive the package."""
-    name_format = name_format or (
-        '{name}-{version}-{tree_ish}-{datetime:%Y%m%d%H%M%S}'
-    )
-    return fab('archive', repo, tree_ish or 'HEAD',
-               name_format, output or '/tmp')
+    from cooly import api
+    api.archive(repo, tree_ish, name_format, output, store, compression,
+                mirror_dir, mirror_depth, mirror_filter, mirror_max_size)
 
 
 @add_param_dict
@@ -162,12 +238,81 @@ def archive(repo, tree_ish, name_format, output):
 @click.option('--wheel-cache', type=click.Path(),
               help='The path to an optional folder where Cooly should '
                    'cache wheels. Defaults to `~/.cache/cooly`.')
+@click.option('--store/--no-store', default=None,
+              help='Whether to reuse the distribution previously built '
+                   'from the same package and build arguments in the '
+                   'local folder. The requirements file and scripts outside '
+                   'the project are hashed on the build server, and the '
+                   'distribution is not reused if they cannot be. Defaults '
+                   'to `--store`.')
+@click.option('--layers/--no-layers', default=None,
+              help='Whether to split the distribution into a dependency '
+                   'layer and an application layer. The dependency layer '
+                   'is cached on the servers to install on, and is only '
+                   'uploaded when the dependencies change. Defaults to '
+                   '`--no-layers`.')
+@click.option('--push/--no-push', default=None,
+              help='Whether to keep the distribution on the build server '
+                   '(or the relay server) to push it to the servers to '
+                   'install on directly, instead of downloading it before '
+                   'installing. Defaults to `--no-push`.')
+@click.option('--relay',
+              help='The hostname of an optional relay server, to which '
+                   'the build server copies the distribution to be pushed.')
+@click.option('--local-copy/--no-local-copy', default=None,
+              help='Whether to download a copy of the pushed distribution '
+                   'to the local folder in the background. Defaults to '
+                   '`--local-copy`.')
+@click.option('--stream/--no-stream', default=None,
+              help='Whether to extract the package on the build server '
+                   'while uploading it over SSH, instead of uploading it '
+                   'to a temporary file first. Defaults to `--no-stream`.')
+@click.option('--compression',
+              help='The compression of the distribution in the form of '
+                   '`NAME[:LEVEL[:THREADS]]`, where NAME is one of gzip, '
+                   'pigz, zstd, lz4 and none (e.g. `zstd:3:8`). The '
+                   'programs of the codec (except none) must be available '
+                   'on the build server, locally and on the servers to '
+                   'install on. Defaults to `gzip`.')
+@click.option('--shared-wheel-cache', type=click.Path(),
+              help='The local directory to share the wheels built by all '
+                   'build servers in. The compatible wheels missing on the '
+                   'build server are pushed to its wheel cache before the '
+                   'build, and the new wheels built there are pulled back '
+                   'after it. Defaults to no sharing.')
+@click.option('--shared-wheel-cache-max-size', type=int,
+              help='The maximum total size (in megabytes) of the shared '
+                   'wheels, beyond which the least recently used ones are '
+                   'removed. Defaults to be unlimited.')
+@click.option('--workspace', type=click.Path(),
+              help='The persistent directory on the build server (or '
+                   'locally) to build the project in incrementally. Only '
+                   'the changed files of the package are applied to it, '
+                   'and the dependencies are only resolved from the wheel '
+                   'cache if the requirements are unchanged. A workspace '
+                   'is locked while building. When deploying, each project '
+                   'builds in a subdirectory of it named after its '
+                   'repository; otherwise it must not be shared by '
+                   'different projects. A leading `~` is expanded on the '
+                   'build server. Defaults to a temporary directory for '
+                   'each build.')
+@click.option('--resumable/--no-resumable', default=None,
+              help='Whether to upload the package to the build server and '
+                   'download the distribution from it in chunks, which '
+                   'resume from the last intact chunk if interrupted, and '
+                   'are checked by their SHA1 digests. Defaults to '
+                   '`--no-resumable`.')
 @merge_arguments_with_config('build', requires=('toolbin', 'output'))
 def build(pkg, host, toolbin, output, requirements,
-          pre_script, post_script, wheel_cache):
+          pre_script, post_script, wheel_cache, store, layers,
+          push, relay, local_copy, stream, compression, shared_wheel_cache,
+          shared_wheel_cache_max_size, workspace, resumable):
     """Build the package."""
-    return fab('build', pkg, host, toolbin, output, requirements,
-               pre_script, post_script, wheel_cache or '~/.cache/cooly')
+    from cooly import api
+    api.build(pkg, toolbin, output, host, requirements, pre_script,
+              post_script, wheel_cache, store, layers, push, relay,
+              local_copy, stream, compression, shared_wheel_cache,
+              shared_wheel_cache_max_size, workspace, resumable)
 
 
 @add_param_dict
@@ -176,27 +321,101 @@ def build(pkg, host, toolbin, output, requirements,
               help='The configuration file.')
 @click.argument('dist', type=click.Path(), required=True)
 @click.option('--hosts',
-              help='The hostnames of the servers to install on.',
+              help='The hostnames of the servers to install on. When '
+                   'deploying, each of them can be tagged with its platform '
+                   'in the form of `HOST=PLATFORM`, to install the '
+                   'distribution built for the platform.',
               multiple=True)
 @click.option('--path', type=click.Path(),
               help='The installation path on the server.')
 @click.option('--pre-command', help='The command to run before installing.')
 @click.option('--post-command', help='The command to run after installing.')
-@click.option('--max-versions',
-              help='The maximum number of the versions installed. '
-                   'If specified (must be greater than 0), the earliest '
-                   'versions will be removed when the number exceeds the '
-                   'limit. Defaults to be unlimited.')
-@merge_arguments_with_config('install', requires=('hosts', 'path'))
-def install(dist, hosts, path, pre_command, post_command, max_versions):
+@click.option('--max-versions', type=int,
+              help='The maximum number of the versions installed (must be '
+                   'greater than 0), beyond which the earliest versions '
+                   'will be removed. Required.')
+@click.option('--parallel', type=int,
+              help='The maximum number of servers to install on at the '
+                   'same time. Defaults to 1 (serially).')
+@click.option('--wave',
+              help='The number (e.g. `10`) or the percentage (e.g. `10%`) '
+                   'of servers in each wave. A wave always finishes before '
+                   'the next one starts. Defaults to all servers in a '
+                   'single wave.')
+@click.option('--canary', type=int,
+              help='The number of servers to install on first, as a wave '
+                   'on their own, before the other waves. Defaults to 0.')
+@click.option('--max-failure-ratio', type=float,
+              help='The maximum ratio (between 0 and 1) of the failed '
+                   'servers in a wave. The installation is aborted once a '
+                   'wave exceeds it. Defaults to 0.')
+@click.option('--transfer',
+              type=click.Choice(['full', 'delta', 'stream', 'resumable']),
+              help='How to upload the distribution. `full` uploads the '
+                   'whole distribution, `stream` extracts the distribution '
+                   'while uploading it over SSH, `resumable` uploads the '
+                   'distribution in chunks, resuming from the last intact '
+                   'chunk if interrupted (even in an earlier run), and '
+                   'checks its SHA1 digest before extracting it, and '
+                   '`delta` only uploads the files changed since the '
+                   'latest installation, and falls back to `full` if the '
+                   'result does not match. '
+                   'Layered distributions are always uploaded by layers. '
+                   'Defaults to `full`.')
+@click.option('--fanout', type=int,
+              help='The degree of the tree to fan the distribution out '
+                   'across the servers before installing. If specified, '
+                   'the distribution is only uploaded to the first '
+                   '`fanout` servers, and each server then relays it to '
+                   '`fanout` other ones over scp (1 for a chain). The '
+                   'servers must be able to scp to each other, e.g. by '
+                   'SSH agent forwarding. Defaults to no fan-out.')
+@click.option('--batch/--no-batch', default=None,
+              help='Whether to run all installation steps on a server as '
+                   'a single script, which reports the status and the time '
+                   'of each step. Layered distributions and delta '
+                   'transfers are not supported. Defaults to `--no-batch`.')
+@click.option('--dedup', type=click.Choice(['hardlink', 'reflink']),
+              help='How to deduplicate the installed version against the '
+                   'current one. The files unchanged since the current '
+                   'version are replaced by hardlinks to (`hardlink`), or '
+                   'reflinks of (`reflink`, on filesystems supporting it) '
+                   'the ones of the current version, so that the versions '
+                   'share the disk space and the page cache. Hardlinked '
+                   'files must not be modified in place. Defaults to no '
+                   'deduplication.')
+@click.option('--prune', type=click.Choice(['background', 'sync']),
+              help='How to remove the versions beyond `--max-versions`. '
+                   'They are always moved aside at once, and then removed '
+                   'at the lowest I/O priority, either in the background '
+                   '(`background`) or before the installation finishes '
+                   '(`sync`). Defaults to `background`.')
+@click.option('--two-phase/--no-two-phase', default=None,
+              help='Whether to install in two phases: the new version is '
+                   'staged on all servers first (on up to `--parallel` '
+                   'servers at the same time, defaulting to all), while the '
+                   'current version keeps serving, and then activated and '
+                   'followed by the post-install command on all servers of '
+                   'each wave at once. Defaults to `--no-two-phase`.')
+@merge_arguments_with_config('install',
+                             requires=('hosts', 'path', 'max_versions'))
+def install(dist, hosts, path, pre_command, post_command, max_versions,
+            parallel, wave, canary, max_failure_ratio, transfer, fanout,
+            batch, dedup, prune, two_phase):
     """Install the distribution."""
-    return fab('install', dist, hosts, path,
-               pre_command, post_command, max_versions)
+    from cooly import api
+    api.install(dist, hosts, path, pre_command, post_command, max_versions,
+                parallel, wave, canary, max_failure_ratio, transfer, fanout,
+                batch, dedup, prune, two_phase)
 
 
 @cli.command('deploy')
-@click.option('-c', '--config', type=click.Path(),
-              help='The configuration file.')
+@click.option('-c', '--config', type=click.Path(), multiple=True,
+              help='The configuration file, or a project set listing the '
+                   'configuration files of its projects as `projects`. '
+                   'Multiple projects (by multiple configuration files or '
+                   'project sets) are deployed at once, with their stages '
+                   'pipelined.')
 @click.option('--archive-repo',
               help=archive.param_dict['repo'].help)
 @click.option('--archive-tree-ish',
@@ -206,8 +425,32 @@ def install(dist, hosts, path, pre_command, post_command, max_versions):
 @click.option('--archive-output',
               type=archive.param_dict['output'].type,
               help=archive.param_dict['output'].help)
+@click.option('--archive-store/--no-archive-store', default=None,
+              help=archive.param_dict['store'].help)
+@click.option('--archive-compression',
+              help=archive.param_dict['compression'].help)
+@click.option('--archive-mirror-dir',
+              type=archive.param_dict['mirror_dir'].type,
+              help=archive.param_dict['mirror_dir'].help)
+@click.option('--archive-mirror-depth',
+              type=archive.param_dict['mirror_depth'].type,
+              help=archive.param_dict['mirror_depth'].help)
+@click.option('--archive-mirror-filter',
+              help=archive.param_dict['mirror_filter'].help)
+@click.option('--archive-mirror-max-size',
+              type=archive.param_dict['mirror_max_size'].type,
+              help=archive.param_dict['mirror_max_size'].help)
 @click.option('--build-host',
               help=build.param_dict['host'].help)
+@click.option('--build-hosts', multiple=True,
+              help='The pool of build servers, each of which can be tagged '
+                   'with the platform it builds for in the form of '
+                   '`HOST=PLATFORM`. The package is built once for each '
+                   'platform of the servers to install on, on the least '
+                   'loaded build server of the platform. If all servers to '
+                   'install on are of the same platform, the first build '
+                   'server of the platform is always used. Overrides '
+                   '`--build-host`.')
 @click.option('--build-toolbin',
               type=build.param_dict['toolbin'].type,
               help=build.param_dict['toolbin'].help)
@@ -226,6 +469,31 @@ def install(dist, hosts, path, pre_command, post_command, max_versions):
 @click.option('--build-wheel-cache',
               type=build.param_dict['wheel_cache'].type,
               help=build.param_dict['wheel_cache'].help)
+@click.option('--build-store/--no-build-store', default=None,
+              help=build.param_dict['store'].help)
+@click.option('--build-layers/--no-build-layers', default=None,
+              help=build.param_dict['layers'].help)
+@click.option('--build-push/--no-build-push', default=None,
+              help=build.param_dict['push'].help)
+@click.option('--build-relay',
+              help=build.param_dict['relay'].help)
+@click.option('--build-local-copy/--no-build-local-copy', default=None,
+              help=build.param_dict['local_copy'].help)
+@click.option('--build-stream/--no-build-stream', default=None,
+              help=build.param_dict['stream'].help)
+@click.option('--build-compression',
+              help=build.param_dict['compression'].help)
+@click.option('--build-shared-wheel-cache',
+              type=build.param_dict['shared_wheel_cache'].type,
+              help=build.param_dict['shared_wheel_cache'].help)
+@click.option('--build-shared-wheel-cache-max-size',
+              type=build.param_dict['shared_wheel_cache_max_size'].type,
+              help=build.param_dict['shared_wheel_cache_max_size'].help)
+@click.option('--build-workspace',
+              type=build.param_dict['workspace'].type,
+              help=build.param_dict['workspace'].help)
+@click.option('--build-resumable/--no-build-resumable', default=None,
+              help=build.param_dict['resumable'].help)
 @click.option('--install-hosts',
               help=install.param_dict['hosts'].help,
               multiple=True)
@@ -237,28 +505,133 @@ def install(dist, hosts, path, pre_command, post_command, max_versions):
 @click.option('--install-post-command',
               help=install.param_dict['post_command'].help)
 @click.option('--install-max-versions',
+              type=install.param_dict['max_versions'].type,
               help=install.param_dict['max_versions'].help)
+@click.option('--install-parallel',
+              type=install.param_dict['parallel'].type,
+              help=install.param_dict['parallel'].help)
+@click.option('--install-wave',
+              help=install.param_dict['wave'].help)
+@click.option('--install-canary',
+              type=install.param_dict['canary'].type,
+              help=install.param_dict['canary'].help)
+@click.option('--install-max-failure-ratio',
+              type=install.param_dict['max_failure_ratio'].type,
+              help=install.param_dict['max_failure_ratio'].help)
+@click.option('--install-transfer',
+              type=install.param_dict['transfer'].type,
+              help=install.param_dict['transfer'].help)
+@click.option('--install-fanout',
+              type=install.param_dict['fanout'].type,
+              help=install.param_dict['fanout'].help)
+@click.option('--install-batch/--no-install-batch', default=None,
+              help=install.param_dict['batch'].help)
+@click.option('--install-dedup',
+              type=install.param_dict['dedup'].type,
+              help=install.param_dict['dedup'].help)
+@click.option('--install-prune',
+              type=install.param_dict['prune'].type,
+              help=install.param_dict['prune'].help)
+@click.option('--install-two-phase/--no-install-two-phase', default=None,
+              help=install.param_dict['two_phase'].help)
+@click.option('--max-builds-per-host', type=int,
+              help='The maximum number of projects to build on each build '
+                   'host (or locally) at the same time, when deploying '
+                   'multiple projects. Defaults to 1.')
+@click.option('--max-installs-per-host', type=int,
+              help='The maximum number of projects to install on each '
+                   'install host at the same time, when deploying multiple '
+                   'projects. Defaults to 1.')
 @merge_arguments_with_config(requires=(
     'archive_repo',
     'build_toolbin', 'build_output',
-    'install_hosts', 'install_path'
-))
-def deploy(archive_repo, archive_tree_ish, archive_name_format, archive_output,
-           build_host, build_toolbin, build_output, build_requirements,
-           build_pre_script, build_post_script, build_wheel_cache,
-           install_hosts, install_path, install_pre_command,
-           install_post_command, install_max_versions):
-    """Deploy the package."""
-    archive_name_format = archive_name_format or (
-        '{name}-{version}-{tree_ish}-{datetime:%Y%m%d%H%M%S}'
-    )
-    return fab('deploy', archive_repo, archive_tree_ish or 'HEAD',
-               archive_name_format, archive_output or '/tmp',
-               build_host, build_toolbin, build_output, build_requirements,
-               build_pre_script, build_post_script,
-               build_wheel_cache or '~/.cache/cooly',
-               install_hosts, install_path, install_pre_command,
-               install_post_command, install_max_versions)
+    'install_hosts', 'install_path', 'install_max_versions'
+), multiple=True, shared=('max_builds_per_host', 'max_installs_per_host'))
+def deploy(projects, max_builds_per_host, max_installs_per_host):
+    """Deploy the package, or multiple projects at once."""
+    from cooly import api
+    configs = [(name or 'default', make_deploy_config(**arguments))
+               for name, arguments in projects]
+    if len(configs) == 1:
+        api.deploy(configs[0][1])
+    else:
+        api.deploy_projects(configs, max_builds_per_host,
+                            max_installs_per_host)
+
+
+def make_deploy_config(archive_repo, archive_tree_ish, archive_name_format,
+                       archive_output, archive_store, archive_compression,
+                       archive_mirror_dir, archive_mirror_depth,
+                       archive_mirror_filter, archive_mirror_max_size,
+                       build_host, build_hosts, build_toolbin, build_output,
+                       build_requirements, build_pre_script,
+                       build_post_script, build_wheel_cache, build_store,
+                       build_layers, build_push, build_relay,
+                       build_local_copy, build_stream, build_compression,
+                       build_shared_wheel_cache,
+                       build_shared_wheel_cache_max_size, build_workspace,
+                       build_resumable,
+                       install_hosts, install_path, install_pre_command,
+                       install_post_command, install_max_versions,
+                       install_parallel, install_wave, install_canary,
+                       install_max_failure_ratio, install_transfer,
+                       install_fanout, install_batch, install_dedup,
+                       install_prune, install_two_phase):
+    """Make the configuration of `api.deploy` from the arguments of the
+    `deploy` command.
+    """
+    return {
+        'archive': {
+            'repo': archive_repo,
+            'tree_ish': archive_tree_ish,
+            'name_format': archive_name_format,
+            'output': archive_output,
+            'store': archive_store,
+            'compression': archive_compression,
+            'mirror_dir': archive_mirror_dir,
+            'mirror_depth': archive_mirror_depth,
+            'mirror_filter': archive_mirror_filter,
+            'mirror_max_size': archive_mirror_max_size,
+        },
+        'build': {
+            'host': build_host,
+            'hosts': build_hosts,
+            'toolbin': build_toolbin,
+            'output': build_output,
+            'requirements': build_requirements,
+            'pre_script': build_pre_script,
+            'post_script': build_post_script,
+            'wheel_cache': build_wheel_cache,
+            'store': build_store,
+            'layers': build_layers,
+            'push': build_push,
+            'relay': build_relay,
+            'local_copy': build_local_copy,
+            'stream': build_stream,
+            'compression': build_compression,
+            'shared_wheel_cache': build_shared_wheel_cache,
+            'shared_wheel_cache_max_size': build_shared_wheel_cache_max_size,
+            'workspace': build_workspace,
+            'resumable': build_resumable,
+        },
+        'install': {
+            'hosts': install_hosts,
+            'path': install_path,
+            'pre_command': install_pre_command,
+            'post_command': install_post_command,
+            'max_versions': install_max_versions,
+            'parallel': install_parallel,
+            'wave': install_wave,
+            'canary': install_canary,
+            'max_failure_ratio': install_max_failure_ratio,
+            'transfer': install_transfer,
+            'fanout': install_fanout,
+            'batch': install_batch,
+            'dedup': install_dedup,
+            'prune': install_prune,
+            'two_phase': install_two_phase,
+        },
+    }
 
 
 @cli.command('list')
@@ -272,10 +645,45 @@ def deploy(archive_repo, archive_tree_ish, archive_name_format, archive_output,
 @click.option('--path', type=click.Path(),
               help='The directory path to the versions. This can be the same '
                    'as the `--path` argument of the `cooly install` command.')
+@click.option('--parallel', type=int,
+              help='The maximum number of servers to list on at the same '
+                   'time. Defaults to all servers.')
+@click.option('--cached/--no-cached', default=None,
+              help='Whether to list the versions from the local cache of '
+                   'the latest listings only, without connecting to the '
+                   'servers. The cache is also used for the servers which '
+                   'fail to list. Defaults to `--no-cached`.')
 @merge_arguments_with_config('install', requires=('path',))
-def _list(hosts, path):
+def _list(hosts, path, parallel, cached):
     """List all available versions."""
-    return fab('list', hosts, path)
+    from cooly import api
+    api.list(hosts, path, parallel, cached)
+
+
+@cli.command('prune')
+@click.option('-c', '--config', type=click.Path(),
+              help='The configuration file.')
+@click.option('--hosts',
+              help='The hostnames of the servers where the versions located. '
+                   'This can be the same as the `--hosts` argument of the '
+                   '`cooly install` command.',
+              multiple=True)
+@click.option('--path', type=click.Path(),
+              help='The directory path to the versions. This can be the same '
+                   'as the `--path` argument of the `cooly install` command.')
+@click.option('--max-versions', type=int,
+              help='The number of the latest versions to keep, besides the '
+                   'current one. This can be the same as the '
+                   '`--max-versions` argument of the `cooly install` '
+                   'command.')
+@click.option('--parallel', type=int,
+              help='The maximum number of servers to prune on at the same '
+                   'time. Defaults to 1 (serially).')
+@merge_arguments_with_config('install', requires=('path', 'max_versions'))
+def prune(hosts, path, max_versions, parallel):
+    """Remove the obsolete versions at the lowest I/O priority."""
+    from cooly import api
+    api.prune(hosts, path, max_versions, parallel)
 
 
 @cli.command('rollback')
@@ -293,8 +701,12 @@ def _list(hosts, path):
               help='The command to run after rollbacking. This is the '
                    'same as the `--post-command` argument of the `cooly '
                    'install` command.')
+@click.option('--parallel', type=int,
+              help='The maximum number of servers to rollback on at the '
+                   'same time. Defaults to 1 (serially).')
 @click.argument('version', required=True)
 @merge_arguments_with_config('install', requires=('path',))
-def rollback(hosts, path, post_command, version):
+def rollback(hosts, path, post_command, version, parallel):
     """Rollback current version to the specified one."""
-    return fab('rollback', hosts, path, post_command, version)
+    from cooly import api
+    api.rollback(hosts, path, version, post_command, parallel)
@@ -0,0 +1,218 @@
+"""Compression codecs of packages, distributions and their layers.
+
+A codec is specified as `NAME[:LEVEL[:THREADS]]` (e.g. `zstd:19:8`), and
+is recorded in the extension of the files it compresses, so that they
+can always be decompressed without knowing how they were created. The
+codecs other than gzip and none run external programs, which must be
+available on the hosts involved.
+"""
+
+import tarfile
+import tempfile
+import subprocess
+from collections import OrderedDict
+
+
+DEFAULT_CODEC = 'gzip'
+
+
+class Codec(object):
+    """A compression codec run by an external `program`, which compresses
+    the standard input to the standard output by `compress_options`, and
+    decompresses it by `-d`, as `tar --use-compress-program` requires.
+    """
+
+    def __init__(self, name, extension, program, compress_options='-c',
+                 level_option='-%s', threads_option=None):
+        self.name = name
+        self.extension = extension
+        self.program = program
+        self.compress_options = compress_options
+        self.level_option = level_option
+        self.threads_option = threads_option
+
+    def __repr__(self):
+        return '<Codec %s>' % self.name
+
+
+CODECS = OrderedDict((codec.name, codec) for codec in [
+    Codec('gzip', '.tar.gz', 'gzip', '-cn'),
+    Codec('pigz', '.tar.gz', 'pigz', '-cn', threads_option='-p %s'),
+    Codec('zstd', '.tar.zst', 'zstd', '-qc', threads_option='-T%s'),
+    Codec('lz4', '.tar.lz4', 'lz4', '-qc'),
+    Codec('none', '.tar', None, level_option=None),
+])
+
+
+class Compression(object):
+    """A codec with its options."""
+
+    def __init__(self, codec, level=None, threads=None):
+        if level is not None and codec.level_option is None:
+            raise RuntimeError('Codec `%s` does not support levels'
+                               % codec.name)
+        if threads is not None and codec.threads_option is None:
+            raise RuntimeError('Codec `%s` does not support threads'
+                               % codec.name)
+        self.codec = codec
+        self.level = level
+        self.threads = threads
+
+    @classmethod
+    def parse(cls, spec):
+        """Parse `spec` in the form of `NAME[:LEVEL[:THREADS]]`, where
+        None means the default codec.
+        """
+        parts = str(spec or DEFAULT_CODEC).split(':')
+        if parts[0] not in CODECS or len(parts) > 3:
+            raise RuntimeError(
+                'Unknown compression `%s`, which should be in the form of '
+                '`NAME[:LEVEL[:THREADS]]`, where NAME is one of %s'
+                % (spec, ', '.join(CODECS))
+            )
+        try:
+            options = [int(part) if part else None for part in parts[1:]]
+        except ValueError:
+            raise RuntimeError('The level and threads of compression `%s` '
+                               'are not integers' % spec)
+        return cls(CODECS[parts[0]], *options)
+
+    @classmethod
+    def for_path(cls, path):
+        """Get the compression of the file `path` by its extension."""
+        # Match `.tar.gz` before `.tar`
+        codecs = sorted(CODECS.values(), key=lambda c: -len(c.extension))
+        for codec in codecs:
+            if path.endswith(codec.extension):
+                return cls(codec)
+        raise RuntimeError('Unknown compression of %s' % path)
+
+    def __str__(self):
+        options = [self.level, self.threads]
+        while options and options[-1] is None:
+            options.pop()
+        return ':'.join([self.codec.name] + [
+            '' if option is None else str(option) for option in options
+        ])
+
+    @property
+    def extension(self):
+        return self.codec.extension
+
+    @property
+    def is_builtin(self):
+        """Whether the codec is supported by Python and `tar` themselves."""
+        return self.codec.name in ('gzip', 'none') and self.level is None
+
+    @property
+    def compress_command(self):
+        """The command to compress the standard input to the standard
+        output.
+        """
+        if self.codec.program is None:
+            return 'cat'
+        command = [self.codec.program, self.codec.compress_options]
+        if self.level is not None:
+            command.append(self.codec.level_option % self.level)
+        if self.threads is not None:
+            command.append(self.codec.threads_option % self.threads)
+        return ' '.join(command)
+
+    @property
+    def decompress_command(self):
+        """The command to decompress the standard input to the standard
+        output.
+        """
+        if self.codec.program is None:
+            return 'cat'
+        return '%s -dc' % self.codec.program
+
+
+def strip_extension(name):
+    """Strip the extension of any known codec off `name`."""
+    extensions = sorted(set(c.extension for c in CODECS.values()),
+                        key=len, reverse=True)
+    for extension in extensions:
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def extract_command(archive, directory, strip_components=0,
+                    compression=None):
+    """Get the command to extract `archive` into `directory`.
+
+    The `compression` defaults to the one of the extension of `archive`,
+    and must be specified if `archive` is `-` (the standard input).
+    """
+    compression = compression or Compression.for_path(archive)
+    options = []
+    if compression.codec.program is not None:
+        options.append('-I %s' % compression.codec.program)
+    if strip_components:
+        options.append('--strip-components=%s' % strip_components)
+    options.append('-xf %s -C %s' % (archive, directory))
+    return 'tar %s' % ' '.join(options)
+
+
+class OwnedTarFile(tarfile.TarFile):
+    """A tar archive over a file object it owns (e.g. a temporary file,
+    or a pipe to a compressor), which is finished by `on_close` once the
+    archive is closed.
+    """
+
+    on_close = None
+
+    def close(self):
+        if self.closed:
+            return
+        tarfile.TarFile.close(self)
+        if self.on_close:
+            self.on_close()
+
+
+def open_tar(path):
+    """Open the tar archive `path` for reading, whatever its codec is.
+
+    Archives of the codecs unknown to Python are decompressed into a
+    temporary file first, to allow random access to their members.
+    """
+    compression = Compression.for_path(path)
+    if compression.is_builtin:
+        return tarfile.open(path)
+
+    temp = tempfile.TemporaryFile()
+    with open(path, 'rb') as f:
+        subprocess.check_call(compression.decompress_command, shell=True,
+                              stdin=f, stdout=temp)
+    temp.seek(0)
+    tar = OwnedTarFile.open(fileobj=temp)
+    tar.on_close = temp.close
+    return tar
+
+
+def create_tar(path, compression):
+    """Create the tar archive `path` compressed by `compression`.
+
+    Archives of the codecs unknown to Python are piped to the compressor,
+    which is waited for when the archive is closed.
+    """
+    if compression.is_builtin:
+        return tarfile.open(
+            path, 'w:gz' if compression.codec.name == 'gzip' else 'w'
+        )
+
+    output = open(path, 'wb')
+    process = subprocess.Popen(compression.compress_command, shell=True,
+                               stdin=subprocess.PIPE, stdout=output)
+    output.close()
+
+    def finish():
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError('Failed to compress %s by `%s`'
+                               % (path, compression.compress_command))
+
+    tar = OwnedTarFile.open(fileobj=process.stdin, mode='w|')
+    tar.on_close = finish
+    return tar
@@ -0,0 +1,66 @@
+"""Deduplicate the files of a version against the previous version.
+
+The installation script builds a virtualenv in place, which is not
+relocatable, so a new version is always written in full. Once it is
+installed, each of its regular files identical to the one at the same
+path in the version served currently (in content, mode and owner) is
+replaced by a hardlink to (or a reflink of) the latter. As a result,
+the unchanged files of all kept versions share the disk space and the
+page cache.
+
+The replacement is atomic, so a file is either the original one or the
+linked one even if the deduplication is interrupted. Note that the
+hardlinked files are shared by the versions, and must not be modified
+in place.
+"""
+
+import pipes
+
+
+METHODS = ('hardlink', 'reflink')
+
+# The suffix of the temporary links, which are renamed over the files
+TEMP_SUFFIX = '.cooly-dedup'
+
+SCRIPT = '''\
+basis=$(readlink -f %(serve_path)s)
+version=$(readlink -f %(version_path)s)
+if [ -d "$basis" ] && [ "$basis" != "$version" ]; then
+    count=$(cd "$version" && find . -type f -print0 |
+    while IFS= read -r -d '' f; do
+        f=${f#./} b="$basis/${f#./}" t="$f%(suffix)s"
+        [ -f "$b" ] && [ ! -L "$b" ] && [ ! "$f" -ef "$b" ] &&
+        cmp -s "$f" "$b" &&
+        [ "$(stat -c %%a:%%u:%%g "$f")" = "$(stat -c %%a:%%u:%%g "$b")" ] ||
+        continue
+        { %(link)s "$b" "$t" && mv -f "$t" "$f" && echo "$f"; } ||
+        rm -f "$t"
+    done | wc -l)
+    echo "$count files deduplicated against $basis"
+else
+    echo 'No previous version to deduplicate against'
+fi
+'''
+
+LINK_COMMANDS = {
+    'hardlink': 'ln',
+    'reflink': 'cp -p --reflink=always',
+}
+
+
+def dedup_command(version_path, serve_path, method='hardlink'):
+    """Get the command to deduplicate the files in `version_path` against
+    the version `serve_path` links to, by `method` (one of `METHODS`).
+
+    It must run before `serve_path` is switched to `version_path`.
+    """
+    if method not in METHODS:
+        raise RuntimeError('Unknown deduplication method `%s`, which should '
+                           'be one of %s' % (method, ', '.join(METHODS)))
+    script = SCRIPT % {
+        'serve_path': pipes.quote(serve_path),
+        'version_path': pipes.quote(version_path),
+        'link': LINK_COMMANDS[method],
+        'suffix': TEMP_SUFFIX,
+    }
+    return 'bash -c %s' % pipes.quote(script)
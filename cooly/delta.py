@@ -0,0 +1,144 @@
+"""Compute the delta between a distribution and the previous one.
+
+The signature of the previous distribution, which is kept extracted on
+each host, is a list of SHA1 digests of its files (as printed by
+`sha1sum`). Only the files whose digests are not in the signature need
+to be shipped, and the others can be copied from the previous one.
+"""
+
+import os
+import json
+import uuid
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+from cooly.layers import strip_toplevel
+from cooly.compression import Compression, open_tar, create_tar
+
+
+# The directory under the installation path to keep the extracted
+# distribution of the latest installation
+BASIS_DIR = '.cooly-delta'
+
+
+def parse_signature(output):
+    """Parse the `output` of `sha1sum` to a mapping from the relative
+    path of each file to its SHA1 digest.
+    """
+    signature = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        digest, name = line.split(None, 1)
+        # Skip the mark of the binary mode
+        name = name.lstrip('*')
+        if name.startswith('./'):
+            name = name[2:]
+        signature[name] = digest
+    return signature
+
+
+def copy_member(tar, member, fileobj):
+    """Copy the content of the tar `member` to `fileobj`, and return its
+    SHA1 hex digest.
+    """
+    sha1 = hashlib.sha1()
+    source = tar.extractfile(member)
+    for chunk in iter(lambda: source.read(65536), b''):
+        sha1.update(chunk)
+        fileobj.write(chunk)
+    return sha1.hexdigest()
+
+
+def make_delta(dist, signature, output):
+    """Make the delta of `dist` against the `signature` of the previous
+    distribution in the directory `output`.
+
+    Return the paths to three files: a tarball of the changed files
+    (compressed in the same way as `dist`), a list of the unchanged files,
+    and the checksums of all files in the format of `sha1sum`. Also return
+    the number of bytes changed.
+    """
+    suffix = uuid.uuid4()
+    compression = Compression.for_path(dist)
+    delta_path = os.path.join(output, 'delta-%s%s' % (suffix,
+                                                      compression.extension))
+    unchanged_path = os.path.join(output, 'unchanged-%s.txt' % suffix)
+    sums_path = os.path.join(output, 'sha1sums-%s.txt' % suffix)
+
+    changed_bytes = 0
+    with open_tar(dist) as tar:
+        delta_tar = create_tar(delta_path, compression)
+        try:
+            with open(unchanged_path, 'w') as unchanged_file:
+                with open(sums_path, 'w') as sums_file:
+                    for member in tar:
+                        if '/' not in member.name:
+                            # Throw away the toplevel folder
+                            continue
+                        name = strip_toplevel(member.name)
+                        if not member.isfile():
+                            member.name = name
+                            delta_tar.addfile(member)
+                            continue
+
+                        # Spool the content while hashing it, to avoid
+                        # seeking backwards in the compressed stream
+                        spool = tempfile.SpooledTemporaryFile(2 ** 20)
+                        digest = copy_member(tar, member, spool)
+                        sums_file.write('%s  %s\n' % (digest, name))
+                        if signature.get(name) == digest:
+                            unchanged_file.write(name + '\n')
+                        else:
+                            spool.seek(0)
+                            member.name = name
+                            delta_tar.addfile(member, spool)
+                            changed_bytes += member.size
+                        spool.close()
+        finally:
+            delta_tar.close()
+
+    return delta_path, unchanged_path, sums_path, changed_bytes
+
+
+class DeltaCache(object):
+    """A local cache of the deltas of the distributions in `path`, by the
+    signatures they are made against, so that the delta against the same
+    previous distribution is only made once, even by the processes forked
+    to install on hosts in parallel.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, dist, signature):
+        """Get the delta of `dist` against `signature` (as returned by
+        `make_delta`), making it if missing.
+        """
+        key = hashlib.sha1(repr(
+            (os.path.basename(dist), sorted(signature.items()))
+        ).encode('utf-8')).hexdigest()
+        delta_dir = os.path.join(self.path, key)
+        try:
+            os.makedirs(delta_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        index = os.path.join(delta_dir, 'index.json')
+        # Let the other processes wait for the delta being made
+        with open(os.path.join(delta_dir, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(index):
+                with open(index) as f:
+                    return tuple(json.load(f))
+            delta = make_delta(dist, signature, delta_dir)
+            with open(index, 'w') as f:
+                json.dump(delta, f)
+            return delta
+
+    def clear(self):
+        """Remove all deltas."""
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -1,25 +1,65 @@
 import os
 import uuid
+import pipes
+import hashlib
 import functools
+import contextlib
+import subprocess
 import datetime
+import threading
+import time
 from collections import OrderedDict
 
 from fabric.api import (
-    task, settings, env, execute,
+    settings, env, execute,
     lcd, local, cd, run, put, get
 )
-from fabric.context_managers import quiet
-from fabric.colors import green, yellow
+from fabric.context_managers import quiet, hide
+from fabric.decorators import parallel as run_in_parallel
+from fabric.colors import green, yellow, red
+
+from cooly import batch as batch_script, layers, resumable, ssh, trace, \
+    wheels
+from cooly import workspace as build_workspace
+from cooly import manifest as version_manifest
+from cooly.compression import Compression, strip_extension, extract_command
+from cooly.dedup import dedup_command
+from cooly.metadata import get_metadata
+from cooly.mirrors import MirrorCache
+from cooly.prune import prune_command
+from cooly.remote import multiplexed, quote_path, split_host_string, \
+    ssh_command
+from cooly.delta import BASIS_DIR as DELTA_BASIS_DIR, \
+    parse_signature, DeltaCache
+
+
+# Run all remote operations over the master connections (if enabled), and
+# trace all local and remote operations
+run, put, get = [multiplexed(f) for f in (run, put, get)]
+local, run, put, get = [trace.operation(f) for f in (local, run, put, get)]
 
 
-EXT = '.tar.gz'
 LATEST_FLAG = 'LATEST'
+# The directory on the build host (or the relay) to keep the distributions
+# which are pushed to the install hosts directly
+PUSHED_DIST_DIR = '/tmp/cooly-dists'
+# The local directory to keep the deltas made during an installation
+DELTA_CACHE_DIR = '/tmp/cooly-delta'
 
 
 class Scratchpads(object):
+    """The scratchpads to clean up, which are tracked per thread, so that
+    a thread only cleans up the ones it made.
+    """
 
     def __init__(self):
-        self.queue = []
+        self.local = threading.local()
+
+    @property
+    def queue(self):
+        if not hasattr(self.local, 'queue'):
+            self.local.queue = []
+        return self.local.queue
 
     def execute(self, cmd, host):
         if host is None:
@@ -32,41 +72,103 @@ class Scratchpads(object):
         temp = os.path.join('/tmp/cooly-' + suffix, str(uuid.uuid4()))
         self.queue.append((temp, host))
         print('Created scratchpad in %s' % temp)
-        self.execute('mkdir -p %s' % temp, host)
+        with trace.span('scratchpad make', 'scratchpad', host, path=temp):
+            self.execute('mkdir -p %s' % temp, host)
         return temp
 
     def cleanup(self):
         while self.queue:
             temp, host = self.queue.pop()
             print('Cleaning up scratchpad in %s' % temp)
-            self.execute('rm -rf %s' % temp, host)
+            with trace.span('scratchpad cleanup', 'scratchpad', host,
+                            path=temp):
+                self.execute('rm -rf %s' % temp, host)
 
 
 # The global scratchpads
-# Note: This is not thread-safe, but is enough for now.
 scratchpads = Scratchpads()
 
 
-def pythonic_arguments(task):
-    """A decorator that tries to evaluate all meaningful strings to
-    Python values.
+class ArtifactStore(object):
+    """A local content-addressed store of the artifacts in `output`.
+
+    Each artifact is indexed by a key computed from all inputs producing
+    it, so that identical inputs are never archived or built twice.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.index = os.path.join(output, '.cooly-store')
+
+    def make_key(self, *inputs):
+        sha1 = hashlib.sha1()
+        for value in inputs:
+            sha1.update(('%r\0' % (value,)).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def lookup(self, key):
+        """Return the path to the artifact indexed by `key`, or None if
+        no such artifact exists.
+        """
+        try:
+            with open(os.path.join(self.index, key)) as f:
+                artifact = os.path.join(self.output, f.read().strip())
+        except IOError:
+            return None
+        return artifact if os.path.isfile(artifact) else None
+
+    def record(self, key, artifact):
+        """Index the `artifact` in `output` by `key`."""
+        if not os.path.isdir(self.index):
+            os.makedirs(self.index)
+        entry = os.path.join(self.index, key)
+        # Write to a temporary file first to update the entry atomically
+        with open(entry + '.tmp', 'w') as f:
+            f.write(os.path.basename(artifact) + '\n')
+        os.rename(entry + '.tmp', entry)
+
+
+def file_digest(path):
+    """Get the SHA1 hex digest of the content of local file `path`."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, 65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def external_file_digests(paths, host=None):
+    """Get the SHA1 hex digests of the files of `paths` outside the
+    package (absolute, or relative to the home directory), on `host` or
+    locally, ignoring the others and None. Return None if any of them
+    cannot be hashed.
     """
-    def evaluate(string):
+    paths = [path for path in paths
+             if path and (os.path.isabs(path) or path.startswith('~'))]
+    if not paths:
+        return []
+    if not host:
         try:
-            value = eval(string)
-        except Exception:
-            value = string
-        return value
+            return [file_digest(os.path.expanduser(path)) for path in paths]
+        except (IOError, OSError):
+            return None
+    with settings(quiet(), host_string=host):
+        result = run('sha1sum %s' % ' '.join(quote_path(path)
+                                             for path in paths))
+    if result.failed:
+        return None
+    return [line.split()[0] for line in result.splitlines()]
 
-    @functools.wraps(task)
-    def decorator(*args, **kwargs):
-        evaluated_args = [evaluate(arg) for arg in args]
-        evaluated_kwargs = {
-            arg: evaluate(value)
-            for arg, value in kwargs.iteritems()
-        }
-        return task(*evaluated_args, **evaluated_kwargs)
-    return decorator
+
+class HostFailure(object):
+    """The result of a piece of work which failed on a single host."""
+
+    def __init__(self, host, reason):
+        self.host = host
+        self.reason = reason
+
+    def __repr__(self):
+        return '<HostFailure %s: %s>' % (self.host, self.reason)
 
 
 def cleanup_scratchpads(task):
@@ -82,6 +184,113 @@ def cleanup_scratchpads(task):
     return decorator
 
 
+def guard_host_work(work):
+    """A decorator that turns any failure of the per-host `work` into a
+    `HostFailure` result, instead of aborting the whole execution.
+
+    The scratchpads made by `work` are cleaned up on the host as soon as
+    it finishes, since a parallel worker has its own copy of them.
+    """
+    @functools.wraps(work)
+    def decorator(*args, **kwargs):
+        try:
+            try:
+                return work(*args, **kwargs)
+            finally:
+                scratchpads.cleanup()
+        except (Exception, SystemExit) as e:
+            # `SystemExit` is raised by Fabric whenever a command fails
+            return HostFailure(env.host_string, str(e) or repr(e))
+    return decorator
+
+
+def split_into_waves(host_list, wave=None, canary=None):
+    """Split `host_list` into waves of hosts.
+
+    The first `canary` hosts (if specified) make up a wave on their own.
+    Each of the remaining waves has `wave` hosts, which is either a
+    number (e.g. `10`) or a percentage of all hosts (e.g. `'10%'`).
+    """
+    total = len(host_list)
+    if isinstance(canary, int) and canary > 0:
+        waves = [host_list[:canary]]
+        host_list = host_list[canary:]
+    else:
+        waves = []
+
+    if not wave:
+        size = len(host_list)
+    elif str(wave).endswith('%'):
+        size = int(total * float(wave[:-1]) / 100)
+    else:
+        size = int(wave)
+    # At least one host per wave
+    size = max(size, 1)
+
+    for i in range(0, len(host_list), size):
+        waves.append(host_list[i:i + size])
+    return waves
+
+
+def execute_in_waves(work, host_list, parallel=None, wave=None,
+                     canary=None, max_failure_ratio=None):
+    """Execute `work` on the hosts in `host_list` wave by wave, and
+    return the mapping from each host to its result.
+
+    In each wave, `work` runs on up to `parallel` hosts at the same
+    time (serially, by default). A wave always finishes before the next
+    one starts, and the execution is aborted if the ratio of the failed
+    hosts in a wave exceeds `max_failure_ratio` (defaults to 0).
+    """
+    if parallel is None:
+        parallel = 1
+    if not isinstance(parallel, int) or parallel < 1:
+        raise RuntimeError('Argument `parallel` is not a positive integer')
+    max_failure_ratio = max_failure_ratio or 0
+
+    guarded_work = guard_host_work(work)
+    if parallel > 1:
+        guarded_work = run_in_parallel(pool_size=parallel)(guarded_work)
+
+    waves = split_into_waves(host_list, wave, canary)
+    results = OrderedDict()
+    for i, wave_hosts in enumerate(waves):
+        if len(waves) > 1:
+            print(yellow('>>> Wave %s/%s: %s' % (
+                i + 1, len(waves), ', '.join(wave_hosts)
+            )))
+
+        failures = []
+        max_failures = max_failure_ratio * len(wave_hosts)
+        if parallel > 1:
+            wave_results = execute(guarded_work, hosts=wave_hosts)
+            for host in wave_hosts:
+                results[host] = wave_results.get(host)
+                if isinstance(results[host], HostFailure):
+                    failures.append(results[host])
+        else:
+            # Fail fast as soon as the wave can not succeed any more
+            for host in wave_hosts:
+                results.update(execute(guarded_work, hosts=[host]))
+                if isinstance(results[host], HostFailure):
+                    failures.append(results[host])
+                    if len(failures) > max_failures:
+                        break
+
+        for failure in failures:
+            print(red('>>> Failed on %s: %s' % (failure.host,
+                                                 failure.reason)))
+        if len(failures) > max_failures:
+            raise SystemExit(
+                'Error: {0} of {1} hosts failed in wave {2}, which exceeds '
+                'the maximum failure ratio {3}'.format(
+                    len(failures), len(wave_hosts), i + 1, max_failure_ratio
+                )
+            )
+
+    return results
+
+
 '''
 # The following version only works locally.
 
@@ -102,25 +311,6 @@ def get_obsolete_version_names(path, max_versions, excludes=None):
 '''
 
 
-def get_obsolete_version_names(path, max_versions, ignore_pattern=''):
-    """Get the names of all obsolete versions in remote `path` except the
-    names matching the `ignore_pattern`. As a result, the number of the
-    latest versions in remote `path` is no more than `max_versions`.
-    """
-    # List all names of the entries in `path`
-    # Options:
-    #     -1: list one file per line
-    #     -t: sort by modification time, neweset first
-    #     -I PATTERN: do not list implied entries matching shell PATTERN
-    ignore_option = '-I %s' % ignore_pattern if ignore_pattern else ''
-    result = run('ls -1t %s %s' % (ignore_option, path))
-
-    # Convert the result, a single (likely multiline) string, to a list
-    names = result.splitlines()
-
-    return names[max_versions:]
-
-
 def cp(source, dest):
     """Copy `source` to `dest` locally."""
     local('cp -rf %s %s' % (source, dest))
@@ -130,48 +320,539 @@ def get_versions_alias_mapping(path, remote=True, latest_flag=LATEST_FLAG):
     """Get the ordered mapping from the alias to the name of the
     versions in `path`, latest first.
     """
+    _, versions = read_versions(path, remote)
+    return version_manifest.alias_mapping(versions, latest_flag)
+
+
+def read_versions(path, remote=True):
+    """Get the name of the current version and the versions in `path`,
+    latest first, from the manifest.
+    """
     with quiet():
-        cmd = 'ls -1t -I current %s' % path
+        cmd = version_manifest.read_command(path)
         if remote:
-            result = run(cmd)
+            output = run(cmd)
         else:
-            result = local(cmd, capture=True)
-        names = result.splitlines()
+            output = local(cmd, capture=True)
+    return version_manifest.parse(output)
+
+
+def put_layers(manifest, install_tmp, path):
+    """Upload the distribution layers in `manifest` and assemble them
+    in `install_tmp` on the current host.
 
+    The dependency layer is cached under `path`, and is only uploaded
+    if the current host has not got it yet.
+    """
+    deps = manifest['deps']
+    cache_path = os.path.join(path, layers.CACHE_DIR)
+    deps_path = os.path.join(cache_path, deps['hash'])
+    with quiet():
+        cached = run('test -d %s' % deps_path).succeeded
+    if cached:
+        print('Using cached dependency layer %s' % deps['hash'])
+        # Mark the layer as recently used
+        run('touch %s' % deps_path)
+    else:
+        put(deps['path'], os.path.join(install_tmp, deps['name']))
+        # Extract aside first to make the cached layer appear atomically
+        deps_tmp = os.path.join(cache_path, '.%s' % uuid.uuid4())
+        run('mkdir -p %s' % deps_tmp)
+        run(extract_command(os.path.join(install_tmp, deps['name']),
+                            deps_tmp))
+        run('mv -T %s %s || rm -rf %s' % (deps_tmp, deps_path, deps_tmp))
+
+    app = manifest['app']
+    with cd(install_tmp):
+        put(app['path'], app['name'])
+        run(extract_command(app['name'], '.', strip_components=1))
+        run('cp -R %s/. .' % deps_path)
+
+
+def put_delta(dist, install_tmp, path, deltas):
+    """Upload the delta of `dist` against the distribution installed
+    latest on the current host, and rebuild `dist` in `install_tmp`.
+    The delta is made once for each previous distribution, and kept in
+    the `DeltaCache` `deltas`.
+
+    Return whether the rebuilt distribution matches `dist`. If not,
+    `install_tmp` is emptied for a full upload.
+    """
+    basis_path = os.path.join(path, DELTA_BASIS_DIR)
+    with quiet():
+        result = run('ls -1t %s' % basis_path)
+    names = result.splitlines() if result.succeeded else []
     if not names:
-        return {}
+        print('No previous distribution found on %s to compute the delta'
+              % env.host_string)
+        return False
+
+    # Get the signature of the previous distribution
+    basis = os.path.join(basis_path, names[0])
+    with cd(basis), quiet():
+        signature = parse_signature(run('find . -type f -exec sha1sum {} +'))
+
+    delta_path, unchanged_path, sums_path, changed_bytes = deltas.get(
+        dist, signature
+    )
+    print('Uploading the delta (%s bytes changed) against %s'
+          % (changed_bytes, names[0]))
+
+    with cd(install_tmp), settings(warn_only=True):
+        for source in (delta_path, unchanged_path, sums_path):
+            put(source, os.path.basename(source))
+        delta_name, unchanged_name, sums_name = [
+            os.path.basename(p) for p in (delta_path, unchanged_path,
+                                          sums_path)
+        ]
+        # Copy the unchanged files from the previous distribution, extract
+        # the changed ones, and then verify all of them
+        matched = (
+            run('(cd %s && tar -cf - -T %s) | tar -xf -' % (
+                basis, os.path.join(install_tmp, unchanged_name)
+            )).succeeded and
+            run(extract_command(delta_name, '.')).succeeded and
+            run('sha1sum -c --quiet %s' % sums_name).succeeded
+        )
+        run('rm -f %s %s %s' % (delta_name, unchanged_name, sums_name))
+
+    if not matched:
+        print(red('The rebuilt distribution does not match, falling back '
+                  'to a full upload'))
+        run('find %s -mindepth 1 -delete' % install_tmp)
+    return matched
+
+
+def keep_delta_basis(install_tmp, path, dist_name):
+    """Keep the distribution extracted in `install_tmp` as the basis of
+    the next delta transfer on the current host.
+    """
+    basis_path = os.path.join(path, DELTA_BASIS_DIR)
+    # Remove the distribution uploaded in full if any
+    run('rm -f %s' % os.path.join(install_tmp, dist_name))
+    run('rm -rf %s && mkdir -p %s' % (basis_path, basis_path))
+    run('mv %s %s' % (install_tmp, os.path.join(basis_path, dist_name)))
+
+
+def fanout_levels(host_list, degree):
+    """Build a `degree`-ary tree over `host_list`, and return its levels
+    from top to bottom. Each level is a mapping from the parent host (None
+    for the local host) to its children hosts.
+
+    The top level has `degree` hosts, and a tree of degree 1 is a chain.
+    """
+    def children_of(i):
+        start = degree * (i + 1)
+        return range(start, min(start + degree, len(host_list)))
+
+    levels = [{None: host_list[:degree]}]
+    indexes = range(min(degree, len(host_list)))
+    while True:
+        level = OrderedDict(
+            (host_list[i], [host_list[c] for c in children_of(i)])
+            for i in indexes if children_of(i)
+        )
+        if not level:
+            return levels
+        levels.append(level)
+        indexes = [c for i in indexes for c in children_of(i)]
+
+
+def scp_destination(host, path, multiplex=True):
+    """Get the scp options and destination to copy a file to `path` on
+    `host`. Only scp run on the local host should `multiplex`.
+    """
+    destination, port = split_host_string(host)
+    options = ssh.options(port, port_flag='-P', multiplex=multiplex)
+    return options, '%s:%s' % (destination, path)
+
+
+def capture_output(host, command):
+    """Run `command` on `host` (or locally), and return its output."""
+    return run(command) if host else local(command, capture=True)
+
+
+@contextlib.contextmanager
+def lock_workspace(workspace, host):
+    """A context manager to hold the lock of the build `workspace` (if
+    any) on `host` (or locally) in it.
+    """
+    if not workspace:
+        yield
+        return
+    smart_run = run if host else local
+    with trace.span('lock workspace', host=host or 'localhost'):
+        smart_run(build_workspace.lock_command(workspace))
+    try:
+        yield
+    finally:
+        smart_run(build_workspace.unlock_command(workspace))
+
+
+def pipe_to_host(source, host, command, capture=False):
+    """Pipe the local file `source` into `command` on `host` over SSH.
+
+    The file is consumed while being transferred, instead of being
+    uploaded to a temporary file first.
+    """
+    with trace.span('pipe', host=host, bytes=trace.file_size(source)):
+        return local('%s < %s' % (ssh_command(host, command),
+                                  pipes.quote(source)), capture=capture)
+
+
+def put_resumable(source, remote_path):
+    """Upload the local file `source` to `remote_path` on the current host
+    in a resumable way, checking its integrity before it appears there.
+    """
+    host = env.host_string
+    size, hashes, digest = resumable.file_hashes(source)
+    partial = resumable.partial_path(digest, host)
+    # Whether the partial file is fully received but does not match
+    corrupt = False
+    with trace.span('resumable upload', host=host, bytes=size):
+        for attempt in range(1, resumable.MAX_ATTEMPTS + 1):
+            with quiet():
+                output = run(resumable.hashes_command(partial))
+            received, received_hashes, _ = resumable.parse_hashes(output)
+            offset = resumable.resume_offset(received, received_hashes,
+                                             size, hashes)
+            if offset == size and corrupt:
+                offset = len(hashes) * resumable.CHUNK_SIZE
+            if 0 < offset < size:
+                print('Resuming the upload of %s at %s of %s bytes' % (
+                    source, offset, size
+                ))
+            run(resumable.prepare_command(partial, offset))
+            if offset < size:
+                with settings(warn_only=True):
+                    sent = local('%s | %s' % (
+                        resumable.read_command(source, offset),
+                        ssh_command(host, resumable.append_command(partial))
+                    )).succeeded
+                if not sent:
+                    print(red('>>> Upload attempt %s of %s interrupted' % (
+                        attempt, resumable.MAX_ATTEMPTS
+                    )))
+                    continue
+            with quiet():
+                corrupt = not run(resumable.finish_command(
+                    partial, remote_path, digest
+                )).succeeded
+            if not corrupt:
+                return
+            print(red('>>> The upload of %s is corrupt' % source))
+    raise SystemExit('Error: Failed to upload {0} after {1} attempts'.format(
+        source, resumable.MAX_ATTEMPTS
+    ))
+
+
+def get_resumable(host, remote_path, local_path):
+    """Download `remote_path` on `host` to the local file `local_path` in
+    a resumable way, checking its integrity before it appears there.
+    """
+    with quiet():
+        output = run(resumable.hashes_command(remote_path, digest=True))
+    size, hashes, digest = resumable.parse_hashes(output)
+    partial = local_path + '.part'
+    corrupt = False
+    with trace.span('resumable download', host=host, bytes=size):
+        for attempt in range(1, resumable.MAX_ATTEMPTS + 1):
+            received, received_hashes = 0, []
+            if os.path.exists(partial):
+                received, received_hashes, _ = resumable.file_hashes(partial)
+            offset = resumable.resume_offset(received, received_hashes,
+                                             size, hashes)
+            if offset == size and corrupt:
+                offset = len(hashes) * resumable.CHUNK_SIZE
+            if 0 < offset < size:
+                print('Resuming the download of %s at %s of %s bytes' % (
+                    remote_path, offset, size
+                ))
+            with open(partial, 'ab') as f:
+                f.truncate(offset)
+            if offset < size:
+                with settings(warn_only=True):
+                    received = local('%s >> %s' % (
+                        ssh_command(host, resumable.read_command(remote_path,
+                                                                 offset)),
+                        pipes.quote(partial)
+                    )).succeeded
+                if not received:
+                    print(red('>>> Download attempt %s of %s interrupted' % (
+                        attempt, resumable.MAX_ATTEMPTS
+                    )))
+                    continue
+            corrupt = file_digest(partial) != digest
+            if not corrupt:
+                os.rename(partial, local_path)
+                return
+            print(red('>>> The download of %s is corrupt' % remote_path))
+    raise SystemExit('Error: Failed to download {0} after {1} '
+                     'attempts'.format(remote_path, resumable.MAX_ATTEMPTS))
+
+
+def push_wheels(shared_cache, host, wheel_cache, toolbin):
+    """Push the wheels in `shared_cache`, which are compatible with and
+    missing on `host` (or locally), into `wheel_cache` there.
+    """
+    with quiet():
+        output = capture_output(
+            host, wheels.inspect_command(wheel_cache, toolbin)
+        )
+    if output.failed:
+        raise RuntimeError('Failed to inspect the wheel cache %s' %
+                           wheel_cache)
+    tags, existing = wheels.parse_inspection(output)
+    missing = shared_cache.missing(existing, tags)
+    if not missing:
+        return
+    shared_cache.touch(missing)
+
+    scratchpad = scratchpads.make('wheels')
+    list_path = os.path.join(scratchpad, 'wheels')
+    tarball = os.path.join(scratchpad, 'wheels.tar')
+    with open(list_path, 'w') as f:
+        f.write(''.join(wheel + '\n' for wheel in missing))
+    local('tar -C %s -cf %s -T %s' % (shared_cache.cache_dir, tarball,
+                                      list_path))
+    extract = 'tar -C %s -xf -' % wheel_cache
+    if host:
+        pipe_to_host(tarball, host, extract)
+    else:
+        local('%s < %s' % (extract, tarball))
+    print('Pushed %s wheels for %s to %s' % (len(missing), '-'.join(tags),
+                                             host or 'localhost'))
 
-    mapping = OrderedDict([(latest_flag, names[0])])
-    for i, name in enumerate(names[1:]):
-        mapping['%s~%s' % (latest_flag, i + 1)] = name
-    return mapping
+
+def sync_wheels(sync, shared_cache, host, *args):
+    """Push or pull (by `sync`) the wheels between `shared_cache` and
+    `host`, without failing the build, which only gets slower without
+    the shared wheels.
+    """
+    with trace.span(sync.__name__, host=host or 'localhost'):
+        try:
+            sync(shared_cache, host, *args)
+        except (Exception, SystemExit) as e:
+            # `SystemExit` is raised by Fabric whenever a command fails
+            print(red('Failed to %s: %s' % (sync.__name__.replace('_', ' '),
+                                            str(e) or repr(e))))
+
+
+def pull_wheels(shared_cache, host, wheel_cache):
+    """Pull the wheels in `wheel_cache` on `host` (or locally), which are
+    missing in `shared_cache`, into it.
+    """
+    with quiet():
+        output = capture_output(host, wheels.list_command(wheel_cache))
+    if output.failed:
+        raise RuntimeError('Failed to list the wheel cache %s' %
+                           wheel_cache)
+    new = sorted(set(os.path.normpath(line.strip())
+                     for line in output.splitlines() if line.strip()) -
+                 shared_cache.wheels())
+    if not new:
+        return
+
+    scratchpad = scratchpads.make('wheels')
+    list_path = os.path.join(scratchpad, 'wheels')
+    with open(list_path, 'w') as f:
+        f.write(''.join(wheel + '\n' for wheel in new))
+    archive = 'cd %s && tar -cf - -T -' % wheel_cache
+    if host:
+        archive = ssh_command(host, archive)
+    incoming_dir = shared_cache.make_incoming_dir()
+    try:
+        local('%s < %s | tar -C %s -xf -' % (archive, list_path,
+                                              incoming_dir))
+        added = shared_cache.add(incoming_dir)
+    finally:
+        shared_cache.remove_incoming_dir(incoming_dir)
+    shared_cache.evict()
+    print('Pulled %s wheels from %s' % (added, host or 'localhost'))
+
+
+def split_remote_dist(dist):
+    """Split `dist` into the host and the path if it is a distribution on
+    a remote host (in the form of `HOST:PATH`), otherwise return None as
+    the host.
+    """
+    if ':' in dist and not os.path.exists(dist):
+        host, path = dist.rsplit(':', 1)
+        return host, path
+    return None, dist
+
+
+# The local copies of the pushed distributions, which are being
+# downloaded in the background
+local_copies = []
+
+
+def copy_to_local_async(host, remote_path, local_path, on_done=None):
+    """Start downloading `remote_path` on `host` to `local_path` in the
+    background. The `on_done` callback is called once it succeeds.
+    """
+    options, source = scp_destination(host, remote_path)
+    cmd = 'scp -q %s %s %s' % (options, source, local_path)
+    print('Copying the distribution to %s in the background' % local_path)
+    local_copies.append((subprocess.Popen(cmd, shell=True), on_done, host,
+                         local_path, time.time()))
+
+
+def wait_for_local_copies():
+    """Wait for all local copies to be downloaded."""
+    while local_copies:
+        process, on_done, host, local_path, start_time = local_copies.pop()
+        if process.wait() != 0:
+            print(red('>>> Failed to download a local copy of the '
+                      'distribution'))
+        elif on_done:
+            on_done()
+        trace.record('local copy', start_time, time.time() - start_time,
+                     host=host, bytes=trace.file_size(local_path),
+                     status=process.returncode)
+
+
+def fanout_dist(dist, host_list, degree, resume=False):
+    """Stage `dist` on all hosts in `host_list` by a `degree`-ary tree,
+    and return the paths to the staged distribution by the hosts which
+    have got it.
+
+    The source host, which is the local host or the remote host of
+    `dist`, only copies `dist` to the top level hosts, and each host then
+    relays it to its children over host-to-host scp. A host which fails
+    to get it just has nothing staged, and the partial copy left there
+    (if any) is removed. The uploads from the local host are resumable if
+    `resume` is true.
+    """
+    source_host, source_path = split_remote_dist(dist)
+    staged = '/tmp/cooly-fanout-%s-%s' % (uuid.uuid4(),
+                                          os.path.basename(dist))
+    levels = fanout_levels(host_list, degree)
+    if source_host:
+        levels[0] = {source_host: levels[0][None]}
+
+    def upload():
+        """Upload from the local host."""
+        if resume:
+            put_resumable(dist, staged)
+        else:
+            put(dist, staged)
+        return [env.host_string]
+
+    def relay():
+        """Relay to all children of the current host at the same time,
+        and return the children which have got it.
+        """
+        children = level[env.host_string]
+        relayed = source_path if env.host_string == source_host else staged
+        commands = [
+            '{ scp -q %s %s %s && echo %s; } & pids="$pids $!"' % (
+                options, relayed, destination, pipes.quote(child)
+            )
+            for child, (options, destination) in (
+                (child, scp_destination(child, staged, multiplex=False))
+                for child in children
+            )
+        ]
+        commands.append('for pid in $pids; do wait $pid; done')
+        with settings(warn_only=True):
+            output = run('pids=; ' + '; '.join(commands))
+        return [child for child in output.splitlines() if child in children]
+
+    def remove_partial():
+        """Remove the partial copy left on the current host."""
+        run('rm -f %s' % staged)
+
+    print(yellow('>>> Fan out to %s hosts in %s levels.'
+                 % (len(host_list), len(levels))))
+    staged_hosts = set()
+    for i, level in enumerate(levels):
+        if i == 0 and not source_host:
+            work, parents = upload, level[None]
+        else:
+            # Only relay from the hosts which have got the distribution
+            work = relay
+            parents = [host for host in level
+                       if host in staged_hosts or host == source_host]
+        results = execute_in_waves(work, parents, max(len(parents), 1),
+                                   max_failure_ratio=1)
+        for host, result in results.items():
+            if not isinstance(result, HostFailure):
+                staged_hosts.update(result)
+
+    failed_hosts = [host for host in host_list if host not in staged_hosts]
+    if failed_hosts:
+        with quiet():
+            execute_in_waves(remove_partial, failed_hosts, len(failed_hosts),
+                             max_failure_ratio=1)
+    return {host: staged for host in host_list if host in staged_hosts}
+
+
+def put_dist(dist, remote_path, staged=None, resume=False):
+    """Upload `dist` to `remote_path` on the current host (in a resumable
+    way if `resume` is true), or just move it there if it has been
+    staged on the host, where `staged` holds the paths to the staged
+    distribution by the hosts (see `fanout_dist`).
+    """
+    staged_path = (staged or {}).get(env.host_string)
+    if staged_path:
+        with quiet():
+            moved = run('mv %s %s' % (staged_path, remote_path)).succeeded
+        if moved:
+            return
+    if split_remote_dist(dist)[0]:
+        raise RuntimeError('The distribution %s has not been pushed to %s'
+                           % (dist, env.host_string))
+    if resume:
+        put_resumable(dist, remote_path)
+    else:
+        put(dist, remote_path)
 
 
-@task
-@pythonic_arguments
 @cleanup_scratchpads
-def archive(repo, tree_ish, name_format, output):
+def archive(repo, tree_ish, name_format, output, use_store, compression,
+            mirror_dir, mirror_depth, mirror_filter, mirror_max_size):
     """Archive the package."""
     print(yellow('>>> Archive stage.'))
+    compression = Compression.parse(compression)
 
     # Archive local repository
     if repo.startswith('file://'):
         repo_path = repo[len('file://'):]
+        source_path = repo_path
     # Archive remote repository
     # since `git archive --remote` is not widely supported,
-    # we use `git clone` first, and then use `git archive` locally
+    # we mirror the repository first, and then use `git archive` locally
     else:
-        repo_tmp = scratchpads.make('archive')
-        with lcd(repo_tmp):
-            local('git clone %s' % repo)
-        repo_path = local('ls -d %s/*' % repo_tmp, capture=True)
+        if mirror_dir == '':
+            # Mirror the repository into a scratchpad for this time only
+            mirror_dir, mirror_max_size = scratchpads.make('archive'), None
+        mirrors = MirrorCache(mirror_dir, mirror_depth, mirror_filter,
+                              mirror_max_size)
+        repo_path = mirrors.update(repo)
+        # The mirror is bare, and the source tree is only extracted once
+        # it is needed
+        source_path = None
+
+    # Reuse the package archived from the same tree if any
+    with lcd(repo_path):
+        tree = local('git rev-parse "%s^{tree}"' % tree_ish, capture=True)
+    store = ArtifactStore(output)
+    key = store.make_key('archive', tree, name_format, str(compression))
+    pkg = store.lookup(key) if use_store is not False else None
+    if pkg:
+        print(green('>>> Package %s found in the store!' % pkg))
+        return pkg
 
     # Analyze the package
-    setup_py = os.path.join(repo_path, 'setup.py')
-    if not os.path.isfile(setup_py):
-        raise RuntimeError('No `setup.py` found in the package %r' % repo_path)
-    name, version = local('python %s --name --version' % setup_py,
-                          capture=True).splitlines()
+    if source_path is None:
+        source_path = scratchpads.make('archive')
+        source_tar = os.path.join(source_path, '.cooly-source.tar')
+        with lcd(repo_path):
+            local('git archive -o %s %s' % (source_tar, tree_ish))
+        local('tar -xf %s -C %s && rm %s' % (source_tar, source_path,
+                                             source_tar))
+    name, version = get_metadata(source_path, tree)
 
     pkg_name = '%s%s' % (
         name_format.format(
@@ -180,23 +861,68 @@ def archive(repo, tree_ish, name_format, output):
             tree_ish=tree_ish,
             datetime=datetime.datetime.now()
         ),
-        EXT
+        compression.extension
     )
     pkg = os.path.join(output, pkg_name)
+    # Let git compress the archive by the codec, as a custom tar format
+    archive_format = compression.extension.lstrip('.')
     with lcd(repo_path):
-        local('git archive -o "%s" %s' % (pkg, tree_ish))
+        local('git -c "tar.%s.command=%s" archive --format=%s -o "%s" %s' % (
+            archive_format, compression.compress_command, archive_format,
+            pkg, tree_ish
+        ))
+    store.record(key, pkg)
 
     print(green('>>> Package %s created!' % pkg))
     return pkg
 
 
-@task
-@pythonic_arguments
 @cleanup_scratchpads
 def build(pkg, host, toolbin, output, requirements,
-          pre_script, post_script, wheel_cache):
-    """Build the package."""
+          pre_script, post_script, wheel_cache, use_store, use_layers,
+          push, relay, local_copy, stream, compression, shared_wheel_cache,
+          shared_wheel_cache_max_size, workspace, use_resumable, platform):
+    """Build the package.
+
+    If `push` is true and `host` is specified, the distribution is kept on
+    `host` (or copied to `relay`) instead of being downloaded, and the
+    returned one is in the form of `HOST:PATH`.
+
+    If the `platform` of `host` is specified, the distribution built on
+    any host of the same platform is reused.
+    """
     print(yellow('>>> Build stage.'))
+    compression = Compression.parse(compression)
+
+    # Reuse the distribution built from the same inputs if any
+    store = ArtifactStore(output)
+    builder = 'platform:%s' % platform if host and platform else host
+    inputs = [file_digest(pkg), builder, toolbin, requirements,
+              pre_script, post_script, str(compression)]
+    # The files outside the package may change on their own, so their
+    # contents are hashed (on the build host) too
+    external_digests = None
+    if use_store is not False:
+        external_digests = external_file_digests(
+            (requirements, pre_script, post_script), host
+        )
+        if external_digests is None:
+            print('The store is skipped, since the requirements or scripts '
+                  'outside the package cannot be hashed')
+    key = None
+    if external_digests is not None:
+        key = store.make_key('build', *(inputs + external_digests))
+    dist = store.lookup(key) if key else None
+    if dist:
+        print(green('>>> Distribution %s found in the store!' % dist))
+        if use_layers and not layers.load_manifest(dist):
+            layers.split(dist, compression)
+        return dist
+
+    shared_wheels = None
+    if shared_wheel_cache:
+        shared_wheels = wheels.SharedWheelCache(shared_wheel_cache,
+                                                shared_wheel_cache_max_size)
 
     # Remote operations
     if host:
@@ -205,134 +931,556 @@ def build(pkg, host, toolbin, output, requirements,
     else:
         smart_cd, smart_run, smart_put, smart_get = lcd, local, cp, cp
 
-    with settings(host_string=host):
+    with settings(host_string=host), lock_workspace(workspace, host):
         # Upload the package
-        build_tmp = scratchpads.make('build', host=host)
+        if workspace:
+            # Extract the package aside to apply its changes later
+            build_tmp = build_workspace.incoming_path(workspace)
+            smart_run(build_workspace.prepare_command(workspace))
+        else:
+            build_tmp = scratchpads.make('build', host=host)
         pkg_name = os.path.basename(pkg)
-        smart_put(pkg, os.path.join(build_tmp, pkg_name))
+        if stream and host:
+            # Extract the package while uploading it
+            pipe_to_host(pkg, host, extract_command(
+                '-', build_tmp, compression=Compression.for_path(pkg)
+            ))
+        elif stream:
+            local(extract_command(pkg, build_tmp))
+        else:
+            if host and use_resumable:
+                put_resumable(pkg, os.path.join(build_tmp, pkg_name))
+            else:
+                smart_put(pkg, os.path.join(build_tmp, pkg_name))
+            with smart_cd(build_tmp):
+                smart_run(extract_command(pkg_name, '.'))
+                if workspace:
+                    smart_run('rm -f %s' % pkg_name)
+
+        # Build in the source tree of the workspace with the changes
+        # applied, offline if the requirements are unchanged
+        offline = False
+        if workspace:
+            smart_run(build_workspace.apply_command(workspace))
+            build_tmp = build_workspace.source_path(workspace)
+            with quiet():
+                hashes = capture_output(
+                    host, build_workspace.requirements_hash_command(
+                        workspace, requirements
+                    )
+                ).splitlines() + ['']
+            requirements_hash = hashes[0].strip()
+            offline = requirements_hash == hashes[1].strip()
+
+        # Start with the wheels built by other build hosts
+        wheel_cache = os.path.expanduser(wheel_cache)
+        if shared_wheels:
+            sync_wheels(push_wheels, shared_wheels, host, wheel_cache,
+                        toolbin)
 
         # Build there
         with smart_cd(build_tmp):
-            smart_run('tar xzf %s' % pkg_name)
-            dist = os.path.join(output, pkg_name)
+            dist_name = strip_extension(pkg_name) + compression.extension
+            dist = os.path.join(output, dist_name)
 
+            # Platter only compresses by gzip itself, so let it make a
+            # plain tarball to be compressed by any other codec
+            platter_gzip = (compression.is_builtin and
+                            compression.codec.name == 'gzip')
             build_tool = os.path.join(toolbin, 'platter')
-            smart_run('%s build %s %s %s %s .' % (
+            build_command = '%s build %s %s %s %s %s %%s .' % (
                 build_tool,
                 '--requirements=%s' % requirements if requirements else '',
                 '--prebuild-script=%s' % pre_script if pre_script else '',
                 '--postbuild-script=%s' % post_script if post_script else '',
-                '--wheel-cache=%s' % os.path.expanduser(wheel_cache)
-            ))
+                '--wheel-cache=%s' % wheel_cache,
+                '' if platter_gzip else '--format=tar'
+            )
+            built = False
+            if offline:
+                print('Requirements unchanged, building from the wheel '
+                      'cache only')
+                with settings(warn_only=True):
+                    built = smart_run(build_command % '--no-download'
+                                      ).succeeded
+                if not built:
+                    print('Failed to build offline, retrying online')
+            if not built:
+                smart_run(build_command % '')
+            if compression.codec.program and not platter_gzip:
+                smart_run('tarball=$(ls dist/*.tar) && %s < $tarball > '
+                          '${tarball%%.tar}%s && rm $tarball' % (
+                              compression.compress_command,
+                              compression.extension
+                          ))
+
+            # Share the wheels built here with other build hosts
+            if shared_wheels:
+                sync_wheels(pull_wheels, shared_wheels, host, wheel_cache)
 
-            # Download the distribution
             local('mkdir -p %s' % output)
-            smart_get('dist/*%s' % EXT, dist)
+            if host and push:
+                # Keep the distribution to push it from there directly
+                remote_dist = os.path.join(PUSHED_DIST_DIR, dist_name)
+                run('mkdir -p %s' % PUSHED_DIST_DIR)
+                run('cp dist/*%s %s' % (compression.extension, remote_dist))
+            elif host and use_resumable:
+                # Download the distribution, resuming if interrupted
+                with quiet():
+                    built_dist = run('ls dist/*%s' % compression.extension)
+                get_resumable(host, os.path.join(build_tmp, built_dist),
+                              dist)
+            else:
+                # Download the distribution
+                smart_get('dist/*%s' % compression.extension, dist)
+
+        if workspace:
+            smart_run(build_workspace.save_requirements_hash_command(
+                workspace, requirements_hash
+            ))
+
+    if host and push:
+        source = host
+        if relay:
+            with settings(host_string=host):
+                relay_destination, relay_port = split_host_string(relay)
+                options, destination = scp_destination(relay, remote_dist,
+                                                       multiplex=False)
+                run('ssh %s %s mkdir -p %s' % (
+                    ssh.options(relay_port, multiplex=False),
+                    relay_destination, PUSHED_DIST_DIR
+                ))
+                run('scp -q %s %s %s' % (
+                    options, remote_dist, destination
+                ))
+                run('rm -f %s' % remote_dist)
+            source = relay
+        if local_copy is not False:
+            copy_to_local_async(
+                source, remote_dist, dist,
+                on_done=lambda: key and store.record(key, dist)
+            )
+        if use_layers:
+            print('Layers are skipped for pushed distributions')
+        dist = '%s:%s' % (source, remote_dist)
+        print(green('>>> Distribution %s created!' % dist))
+        return dist
+    if key:
+        store.record(key, dist)
+
+    # Split the distribution into layers if required
+    if use_layers:
+        manifest = layers.split(dist, compression)
+        print('Dependency layer %s created' % manifest['deps']['path'])
+        print('Application layer %s created' % manifest['app']['path'])
 
     print(green('>>> Distribution %s created!' % dist))
     return dist
 
 
-@task
-@pythonic_arguments
+def check_max_versions(max_versions):
+    """Check that `max_versions` is a positive integer."""
+    if not isinstance(max_versions, int) or max_versions <= 0:
+        raise RuntimeError('Argument `max_versions` is not a '
+                           'positive integer')
+
+
 @cleanup_scratchpads
-def install(dist, hosts, path, pre_command, post_command, max_versions):
+def install(dist, host_list, path, pre_command, post_command, max_versions,
+            parallel, wave, canary, max_failure_ratio, transfer, fanout,
+            batch, dedup, prune, two_phase):
     """Install the distribution."""
 
-    def work():
-        """The actual installation work."""
+    def stage_work():
+        """Stage the new version on the current host, while the current
+        version keeps serving.
+        """
         # Run the pre-install command if specified
         if pre_command:
-            run(pre_command)
+            with trace.span('pre_command', 'step'):
+                run(pre_command)
 
         # Upload the distribution
         install_tmp = scratchpads.make('install', host=env.host_string)
-        dist_name = os.path.basename(dist)
-        put(dist, os.path.join(install_tmp, dist_name))
+        with trace.span('upload', 'step', transfer=transfer or 'full'):
+            if manifest:
+                put_layers(manifest, install_tmp, path)
+            elif transfer == 'stream':
+                # Extract the distribution while uploading it, throwing
+                # away the toplevel folder
+                pipe_to_host(dist, env.host_string, extract_command(
+                    '-', install_tmp, strip_components=1,
+                    compression=dist_compression
+                ))
+            elif not (transfer == 'delta' and
+                      put_delta(dist, install_tmp, path, deltas)):
+                put_dist(dist, os.path.join(install_tmp, dist_name), staged,
+                         transfer == 'resumable')
+                with cd(install_tmp):
+                    # Extract the distribution, throwing away the toplevel
+                    # folder
+                    run(extract_command(dist_name, '.', strip_components=1))
 
         with cd(install_tmp):
-            # Extract the distribution, throwing away the toplevel folder
-            run('tar --strip-components=1 -xzf %s' % dist_name)
-
             # Install into a specific directory
-            install_path = os.path.join(path, dist_name.rstrip(EXT))
-            run('./install.sh %s' % install_path)
+            with trace.span('install', 'step'):
+                run('./install.sh %s' % install_path)
+                run(record_command)
+
+            # Link the unchanged files to the ones of the current version
+            if dedup:
+                with trace.span('dedup', 'step'):
+                    run(dedup_command(install_path, serve_path, dedup))
+
+        if transfer == 'delta' and not manifest:
+            keep_delta_basis(install_tmp, path, dist_name)
 
-            # Create or overwrite the symlink for the newly installed
-            # distribution to make it available
-            serve_path = os.path.join(path, 'current')
+    def activate_work():
+        """Activate the staged version on the current host."""
+        # Create or overwrite the symlink for the newly installed
+        # distribution to make it available
+        with trace.span('activate', 'step'):
             run('ln -sfn %s %s' % (install_path, serve_path))
 
         # Run the post-install command if specified
         if post_command:
-            run(post_command)
+            with trace.span('post_command', 'step'):
+                run(post_command)
 
-        # Limit the number of the versions if required
-        if isinstance(max_versions, int) and max_versions > 0:
-            version_names = get_obsolete_version_names(
-                path, max_versions,
-                ignore_pattern='current'
-            )
-            if version_names:
-                with cd(path):
-                    run('rm -rf %s' % ' '.join(version_names))
-        else:
-            raise RuntimeError('Argument `max_versions` is not a '
-                               'positive integer')
+        # Limit the number of the versions
+        with trace.span('prune', 'step'):
+            run(prune_command(path, max_versions, prune_in_background))
+            if manifest:
+                run(prune_command(os.path.join(path, layers.CACHE_DIR),
+                                  max_versions, prune_in_background))
+
+    def work():
+        """The actual installation work."""
+        stage_work()
+        activate_work()
+
+    def batch_work(stage=True, activate=True):
+        """The installation work (or either phase of it) run as a single
+        script.
+        """
+        steps = []
+        cleanup_paths = []
+        uploaded = None
+        if stage:
+            install_tmp = os.path.join('/tmp/cooly-install',
+                                       str(uuid.uuid4()))
+            if pre_command:
+                steps.append(('pre_command', pre_command))
+            steps.append(('scratchpad', 'mkdir -p %s' % install_tmp))
+            # Extract the distribution, throwing away the toplevel folder
+            if transfer == 'stream':
+                uploaded = '-'
+            else:
+                # Move the staged distribution into place, or upload it
+                # directly if the fan-out did not reach the host
+                uploaded = '%s-%s' % (install_tmp, dist_name)
+                put_dist(dist, uploaded, staged, transfer == 'resumable')
+            steps.append(('extract', extract_command(
+                uploaded, install_tmp, strip_components=1,
+                compression=dist_compression
+            )))
+            steps.append(('install', 'cd %s && ./install.sh %s && %s'
+                                     % (install_tmp, install_path,
+                                        record_command)))
+            if dedup:
+                steps.append(('dedup', dedup_command(install_path,
+                                                     serve_path, dedup)))
+            cleanup_paths.append(install_tmp)
+            if uploaded != '-':
+                cleanup_paths.append(uploaded)
+        if activate:
+            steps.append(('activate', 'ln -sfn %s %s' % (install_path,
+                                                          serve_path)))
+            if post_command:
+                steps.append(('post_command', post_command))
+            steps.append(('prune', prune_command(path, max_versions,
+                                                 prune_in_background)))
+        script = batch_script.render_install_script(
+            steps, cleanup_paths, 'extract' if uploaded == '-' else None
+        )
+
+        print('Running %s steps as a single script: %s' % (
+            len(steps), ', '.join(name for name, _ in steps)
+        ))
+        start_time = time.time()
+        with settings(hide('running', 'warnings'), warn_only=True):
+            if uploaded == '-':
+                output = pipe_to_host(dist, env.host_string,
+                                      'bash -c %s' % pipes.quote(script),
+                                      capture=True)
+                print(output)
+            else:
+                output = run(script)
+
+        results = batch_script.parse_steps(output)
+        # Trace the steps as if they started one after another
+        for step in results:
+            trace.record(step.name, start_time, step.milliseconds / 1000.0,
+                         'step', status=step.status)
+            start_time += step.milliseconds / 1000.0
+        for step in results:
+            print('%-12s  %-6s  %.3fs' % (
+                step.name, 'ok' if step.succeeded else 'failed',
+                step.milliseconds / 1000.0
+            ))
+        if output.failed:
+            failed = [step for step in results if not step.succeeded]
+            raise SystemExit('Error: Step `%s` failed with status %s' % (
+                failed[0].name, failed[0].status
+            ) if failed else 'Error: The installation script failed')
+        return results
+
+    def batch_stage_work():
+        """Stage the new version on the current host as a single script."""
+        return batch_work(activate=False)
+
+    def batch_activate_work():
+        """Activate the staged version on the current host as a single
+        script.
+        """
+        return batch_work(stage=False)
 
     print(yellow('>>> Install stage.'))
 
-    # Execute the work on multiple hosts (serially, by default)
-    host_list = hosts.split(';')
-    execute(work, hosts=host_list)
+    check_max_versions(max_versions)
+
+    dist_name = os.path.basename(dist)
+    install_path = os.path.join(path, strip_extension(dist_name))
+    serve_path = os.path.join(path, 'current')
+
+    # Record the new version in the manifest of `path`, along with the
+    # digest of the distribution if it is local
+    record_command = version_manifest.record_command(
+        path, strip_extension(dist_name),
+        None if split_remote_dist(dist)[0] else file_digest(dist)
+    )
+
+    # Remove the obsolete versions in the background unless specified
+    # otherwise
+    prune_in_background = prune != 'sync'
+
+    # Install from layers if the distribution has been split
+    manifest = layers.load_manifest(dist)
+    dist_compression = Compression.for_path(dist)
+
+    # Stage the distribution on all hosts by fan-out if required
+    staged = None
+    if split_remote_dist(dist)[0]:
+        # Push the remote distribution from its host to all hosts directly,
+        # unless a fan-out tree is specified
+        if transfer in ('delta', 'stream', 'resumable'):
+            print('%s transfer is skipped for remote distributions'
+                  % transfer.capitalize())
+            transfer = 'full'
+        if not isinstance(fanout, int) or fanout <= 0:
+            fanout = len(host_list)
+        staged = fanout_dist(dist, host_list, fanout)
+    elif isinstance(fanout, int) and fanout > 0:
+        if manifest:
+            print('Fan-out is skipped for layered distributions')
+        elif transfer in ('delta', 'stream'):
+            print('Fan-out is skipped for %s transfers' % transfer)
+        else:
+            staged = fanout_dist(dist, host_list, fanout,
+                                 transfer == 'resumable')
+
+    if batch:
+        if manifest:
+            print('Batch mode is skipped for layered distributions')
+        elif transfer == 'delta':
+            print('Batch mode is skipped for delta transfers')
+        else:
+            work = batch_work
+            stage_work, activate_work = batch_stage_work, batch_activate_work
+
+    def remove_staged():
+        """Remove the staged distribution left on the current host."""
+        run('rm -f %s' % staged[env.host_string])
+
+    # The deltas shared by the hosts with the same previous distribution
+    deltas = DeltaCache(os.path.join(DELTA_CACHE_DIR, str(uuid.uuid4())))
+
+    try:
+        if two_phase:
+            install_in_two_phases(stage_work, activate_work, host_list,
+                                  parallel, wave, canary, max_failure_ratio)
+        else:
+            # Execute the work on multiple hosts (serially, by default)
+            execute_in_waves(work, host_list, parallel, wave, canary,
+                             max_failure_ratio)
+    except (Exception, SystemExit):
+        if staged:
+            staged_hosts = [host for host in host_list if host in staged]
+            execute_in_waves(remove_staged, staged_hosts, len(staged_hosts),
+                             max_failure_ratio=1)
+        raise
+    finally:
+        deltas.clear()
 
     print(green('>>> Distribution %s installed!' % dist))
 
 
-@task
-def deploy(archive_repo, archive_tree_ish, archive_name_format, archive_output,
-           build_host, build_toolbin, build_output, build_requirements,
-           build_pre_script, build_post_script, build_wheel_cache,
-           install_hosts, install_path, install_pre_command,
-           install_post_command, install_max_versions):
-    """Deploy the package."""
-    pkg = archive(archive_repo, archive_tree_ish, archive_name_format,
-                  archive_output)
-    dist = build(pkg, build_host, build_toolbin, build_output,
-                 build_requirements, build_pre_script, build_post_script,
-                 build_wheel_cache)
-    install(dist, install_hosts, install_path, install_pre_command,
-            install_post_command, install_max_versions)
-
-
-@task
-@pythonic_arguments
-def list(hosts, path):
-    """List all available versions."""
+def install_in_two_phases(stage_work, activate_work, host_list, parallel,
+                          wave, canary, max_failure_ratio):
+    """Install by staging the new version on all hosts first, and then
+    activating it on the staged hosts, so that different versions only
+    serve at the same time during the activation.
 
-    def list_versions(remote=True):
-        """List the names and aliases of the versions in `path`."""
-        mapping = get_versions_alias_mapping(path, remote)
-        versions = [
-            '%-8s    %s' % (alias, name)
-            for alias, name in mapping.items()
-        ]
+    The staging runs on up to `parallel` hosts (all hosts, by default)
+    at the same time, while the activation runs on all hosts of each
+    wave at once.
+    """
+    print(yellow('>>> Staging on %s hosts' % len(host_list)))
+    results = execute_in_waves(stage_work, host_list,
+                               parallel or len(host_list),
+                               max_failure_ratio=max_failure_ratio)
+    # Skip the hosts which failed to stage, if tolerated
+    staged_hosts = [host for host in host_list
+                    if not isinstance(results[host], HostFailure)]
+    if not staged_hosts:
+        return
+
+    print(yellow('>>> Activating on %s hosts' % len(staged_hosts)))
+    start_time = time.time()
+    execute_in_waves(activate_work, staged_hosts, len(staged_hosts), wave,
+                     canary, max_failure_ratio)
+    print('Activated in %.3fs' % (time.time() - start_time))
+
+
+def remove_pushed_dist(dist):
+    """Remove `dist` from its host if it is a pushed distribution."""
+    source_host, source_path = split_remote_dist(dist)
+    if source_host:
+        with settings(host_string=source_host):
+            run('rm -f %s' % source_path)
+
+
+def list(host_list, path, parallel, cached=False):
+    """List all available versions."""
 
-        print('')
-        print('\n'.join(versions))
+    def read_manifest():
+        """Read the manifest of `path` on the current host."""
+        with quiet():
+            output = run(version_manifest.read_command(path))
+        if output.failed:
+            raise SystemExit('Error: Failed to read the versions')
+        return str(output)
 
-    if not hosts:
+    if not host_list:
         # List versions locally
-        list_versions(remote=False)
+        print_versions(read_versions(path, remote=False)[1])
+        return
+
+    cache = version_manifest.ManifestCache()
+    outputs = OrderedDict()
+    stale = []
+    if not cached:
+        # Read the manifests on multiple hosts (all at once, by default)
+        results = execute_in_waves(read_manifest, host_list,
+                                   parallel or len(host_list),
+                                   max_failure_ratio=1)
+        for host, output in results.items():
+            if isinstance(output, HostFailure):
+                continue
+            cache.save(host, path, output)
+            outputs[host] = output
+    # Fall back to the cached manifests of the hosts failed to read
+    for host in host_list:
+        if host not in outputs:
+            output = cache.load(host, path)
+            if output is None:
+                print(red('>>> No versions of %s are known' % host))
+                continue
+            outputs[host] = output
+            stale.append(host)
+
+    if len(host_list) == 1 and outputs:
+        print_versions(version_manifest.parse(outputs[host_list[0]])[1])
+    else:
+        print_fleet_versions(outputs, len(host_list))
+    if stale and not cached:
+        print(yellow('>>> The versions of %s hosts are cached: %s' % (
+            len(stale), ', '.join(stale)
+        )))
+
+
+def format_time(timestamp):
+    """Format the UNIX `timestamp`, which is unknown if None."""
+    if timestamp is None:
+        return '-'
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        '%Y-%m-%d %H:%M:%S'
+    )
+
+
+def print_versions(versions):
+    """Print the aliases, install times and names of `versions`."""
+    mapping = version_manifest.alias_mapping(versions, LATEST_FLAG)
+    installed_at = dict((version.name, format_time(version.installed_at))
+                        for version in versions)
+    print('')
+    for alias, name in mapping.items():
+        print('%-8s    %-19s    %s' % (alias, installed_at[name], name))
+
+
+def print_fleet_versions(outputs, total):
+    """Print each version on the hosts, as well as the number of the hosts
+    it is installed on and serves on, given the mapping from each host to
+    its output of the manifest.
+    """
+    installed_at = OrderedDict()
+    hosts = {}
+    serving = {}
+    for output in outputs.values():
+        current, versions = version_manifest.parse(output)
+        for version in versions:
+            # The time it was first installed on any host
+            times = [t for t in (installed_at.get(version.name),
+                                 version.installed_at) if t is not None]
+            installed_at[version.name] = min(times) if times else None
+            hosts[version.name] = hosts.get(version.name, 0) + 1
+        if current:
+            serving[current] = serving.get(current, 0) + 1
+
+    # The latest installed first, and the unrecorded ones last
+    names = sorted(installed_at, key=lambda name: -(installed_at[name] or 0))
+    row = '%%-%ss    %%-19s    %%-9s    %%s' % max([7] + [len(name)
+                                                     for name in names])
+    print('')
+    print(row % ('VERSION', 'INSTALLED', 'HOSTS', 'CURRENT'))
+    for name in names:
+        print(row % (name, format_time(installed_at[name]),
+                     '%s/%s' % (hosts[name], total), serving.get(name, 0)))
+
+
+def prune(host_list, path, max_versions, parallel):
+    """Prune the obsolete versions."""
+
+    def prune_versions(remote=True):
+        """Remove all but the latest `max_versions` versions and layers in
+        `path`, and the current one, right away.
+        """
+        smart_run = run if remote else local
+        for versions_path in (path, os.path.join(path, layers.CACHE_DIR)):
+            smart_run(prune_command(versions_path, max_versions,
+                                    background=False))
+
+    check_max_versions(max_versions)
+
+    if not host_list:
+        # Prune locally
+        prune_versions(remote=False)
     else:
-        # List versions on multiple hosts (serially, by default)
-        host_list = hosts.split(';')
-        execute(list_versions, hosts=host_list)
+        # Prune on multiple hosts (serially, by default)
+        execute_in_waves(prune_versions, host_list, parallel)
 
 
-@task
-@pythonic_arguments
-def rollback(hosts, path, post_command, version):
+def rollback(host_list, path, post_command, version, parallel):
     """Rollback current version to the specified one."""
 
     def rollback_version(remote=True):
@@ -365,10 +1513,9 @@ def rollback(hosts, path, post_command, version):
         if post_command:
             run(post_command)
 
-    if not hosts:
+    if not host_list:
         # Rollback locally
         rollback_version(remote=False)
     else:
         # Rollback on multiple hosts (serially, by default)
-        host_list = hosts.split(';')
-        execute(rollback_version, hosts=host_list)
+        execute_in_waves(rollback_version, host_list, parallel)
@@ -0,0 +1,157 @@
+"""Split a platter distribution into two layers.
+
+The dependency layer holds the wheels of all dependencies and is keyed
+by a hash of their contents, which only changes when the resolved
+requirements change. The application layer holds everything else, and
+is what actually changes between most deploys.
+"""
+
+import os
+import re
+import json
+import uuid
+import hashlib
+
+from cooly.compression import Compression, strip_extension, open_tar, \
+    create_tar
+
+
+# The directory under the installation path to cache dependency layers
+CACHE_DIR = '.cooly-layers'
+
+
+def manifest_path(dist):
+    """Get the path to the layers manifest of `dist`."""
+    return dist + '.layers'
+
+
+def load_manifest(dist):
+    """Load the layers manifest of `dist`, with the layer paths resolved
+    relative to the directory of `dist`, or return None if `dist` has not
+    been split.
+    """
+    try:
+        with open(manifest_path(dist)) as f:
+            manifest = json.load(f)
+    except IOError:
+        return None
+
+    dist_dir = os.path.dirname(dist)
+    for layer in manifest.values():
+        layer['path'] = os.path.join(dist_dir, layer['name'])
+    return manifest
+
+
+def wheel_name(filename):
+    """Get the normalized distribution name of the wheel `filename`."""
+    return filename.split('-', 1)[0].lower()
+
+
+def normalize_name(name):
+    """Normalize the distribution `name` in the way wheel filenames do."""
+    return re.sub(r'[^\w\d.]+', '_', name).lower()
+
+
+def is_dependency(member, package_name):
+    """Whether the tar `member` belongs to the dependency layer."""
+    filename = os.path.basename(member.name)
+    return (member.isfile() and filename.endswith('.whl') and
+            wheel_name(filename) != package_name)
+
+
+def strip_toplevel(name):
+    """Throw away the toplevel folder of the member `name`."""
+    return name.split('/', 1)[1]
+
+
+def member_digest(tar, member):
+    """Get the SHA1 hex digest of the content of the tar `member`."""
+    sha1 = hashlib.sha1()
+    fileobj = tar.extractfile(member)
+    for chunk in iter(lambda: fileobj.read(65536), b''):
+        sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def split(dist, compression=None):
+    """Split the distribution `dist` into a dependency layer and an
+    application layer next to it, and return the layers manifest.
+
+    The layers are compressed by `compression`, which defaults to the
+    compression of `dist`.
+    """
+    dist_dir = os.path.dirname(dist)
+    compression = compression or Compression.for_path(dist)
+    with open_tar(dist) as tar:
+        members = tar.getmembers()
+        package = [m for m in members if m.name.endswith('/PACKAGE')]
+        if not package:
+            raise RuntimeError('No `PACKAGE` found in the distribution %r'
+                               % dist)
+        package_name = normalize_name(
+            tar.extractfile(package[0]).read().decode('utf-8').strip()
+        )
+        deps = [m for m in members if is_dependency(m, package_name)]
+
+        # Compute the hash of the dependency layer from its content
+        # Note: members are read in the archive order to avoid seeking
+        # backwards in the compressed stream.
+        digests = sorted(
+            (strip_toplevel(m.name), member_digest(tar, m)) for m in deps
+        )
+        deps_hash = hashlib.sha1(
+            json.dumps(digests).encode('utf-8')
+        ).hexdigest()
+
+        deps_name = 'deps-%s%s' % (deps_hash, compression.extension)
+        app_name = '%s.app%s' % (strip_extension(os.path.basename(dist)),
+                                 compression.extension)
+        deps_layer = os.path.join(dist_dir, deps_name)
+        # The dependency layer may be shared with other distributions
+        if os.path.isfile(deps_layer):
+            deps_tar = deps_tmp = None
+        else:
+            deps_tmp = '%s.%s' % (deps_layer, uuid.uuid4())
+            deps_tar = create_tar(deps_tmp, compression)
+        app_layer = os.path.join(dist_dir, app_name)
+        app_tar = create_tar(app_layer, compression)
+        try:
+            for member in members:
+                if member in deps:
+                    if deps_tar is not None:
+                        fileobj = tar.extractfile(member)
+                        # Paths in the dependency layer are relative to
+                        # the root directory of the distribution
+                        member.name = strip_toplevel(member.name)
+                        deps_tar.addfile(member, fileobj)
+                elif member.isfile():
+                    app_tar.addfile(member, tar.extractfile(member))
+                else:
+                    app_tar.addfile(member)
+            app_tar.close()
+            if deps_tar is not None:
+                deps_tar.close()
+        except BaseException:
+            # Never leave an incomplete layer to be reused
+            for layer_tar, path in ((app_tar, app_layer),
+                                    (deps_tar, deps_tmp)):
+                if layer_tar is None:
+                    continue
+                try:
+                    layer_tar.close()
+                except Exception:
+                    pass
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+        # The dependency layer only gets its name once it is complete
+        if deps_tar is not None:
+            os.rename(deps_tmp, deps_layer)
+
+    manifest = {
+        'deps': {'name': deps_name, 'hash': deps_hash},
+        'app': {'name': app_name},
+    }
+    with open(manifest_path(dist), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return load_manifest(dist)
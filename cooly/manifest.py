@@ -0,0 +1,179 @@
+"""The manifest of the versions installed in a directory.
+
+Each installation records the version in the manifest file of the
+installation directory, as a line of the tab-separated name, digest of
+the distribution, install time (in seconds since the epoch) and size (in
+kilobytes), in the order of the installations. The manifest is rewritten
+atomically (by renaming a temporary file over it) whenever it changes.
+
+Listing, rolling back and pruning read the order of the versions from
+the manifest instead of listing the directory and relying on the
+modification times of the versions. When the manifest is created, the
+versions installed before are recorded first, in the order of their
+modification times and with the unknown fields as `-`.
+
+The manifests of the hosts are also cached locally, so that the versions
+on all hosts can be listed from the cache.
+"""
+
+import os
+import json
+import pipes
+import hashlib
+from collections import OrderedDict, namedtuple
+
+
+MANIFEST_FILE = '.cooly-versions'
+
+DEFAULT_CACHE_DIR = '~/.cache/cooly/manifests'
+
+# The separator between the current version and the versions in the
+# output of `read_command`
+CURRENT_MARK = 'COOLY-CURRENT'
+
+RECORD_SCRIPT = '''\
+cd %(path)s || exit 1
+size=$(du -sk %(name)s | cut -f 1)
+if [ ! -f %(manifest)s ]; then
+    ls -1tr -I current | awk '{ print $0 "\\t-\\t-\\t-" }' > %(manifest)s
+fi
+{ awk -F '\\t' -v name=%(name)s '$1 != name' %(manifest)s
+  printf '%%s\\t%%s\\t%%s\\t%%s\\n' %(name)s %(digest)s "$(date +%%s)" "$size"
+} > %(manifest)s.$$ && mv -f %(manifest)s.$$ %(manifest)s
+'''
+
+# List the names of the versions in the current directory, latest first,
+# from the manifest if any
+NAMES_SCRIPT = '''\
+if [ -f %(manifest)s ]; then
+    cut -f 1 %(manifest)s | tac | while read -r name; do
+        [ -e "$name" ] && echo "$name"
+    done
+else
+    ls -1t -I current
+fi'''
+
+# Rewrite the manifest in the current directory without the versions
+# which have been removed
+CLEAN_SCRIPT = '''\
+[ -f %(manifest)s ] &&
+while IFS= read -r line; do
+    [ -e "${line%%%%\t*}" ] && printf '%%s\\n' "$line"
+done < %(manifest)s > %(manifest)s.$$ && mv -f %(manifest)s.$$ %(manifest)s'''
+
+READ_SCRIPT = '''\
+cd %(path)s 2>/dev/null || exit 0
+echo "%(mark)s $(readlink current)"
+cat %(manifest)s 2>/dev/null || ls -1tr -I current
+'''
+
+
+class Version(namedtuple('Version', 'name digest installed_at size')):
+    """A version in the manifest, whose fields except `name` are None
+    if it is not recorded.
+    """
+
+
+def record_command(path, name, digest=None):
+    """Get the command to record the version `name` in `path`, which is
+    installed from the distribution of `digest`, as the latest one.
+    """
+    return 'bash -c %s' % pipes.quote(RECORD_SCRIPT % {
+        'path': pipes.quote(path),
+        'name': pipes.quote(name),
+        'digest': pipes.quote(digest or '-'),
+        'manifest': MANIFEST_FILE,
+    })
+
+
+def names_script():
+    """Get the script to list the names of the versions in the current
+    directory, latest first.
+    """
+    return NAMES_SCRIPT % {'manifest': MANIFEST_FILE}
+
+
+def clean_script():
+    """Get the script to remove the versions which no longer exist in the
+    current directory from the manifest.
+    """
+    return CLEAN_SCRIPT % {'manifest': MANIFEST_FILE}
+
+
+def read_command(path):
+    """Get the command to print the current version, the manifest and the
+    names of all versions in `path`, to be parsed by `parse`.
+    """
+    return 'bash -c %s' % pipes.quote(READ_SCRIPT % {
+        'path': pipes.quote(path),
+        'mark': CURRENT_MARK,
+        'manifest': MANIFEST_FILE,
+    })
+
+
+def parse(output):
+    """Parse the `output` of `read_command` into the name of the current
+    version (or None) and the versions, latest first.
+    """
+    current = None
+    versions = OrderedDict()
+    for line in output.splitlines():
+        line = line.rstrip('\r')
+        if line.startswith(CURRENT_MARK):
+            current = os.path.basename(line[len(CURRENT_MARK):].strip())
+            current = current or None
+        elif line.strip():
+            # Only the names are listed without the manifest
+            fields = (line.split('\t') + ['-'] * 3)[:4]
+            name, digest, installed_at, size = [
+                None if field == '-' else field for field in fields
+            ]
+            versions.pop(name, None)
+            versions[name] = Version(
+                name, digest,
+                int(installed_at) if installed_at else None,
+                int(size) if size else None,
+            )
+    return current, list(versions.values())[::-1]
+
+
+def alias_mapping(versions, latest_flag):
+    """Get the ordered mapping from the alias to the name of `versions`,
+    latest first.
+    """
+    mapping = OrderedDict()
+    for i, version in enumerate(versions):
+        alias = '%s~%s' % (latest_flag, i) if i else latest_flag
+        mapping[alias] = version.name
+    return mapping
+
+
+class ManifestCache(object):
+    """The manifests of the hosts cached in local `cache_dir`."""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR)
+
+    def entry_path(self, host, path):
+        key = '%s:%s' % (host, path)
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def save(self, host, path, output):
+        """Cache the `output` of `read_command` on `host`."""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entry = self.entry_path(host, path)
+        with open(entry + '.tmp', 'w') as f:
+            json.dump({'host': host, 'path': path, 'output': output}, f)
+        os.rename(entry + '.tmp', entry)
+
+    def load(self, host, path):
+        """Load the cached output of `read_command` on `host`, or None if
+        it is not cached.
+        """
+        try:
+            with open(self.entry_path(host, path)) as f:
+                return json.load(f)['output']
+        except (IOError, ValueError, KeyError):
+            return None
@@ -0,0 +1,162 @@
+"""Get the name and the version of a package.
+
+The metadata is read statically from `PKG-INFO`, `pyproject.toml` or
+`setup.cfg` if any of them has both, without running any code of the
+package. Otherwise, `python setup.py --name --version` is run, and its
+result is cached by the content of the metadata files along with the
+tree being archived (since `setup.py` may read any file of the tree), so
+that archiving the same package again skips it.
+"""
+
+import os
+import re
+import email.parser
+import hashlib
+
+try:
+    from configparser import RawConfigParser
+except ImportError:
+    from ConfigParser import RawConfigParser
+
+from fabric.api import local
+
+from cooly import trace
+
+
+# Trace the local operations
+local = trace.operation(local)
+
+
+# The files the metadata is read from, in order
+METADATA_FILES = ('PKG-INFO', 'pyproject.toml', 'setup.cfg', 'setup.py')
+
+DEFAULT_CACHE_DIR = '~/.cache/cooly/metadata'
+
+TOML_TABLE = re.compile(r'^\s*\[([^\[\]]+)\]\s*(#.*)?$')
+TOML_STRING = re.compile(
+    r'''^\s*(name|version)\s*=\s*(?:"([^"]*)"|'([^']*)')\s*(#.*)?$'''
+)
+
+
+def read_pkg_info(path):
+    """Read the metadata from the `PKG-INFO` file `path`."""
+    with open(path) as f:
+        message = email.parser.Parser().parse(f, headersonly=True)
+    return message.get('Name'), message.get('Version')
+
+
+def read_pyproject(path):
+    """Read the static metadata from the `[project]` table of the
+    `pyproject.toml` file `path`.
+
+    Only basic strings are supported, which is what the metadata is
+    written as in practice.
+    """
+    values = {}
+    table = None
+    with open(path) as f:
+        for line in f:
+            match = TOML_TABLE.match(line)
+            if match:
+                table = match.group(1).strip()
+                continue
+            match = TOML_STRING.match(line)
+            if table == 'project' and match:
+                values[match.group(1)] = match.group(2) or match.group(3)
+    return values.get('name'), values.get('version')
+
+
+def read_setup_cfg(path):
+    """Read the static metadata from the `[metadata]` section of the
+    `setup.cfg` file `path`.
+
+    A version of `file:` is read from the file, while the one of `attr:`
+    is not static.
+    """
+    parser = RawConfigParser()
+    parser.read(path)
+    if not parser.has_section('metadata'):
+        return None, None
+
+    def get(option):
+        if parser.has_option('metadata', option):
+            return parser.get('metadata', option).strip()
+
+    name, version = get('name'), get('version')
+    if version and version.startswith('file:'):
+        version_path = os.path.join(os.path.dirname(path),
+                                    version[len('file:'):].strip())
+        try:
+            with open(version_path) as f:
+                version = f.read().strip()
+        except IOError:
+            version = None
+    elif version and version.startswith('attr:'):
+        version = None
+    return name, version
+
+
+STATIC_READERS = (
+    ('PKG-INFO', read_pkg_info),
+    ('pyproject.toml', read_pyproject),
+    ('setup.cfg', read_setup_cfg),
+)
+
+
+def read_static_metadata(source_path):
+    """Read the name and the version of the package in `source_path`
+    statically, or return None if they are not both static.
+    """
+    for filename, reader in STATIC_READERS:
+        path = os.path.join(source_path, filename)
+        if os.path.isfile(path):
+            name, version = reader(path)
+            if name and version:
+                return name, version
+    return None
+
+
+def make_cache_key(source_path, tree):
+    sha1 = hashlib.sha1()
+    sha1.update(('%s\0' % tree).encode('utf-8'))
+    for filename in METADATA_FILES:
+        path = os.path.join(source_path, filename)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                sha1.update(filename.encode('utf-8') + b'\0' + f.read())
+    return sha1.hexdigest()
+
+
+def get_metadata(source_path, tree, cache_dir=None):
+    """Get the name and the version of the package in `source_path`,
+    whose sources are archived from `tree`.
+    """
+    metadata = read_static_metadata(source_path)
+    if metadata:
+        print('Read the metadata of %s %s statically' % metadata)
+        return metadata
+
+    setup_py = os.path.join(source_path, 'setup.py')
+    if not os.path.isfile(setup_py):
+        raise RuntimeError('No `setup.py` found in the package %r, nor '
+                           'static metadata' % source_path)
+
+    cache_dir = os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR)
+    entry = os.path.join(cache_dir, make_cache_key(source_path, tree))
+    try:
+        with open(entry) as f:
+            name, version = f.read().splitlines()
+        print('Using cached metadata of %s %s' % (name, version))
+        return name, version
+    except (IOError, ValueError):
+        pass
+
+    name, version = local('python %s --name --version' % setup_py,
+                          capture=True).splitlines()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write to a temporary file first to update the entry atomically
+    with open(entry + '.tmp', 'w') as f:
+        f.write('%s\n%s\n' % (name, version))
+    os.rename(entry + '.tmp', entry)
+    return name, version
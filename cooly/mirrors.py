@@ -0,0 +1,112 @@
+"""A local cache of bare mirrors of remote repositories.
+
+Each remote repository is mirrored once into the cache directory (by
+`git clone --mirror`), and then only fetched incrementally, so that the
+packages are archived from the mirror directly instead of a full clone.
+The mirrors can be shallow (`depth`) or partial (`filter`, e.g.
+`blob:none`, whose missing blobs are fetched by `git archive` on demand).
+
+The least recently used mirrors are evicted once the total size of the
+cache exceeds `max_size` megabytes.
+"""
+
+import os
+import uuid
+import shutil
+import hashlib
+
+from fabric.api import local, lcd
+from fabric.colors import green
+
+from cooly import trace
+
+
+# Trace the local operations
+local = trace.operation(local)
+
+
+DEFAULT_CACHE_DIR = '~/.cache/cooly/mirrors'
+
+
+def directory_size(path):
+    """Get the total size in bytes of the files in local `path`."""
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.islink(filepath):
+                size += os.path.getsize(filepath)
+    return size
+
+
+class MirrorCache(object):
+    """The mirrors of remote repositories in local `cache_dir`."""
+
+    def __init__(self, cache_dir=None, depth=None, filter=None,
+                 max_size=None):
+        self.cache_dir = os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR)
+        self.depth = depth
+        self.filter = filter
+        self.max_size = max_size
+
+    def mirror_path(self, repo):
+        """Get the path to the mirror of `repo`."""
+        name = hashlib.sha1(repo.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '%s.git' % name)
+
+    def git(self, command, *args):
+        """Get the git `command` with the options of the mirror."""
+        options = [command]
+        if self.depth:
+            options.append('--depth %s' % self.depth)
+        if self.filter:
+            options.append('--filter=%s' % self.filter)
+        return 'git %s' % ' '.join(options + [arg for arg in args])
+
+    def update(self, repo):
+        """Create or fetch the mirror of `repo`, and return the path to
+        it.
+        """
+        path = self.mirror_path(repo)
+        if os.path.isdir(path):
+            with lcd(path):
+                local(self.git('fetch', '--prune', 'origin'))
+        else:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Clone aside first to make the mirror appear atomically
+            temp = os.path.join(self.cache_dir, '.%s' % uuid.uuid4())
+            try:
+                local(self.git('clone', '--mirror', repo, temp))
+                os.rename(temp, path)
+            finally:
+                if os.path.isdir(temp):
+                    shutil.rmtree(temp)
+            print(green('Mirror of %s created in %s' % (repo, path)))
+
+        # Mark the mirror as recently used
+        os.utime(path, None)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used mirrors (except `keep`) until
+        the total size of the cache is within `max_size` megabytes.
+        """
+        if not self.max_size:
+            return
+        mirrors = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir) if name.endswith('.git')
+        ]
+        mirrors.sort(key=os.path.getmtime)
+        sizes = dict((path, directory_size(path)) for path in mirrors)
+        total = sum(sizes.values())
+        for path in mirrors:
+            if total <= self.max_size * 1024 * 1024:
+                break
+            if path == keep:
+                continue
+            print('Evicting mirror %s (%s bytes)' % (path, sizes[path]))
+            shutil.rmtree(path)
+            total -= sizes[path]
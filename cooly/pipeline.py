@@ -0,0 +1,323 @@
+"""Deploy multiple projects at once by pipelining their stages.
+
+The stages of each project still run in order, but the stages of
+different projects overlap: a project is archived while another one is
+built, builds run on different build hosts at the same time, and so on.
+
+The build hosts of a project can be a pool, each of which is tagged
+with the platform it builds for (e.g. `user@host=el7-py27`), as well as
+the install hosts. The project is then built once for each platform of
+its install hosts, on the least loaded build host of the platform, and
+each group of install hosts gets the distribution of its platform.
+
+Since Fabric is not thread-safe, each stage runs in a worker process,
+which is not daemonic so that the stage can fork in turn (e.g. to
+install on hosts in parallel). The workers are kept until all projects
+are deployed, and then stopped explicitly. A stage is preferably given
+to the worker which ran a stage on the same hosts before, to reuse its
+connections. The number of stages running at the same time on each
+build host and each install host is limited.
+"""
+
+import os
+import traceback
+import multiprocessing
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from fabric.colors import green, yellow, red
+from fabric.network import disconnect_all
+
+from cooly import fabfile
+from cooly import workspace as build_workspace
+
+
+STAGES = ('archive', 'build', 'install')
+
+# Archives are made one at a time, since they all run locally
+MAX_ARCHIVES = 1
+
+
+class Project(object):
+    """A project to deploy according to `config`, which is a mapping with
+    the same structure as the configuration file.
+
+    The project is built for the platform of each group of its install
+    hosts, on the build hosts of the same platform, and each group is
+    installed with the distribution built for its platform.
+    """
+
+    def __init__(self, name, config):
+        from cooly.api import split_platforms
+
+        self.name = name
+        self.archive_args, self.build_args, self.install_args = (
+            dict(config.get(part) or {}) for part in STAGES
+        )
+        # Keep the workspaces of different projects apart
+        if self.build_args.get('workspace') and self.archive_args.get('repo'):
+            self.build_args['workspace'] = build_workspace.project_path(
+                self.build_args['workspace'], self.archive_args['repo']
+            )
+        # The pool of build hosts, or the only one (maybe local)
+        pool = self.build_args.pop('hosts', None)
+        host = self.build_args.pop('host', None)
+        self.build_hosts = split_platforms(pool or [host])
+        self.install_groups = split_platforms(
+            self.install_args.pop('hosts', None)
+        )
+        fabfile.check_max_versions(self.install_args.get('max_versions'))
+
+        missing = set(self.install_groups) - set(self.build_hosts)
+        if missing:
+            raise RuntimeError('No build hosts for the platforms of the '
+                               'install hosts in %s: %s' % (
+                                   name, ', '.join(map(str, missing))))
+
+        # The tasks ready to run, each of which is a stage and a platform
+        self.ready = [('archive', None)]
+        self.running = []
+        self.pkg = None
+        self.dists = {}
+        self.errors = []
+
+    @property
+    def done(self):
+        return not self.ready and not self.running
+
+    def resources(self, task, usage, limits):
+        """Get the resources which `task` holds while running, or None if
+        they are not available.
+        """
+        stage, platform = task
+        if stage == 'archive':
+            resources = [('archive', None)]
+        elif stage == 'build':
+            # Build on the least loaded host of the platform
+            hosts = [host for host in self.build_hosts[platform]
+                     if usage.get(('build', host), 0) < limits['build']]
+            if not hosts:
+                return None
+            host = min(hosts, key=lambda h: usage.get(('build', h), 0))
+            return [('build', host)]
+        else:
+            resources = [('install', host) for host in
+                         sorted(set(self.install_groups[platform]))]
+        if any(usage.get(r, 0) >= limits[r[0]] for r in resources):
+            return None
+        return resources
+
+    def start(self, task, resources):
+        """Start `task` holding `resources`, and return its stage and
+        arguments.
+        """
+        self.ready.remove(task)
+        self.running.append(task)
+        stage, platform = task
+        if stage == 'archive':
+            return stage, (), self.archive_args
+        elif stage == 'build':
+            kwargs = dict(self.build_args, host=resources[0][1],
+                          platform=platform)
+            # Keep the distributions of different platforms apart
+            if platform and kwargs.get('output'):
+                kwargs['output'] = os.path.join(kwargs['output'], platform)
+            return stage, (self.pkg,), kwargs
+        else:
+            kwargs = dict(self.install_args,
+                          hosts=self.install_groups[platform])
+            return stage, (self.dists[platform],), kwargs
+
+    def finish(self, task, result):
+        """Finish `task` with `result`, and make the following tasks
+        ready.
+        """
+        self.running.remove(task)
+        stage, platform = task
+        if stage == 'archive':
+            self.pkg = result
+            self.ready.extend(('build', p) for p in self.install_groups)
+        elif stage == 'build':
+            self.dists[platform] = result
+            self.ready.append(('install', platform))
+
+    def fail(self, task, error):
+        """Fail `task` with `error`, which skips the tasks following it."""
+        self.running.remove(task)
+        self.errors.append((task, error))
+
+
+def describe(task):
+    stage, platform = task
+    if platform:
+        return '%s stage for %s' % (stage, platform)
+    return '%s stage' % stage
+
+
+def run_stage(stage, args, kwargs):
+    """Run `stage` in the current worker."""
+    from cooly import api
+    if stage == 'archive':
+        return api.archive(*args, **kwargs)
+    elif stage == 'build':
+        dist = api.build(*args, **kwargs)
+        # The distribution may be removed by another worker once it is
+        # installed, so finish the local copy first
+        fabfile.wait_for_local_copies()
+        return dist
+    else:
+        try:
+            api.install(*args, **kwargs)
+        finally:
+            fabfile.remove_pushed_dist(args[0])
+
+
+def work(worker_id, tasks, results):
+    """The main loop of a worker, which runs the stages from `tasks` and
+    puts the results into `results`, until it gets None.
+    """
+    try:
+        for stage, args, kwargs in iter(tasks.get, None):
+            try:
+                result = run_stage(stage, args, kwargs)
+            except (Exception, SystemExit) as e:
+                # `SystemExit` is raised by Fabric whenever a command fails
+                results.put((worker_id, False,
+                             str(e) or traceback.format_exc()))
+            else:
+                results.put((worker_id, True, result))
+    finally:
+        fabfile.wait_for_local_copies()
+        disconnect_all()
+
+
+class Worker(object):
+
+    def __init__(self, worker_id, results):
+        self.id = worker_id
+        self.tasks = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=work, args=(worker_id, self.tasks, results)
+        )
+        self.process.start()
+        # The resources of the latest stage, whose connections are kept
+        self.resources = None
+
+    def stop(self, wait=True):
+        """Stop the worker after its current stage if `wait` is true, or
+        right away otherwise.
+        """
+        try:
+            if wait:
+                self.tasks.put(None)
+                self.process.join()
+        finally:
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+
+
+def deploy_projects(projects, max_builds_per_host=None,
+                    max_installs_per_host=None):
+    """Deploy `projects`, which is a sequence of the names of the projects
+    and their configurations, by pipelining their stages.
+
+    At most `max_builds_per_host` builds run on each build host (or
+    locally) at the same time, and at most `max_installs_per_host`
+    installations on each install host, both of which default to 1.
+    A project which fails does not stop the others, and the deployment
+    exits with an error once all of them are finished.
+    """
+    limits = {
+        'archive': MAX_ARCHIVES,
+        'build': max_builds_per_host or 1,
+        'install': max_installs_per_host or 1,
+    }
+    projects = [Project(name, config) for name, config in projects]
+    results = multiprocessing.Queue()
+    workers = []
+    idle = []
+    # The running projects and tasks, by the workers running them
+    running = {}
+    # The number of running stages holding each resource
+    usage = {}
+
+    def pick_worker(resources):
+        """Pick an idle worker which used the same resources if any, or
+        start a new one.
+        """
+        for worker in idle:
+            if worker.resources == resources:
+                idle.remove(worker)
+                return worker
+        worker = Worker(len(workers), results)
+        workers.append(worker)
+        return worker
+
+    def dispatch():
+        """Start every ready task whose resources are available, the
+        later stages first to finish projects earlier.
+        """
+        ready = [(project, task) for project in projects
+                 for task in project.ready]
+        ready.sort(key=lambda item: -STAGES.index(item[1][0]))
+        for project, task in ready:
+            resources = project.resources(task, usage, limits)
+            if resources is None:
+                continue
+            for r in resources:
+                usage[r] = usage.get(r, 0) + 1
+            worker = pick_worker(resources)
+            worker.resources = resources
+            running[worker.id] = (project, task)
+            stage, args, kwargs = project.start(task, resources)
+            host = ' on %s' % (resources[0][1] or 'localhost') \
+                if stage == 'build' else ''
+            print(yellow('>>> [%s] Started the %s%s' %
+                         (project.name, describe(task), host)))
+            worker.tasks.put((stage, args, kwargs))
+
+    # Whether the scheduling finished, so that all workers are idle
+    finished = False
+    try:
+        dispatch()
+        while running:
+            try:
+                worker_id, ok, result = results.get(timeout=1)
+            except Empty:
+                # Fail the tasks of the workers which died unexpectedly
+                dead = [worker_id for worker_id in running
+                        if not workers[worker_id].process.is_alive()]
+                if not dead:
+                    continue
+                worker_id, ok, result = dead[0], False, 'The worker died'
+            worker = workers[worker_id]
+            project, task = running.pop(worker_id)
+            for r in worker.resources:
+                usage[r] -= 1
+            idle.append(worker)
+
+            if ok:
+                project.finish(task, result)
+                print(green('>>> [%s] Finished the %s' %
+                            (project.name, describe(task))))
+            else:
+                project.fail(task, result)
+                print(red('>>> [%s] Failed in the %s: %s' %
+                          (project.name, describe(task), result)))
+            dispatch()
+        finished = True
+    finally:
+        for worker in workers:
+            worker.stop(wait=finished)
+
+    failed = [p for p in projects if p.errors]
+    if failed:
+        raise SystemExit(
+            'Error: {0} of {1} projects failed to deploy: {2}'.format(
+                len(failed), len(projects), ', '.join(p.name for p in failed)
+            )
+        )
@@ -0,0 +1,64 @@
+"""Prune the obsolete versions in a directory.
+
+Pruning runs in two phases. The obsolete versions are first moved into a
+trash directory aside, which is only a rename, so that they disappear at
+once. The trash is then removed at the lowest I/O and CPU priority (by
+`ionice` if available, and `nice`), either in the background to keep it
+off the critical path of the installation, or right away.
+
+The version the `current` symlink points to is always kept, even if it
+is not one of the latest versions (e.g. after a rollback). The versions
+are ordered by the manifest of the directory if any, which is rewritten
+without the pruned versions.
+"""
+
+import pipes
+
+from cooly import manifest
+
+
+# The directory to keep the versions to remove, which is hidden from the
+# listings of the versions
+TRASH_DIR = '.cooly-trash'
+
+SCRIPT = '''\
+cd %(path)s 2>/dev/null || exit 0
+current=$(readlink current)
+trash=%(trash_dir)s/$(date +%%Y%%m%%d%%H%%M%%S)-$$
+{
+%(names)s
+} | tail -n +%(start)s | while read -r name; do
+    [ "$name" = "${current##*/}" ] && continue
+    mkdir -p "$trash" && mv -- "$name" "$trash/" && echo "Pruned $name"
+done
+%(clean)s
+nice='nice -n 19'
+command -v ionice >/dev/null 2>&1 && nice="ionice -c 3 $nice"
+%(remove)s
+'''
+
+REMOVE_IN_BACKGROUND = '''\
+[ -d "$trash" ] && nohup $nice rm -rf -- "$trash" >/dev/null 2>&1 </dev/null &
+exit 0'''
+
+REMOVE_NOW = '$nice rm -rf -- %(trash_dir)s'
+
+
+def prune_command(path, max_versions, background=True):
+    """Get the command to prune all but the latest `max_versions` entries
+    in `path`, and the one `current` points to.
+
+    If `background` is true, the command returns as soon as the obsolete
+    entries are moved into the trash. Otherwise, it waits until the whole
+    trash is removed, including what is left by the previous prunings.
+    """
+    remove = REMOVE_IN_BACKGROUND if background else REMOVE_NOW
+    script = SCRIPT % {
+        'path': pipes.quote(path),
+        'trash_dir': TRASH_DIR,
+        'start': max_versions + 1,
+        'names': manifest.names_script(),
+        'clean': manifest.clean_script(),
+        'remove': remove % {'trash_dir': TRASH_DIR},
+    }
+    return 'bash -c %s' % pipes.quote(script)
@@ -0,0 +1,187 @@
+"""Remote operations over the master connections of the OpenSSH clients.
+
+These are drop-in replacements of the Fabric operations `run`, `put` and
+`get`, which run `ssh` on the local host instead of going over the
+paramiko connections of Fabric (a file is transferred as the input or
+the output of `cat`). So the remote commands and transfers
+share the master connection per host (see `cooly.ssh`) with the other
+clients, across the stages, the processes forked to run on hosts in
+parallel and the invocations.
+
+The commands are wrapped as Fabric wraps them (honouring `cd`, `prefix`,
+`shell_env` and `env.shell`), and the results are the same kind of
+strings and lists, whose failures are handled according to
+`env.warn_only`. The clients authenticate by the SSH agent, the keys and
+the `ssh_config` of the local user only, since they run in batch mode.
+"""
+
+import os
+import sys
+import pipes
+import functools
+import subprocess
+
+from fabric.api import env
+from fabric.context_managers import settings, hide
+from fabric.network import parse_host_string
+from fabric.operations import (
+    _AttributeString, _AttributeList,
+    _shell_wrap, _prefix_commands, _prefix_env_vars
+)
+from fabric.state import output
+from fabric.utils import error
+
+from cooly import ssh
+
+
+def split_host_string(host):
+    """Split `host` into the SSH destination and the port (if any)."""
+    parts = parse_host_string(host)
+    destination = parts['host']
+    if parts['user']:
+        destination = '%s@%s' % (parts['user'], destination)
+    return destination, parts['port']
+
+
+def ssh_command(host, command):
+    """Get the local command to run `command` on `host` over SSH."""
+    destination, port = split_host_string(host)
+    return 'ssh %s %s %s' % (ssh.options(port), destination,
+                             pipes.quote(command))
+
+
+def remote_path(path):
+    """Get `path` on the current host, relative to the directory of the
+    current `cd` (if any) as Fabric does.
+    """
+    if env.cwd and not os.path.isabs(path) and not path.startswith('~'):
+        return os.path.join(env.cwd, path)
+    return path
+
+
+def quote_path(path):
+    """Quote the remote `path`, leaving a leading `~/` to the remote
+    shell to expand.
+    """
+    if path.startswith('~/'):
+        return '~/' + pipes.quote(path[2:])
+    return pipes.quote(path)
+
+
+def execute(command, echo=False):
+    """Run the local `command`, printing its output (combined with its
+    errors) as the output of the current host if `echo`, and return the
+    output and the exit status.
+    """
+    with open(os.devnull, 'rb') as devnull:
+        process = subprocess.Popen(command, shell=True, stdin=devnull,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        lines = []
+        for line in iter(process.stdout.readline, b''):
+            lines.append(line)
+            if echo:
+                sys.stdout.write('[%s] out: %s\n' % (env.host_string,
+                                                     line.rstrip('\r\n')))
+                sys.stdout.flush()
+        process.stdout.close()
+        status = process.wait()
+    return ''.join(lines).strip(), status
+
+
+def fail(operation, status, given, executed, out):
+    """Handle the nonzero exit `status` of `operation` as Fabric does."""
+    message = '%s() received nonzero return code %s while executing' % (
+        operation, status
+    )
+    if env.warn_only:
+        message += " '%s'!" % given
+    else:
+        message += '!\n\nRequested: %s\nExecuted: %s' % (given, executed)
+    error(message=message, stdout=out)
+
+
+def run(command, shell=True, warn_only=False, quiet=False, **kwargs):
+    """Run `command` on the current host over the master connection, and
+    return its output like Fabric `run` does.
+    """
+    if quiet:
+        manager = settings(hide('everything'), warn_only=True)
+    else:
+        manager = settings(warn_only=warn_only or env.warn_only)
+    with manager:
+        wrapped = _shell_wrap(
+            _prefix_commands(_prefix_env_vars(command), 'remote'),
+            env.get('shell_escape', True), shell
+        )
+        if output.debug:
+            print('[%s] run: %s' % (env.host_string, wrapped))
+        elif output.running:
+            print('[%s] run: %s' % (env.host_string, command))
+        result, status = execute(ssh_command(env.host_string, wrapped),
+                                 echo=output.stdout)
+        out = _AttributeString(result)
+        out.command = command
+        out.real_command = wrapped
+        out.failed = status not in env.ok_ret_codes
+        if out.failed:
+            fail('run', status, command, wrapped, out)
+        out.return_code = status
+        out.succeeded = not out.failed
+        out.stderr = _AttributeString('')
+        return out
+
+
+def copy(operation, command, redirection, given):
+    """Copy a file by running `command` on the current host over the
+    master connection with the local `redirection`, and return the list
+    of the paths copied like Fabric does.
+    """
+    if output.running:
+        print('[%s] %s: %s' % (env.host_string, operation, given))
+    local_command = '%s %s' % (ssh_command(env.host_string, command),
+                               redirection)
+    result, status = execute(local_command)
+    paths = _AttributeList()
+    paths.failed = []
+    if status not in env.ok_ret_codes:
+        paths.failed.append(given)
+        fail(operation, status, given, local_command,
+             _AttributeString(result))
+    else:
+        paths.append(given)
+    paths.succeeded = not paths.failed
+    return paths
+
+
+def put(local_path, remote, **kwargs):
+    """Upload the local file `local_path` to `remote` on the current host
+    over the master connection.
+    """
+    path = remote_path(remote)
+    return copy('put', 'cat > %s' % quote_path(path),
+                '< %s' % pipes.quote(local_path), path)
+
+
+def get(remote, local_path, **kwargs):
+    """Download `remote` (which may be a glob of a single file) from the
+    current host to the local path `local_path` over the master connection.
+    """
+    # The remote path is left unquoted to be expanded by the remote shell
+    return copy('get', 'cat %s' % remote_path(remote),
+                '> %s' % pipes.quote(local_path), local_path)
+
+
+def multiplexed(function):
+    """A decorator to run the Fabric operation `function` (`run`, `put` or
+    `get`) over the master connection to the current host instead, unless
+    multiplexing is disabled.
+    """
+    over_master = {'run': run, 'put': put, 'get': get}[function.__name__]
+
+    @functools.wraps(function)
+    def decorator(*args, **kwargs):
+        if not ssh.settings['control_dir']:
+            return function(*args, **kwargs)
+        return over_master(*args, **kwargs)
+    return decorator
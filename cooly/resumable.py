@@ -0,0 +1,164 @@
+"""Resumable transfers of large files over SSH.
+
+A file is transferred into a partial file first, which is appended to
+from where the previous attempt stopped, whether it was interrupted by a
+dropped connection in the same invocation or in an earlier one. Before
+resuming, the chunks already received are checked against the hashes of
+the chunks of the source, and the partial file is truncated to the first
+chunk which does not match. Once complete, the partial file is checked
+against the digest of the whole source before it is renamed to the
+destination, so that a corrupt file is never extracted.
+
+The files are hashed and transferred as streams (by `dd` and `tail`), so
+the memory used does not grow with their sizes.
+"""
+
+import os
+import pipes
+import hashlib
+import functools
+
+from cooly.remote import quote_path
+
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# The number of attempts to transfer a file in one invocation
+MAX_ATTEMPTS = 5
+
+# The directory on the destination host to keep the partial uploads in,
+# which are removed once older than `PARTIAL_MAX_AGE` minutes
+PARTIAL_DIR = '/tmp/cooly-partial'
+PARTIAL_MAX_AGE = 24 * 60
+
+# Print the size of a file (0 if missing), the hashes of its complete
+# chunks and optionally the digest of the whole file
+HASHES_SCRIPT = '''\
+size=$(stat -c %%s %(path)s 2>/dev/null || echo 0)
+echo "$size"
+i=0
+while [ $(((i + 1) * %(chunk_size)s)) -le "$size" ]; do
+    dd if=%(path)s bs=%(chunk_size)s skip=$i count=1 2>/dev/null |
+    sha1sum | cut -d ' ' -f 1
+    i=$((i + 1))
+done
+'''
+
+DIGEST_SCRIPT = '''\
+echo "digest $(sha1sum %(path)s | cut -d ' ' -f 1)"
+'''
+
+PREPARE_SCRIPT = '''\
+mkdir -p %(dir)s
+find %(dir)s -name '*.part' -mmin +%(max_age)s -delete 2>/dev/null
+touch %(path)s && truncate -s %(offset)s %(path)s
+'''
+
+FINISH_SCRIPT = '''\
+[ "$(sha1sum %(path)s | cut -d ' ' -f 1)" = %(digest)s ] &&
+mv -f %(path)s %(destination)s
+'''
+
+
+def bash(script):
+    return 'bash -c %s' % pipes.quote(script)
+
+
+def file_hashes(path, chunk_size=CHUNK_SIZE):
+    """Get the size of local file `path`, the hashes of its complete
+    chunks and the digest of the whole file, in a single pass.
+    """
+    size = 0
+    hashes = []
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, chunk_size), b''):
+            size += len(chunk)
+            digest.update(chunk)
+            if len(chunk) == chunk_size:
+                hashes.append(hashlib.sha1(chunk).hexdigest())
+    return size, hashes, digest.hexdigest()
+
+
+def hashes_command(path, digest=False):
+    """Get the command to print the size of `path`, the hashes of its
+    complete chunks and the digest of the whole file if `digest` is true,
+    to be parsed by `parse_hashes`.
+    """
+    script = HASHES_SCRIPT
+    if digest:
+        script += DIGEST_SCRIPT
+    return bash(script % {
+        'path': quote_path(path),
+        'chunk_size': CHUNK_SIZE,
+    })
+
+
+def parse_hashes(output):
+    """Parse the `output` of `hashes_command` into the size, the hashes
+    of the chunks and the digest (or None).
+    """
+    lines = output.split()
+    digest = None
+    if len(lines) > 1 and lines[-2] == 'digest':
+        digest = lines.pop()
+        lines.pop()
+    return int(lines[0]), lines[1:], digest
+
+
+def resume_offset(received, received_hashes, size, hashes):
+    """Get the offset to resume at, given the size and the hashes of the
+    chunks of the partial file received, and those of the source.
+    """
+    matched = 0
+    for expected, actual in zip(hashes, received_hashes):
+        if expected != actual:
+            break
+        matched += 1
+    offset = matched * CHUNK_SIZE
+    # The incomplete chunk at the end is only kept if all of the file has
+    # been received, and is then checked by the digest of the whole file
+    if matched == len(hashes) and received == size:
+        offset = size
+    return min(offset, received)
+
+
+def partial_path(digest, host):
+    """Get the path to the partial upload of the file of `digest` to
+    `host`, which is the same across invocations to resume.
+    """
+    key = hashlib.sha1(host.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(PARTIAL_DIR, '%s-%s.part' % (digest, key))
+
+
+def prepare_command(path, offset):
+    """Get the command to truncate the partial file `path` to `offset`
+    (creating it if missing), and remove the stale partial files.
+    """
+    return bash(PREPARE_SCRIPT % {
+        'dir': pipes.quote(os.path.dirname(path)),
+        'max_age': PARTIAL_MAX_AGE,
+        'path': pipes.quote(path),
+        'offset': offset,
+    })
+
+
+def read_command(path, offset):
+    """Get the command to print the content of `path` from `offset`."""
+    return 'tail -c +%s %s' % (offset + 1, quote_path(path))
+
+
+def append_command(path):
+    """Get the command to append its input to `path`."""
+    return 'cat >> %s' % pipes.quote(path)
+
+
+def finish_command(path, destination, digest):
+    """Get the command to check the partial file `path` against `digest`,
+    and rename it to `destination` if it matches.
+    """
+    return bash(FINISH_SCRIPT % {
+        'path': pipes.quote(path),
+        'digest': digest,
+        'destination': quote_path(destination),
+    })
@@ -0,0 +1,79 @@
+"""Options of the OpenSSH clients (`ssh` and `scp`) run by Cooly.
+
+The clients run on the local host share a master connection per host
+(see `ControlMaster` in ssh_config(5)), whose socket is kept in a local
+directory. The master stays open for a while after its last client exits,
+so that the following stages, and even the following invocations, reuse
+it without another handshake.
+
+All of the remote commands and transfers multiplex over the masters,
+including those of the Fabric operations `run`, `put` and `get` (see
+`cooly.remote`), so that the processes forked to run on hosts in
+parallel share the masters too. Disabling multiplexing falls back to
+the paramiko connections of Fabric, which are only shared by the stages
+of a session in one process.
+"""
+
+import os
+import errno
+
+
+# The local directory to keep the sockets of the master connections
+CONTROL_DIR = '~/.cache/cooly/ssh'
+# The number of seconds to keep a master connection open after its last
+# client exits
+CONTROL_PERSIST = 300
+# The number of seconds between the keepalive messages
+KEEPALIVE = 30
+
+
+# The current settings
+settings = {
+    'control_dir': CONTROL_DIR,
+    'control_persist': CONTROL_PERSIST,
+    'keepalive': KEEPALIVE,
+}
+
+
+def configure(control_dir=None, control_persist=None, keepalive=None):
+    """Update the settings, where None leaves a setting unchanged.
+
+    An empty `control_dir` disables multiplexing, and a `control_persist`
+    of 0 closes a master connection as soon as its last client exits.
+    """
+    for name, value in (('control_dir', control_dir),
+                        ('control_persist', control_persist),
+                        ('keepalive', keepalive)):
+        if value is not None:
+            settings[name] = value
+
+
+def options(port=None, port_flag='-p', multiplex=True):
+    """Get the command line options of `ssh` (or `scp` if `port_flag` is
+    `-P`) to connect to a host on `port`.
+
+    Only clients run on the local host should `multiplex`, since the
+    sockets are kept in a local directory.
+    """
+    opts = ['-o BatchMode=yes']
+    if port:
+        opts.append('%s %s' % (port_flag, port))
+    if settings['keepalive']:
+        opts.append('-o ServerAliveInterval=%s' % settings['keepalive'])
+    control_dir = settings['control_dir']
+    if multiplex and control_dir:
+        control_dir = os.path.expanduser(control_dir)
+        try:
+            os.makedirs(control_dir, 0o700)
+        except OSError as e:
+            # Created by another process running on hosts in parallel
+            if e.errno != errno.EEXIST:
+                raise
+        opts.extend([
+            '-o ControlMaster=auto',
+            # A hash of the connection, since the socket path is limited
+            # in length (about 100 bytes)
+            '-o ControlPath=%s' % os.path.join(control_dir, '%C'),
+            '-o ControlPersist=%s' % (settings['control_persist'] or 'no'),
+        ])
+    return ' '.join(opts)
@@ -0,0 +1,173 @@
+"""Trace the time spent on the stages and operations of Cooly.
+
+Once tracing is started (e.g. by `cooly --trace FILE`), every span of
+work records its name, the host it runs on, its duration and the bytes
+it transfers, as a complete event of the Chrome trace event format. The
+events of each host are shown on a track of their own.
+
+The events are appended to the file as JSON lines as soon as the spans
+end, which also works for the processes of parallel executions. When
+tracing finishes, the file is rewritten as a Chrome trace (to be loaded
+by `chrome://tracing` or Perfetto), unless its name ends with `.jsonl`.
+"""
+
+import os
+import json
+import time
+import zlib
+import atexit
+import functools
+import contextlib
+
+
+# The current state of tracing
+state = {
+    'path': None,
+    # The file descriptor to append the events to
+    'fd': None,
+    # The process which started tracing
+    'pid': None,
+    # The tracks (pid, tid) which have been named
+    'tracks': set(),
+}
+
+# The maximum length of the commands recorded
+MAX_COMMAND_LENGTH = 200
+
+
+def start(path):
+    """Start tracing into the file `path`."""
+    if state['fd'] is not None:
+        finish()
+    state.update(
+        path=path,
+        fd=os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                   os.O_APPEND, 0o644),
+        pid=os.getpid(),
+        tracks=set(),
+    )
+    atexit.register(finish)
+
+
+def enabled():
+    return state['fd'] is not None
+
+
+def finish():
+    """Finish tracing, and write the trace file."""
+    if state['fd'] is None or state['pid'] != os.getpid():
+        return
+    os.close(state['fd'])
+    state['fd'] = None
+
+    path = state['path']
+    if path.endswith('.jsonl'):
+        return
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    os.rename(path + '.tmp', path)
+
+
+def current_host():
+    """Get the host the current Fabric task runs on."""
+    # Fabric is only imported by the commands, which trace the spans
+    from fabric.api import env
+    return env.host_string or 'localhost'
+
+
+def write(event):
+    # A single write of a line is appended atomically
+    os.write(state['fd'], (json.dumps(event) + '\n').encode('utf-8'))
+
+
+def record(name, start_time, duration, category='operation', host=None,
+           **args):
+    """Record the span `name`, which started at `start_time` and lasted
+    for `duration` seconds, on `host` (defaults to the current host).
+    """
+    if not enabled():
+        return
+    host = host or current_host()
+    pid = os.getpid()
+    # Keep the track of a host the same across processes
+    tid = zlib.crc32(host.encode('utf-8')) & 0x7fffffff
+    if (pid, tid) not in state['tracks']:
+        state['tracks'].add((pid, tid))
+        write({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+               'args': {'name': host}})
+    args['host'] = host
+    write({
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': int(start_time * 1e6),
+        'dur': int(duration * 1e6),
+        'pid': pid,
+        'tid': tid,
+        'args': args,
+    })
+
+
+@contextlib.contextmanager
+def span(name, category='operation', host=None, **args):
+    """A context manager to trace the work in it as the span `name`.
+
+    It yields the arguments of the span, which can be updated (e.g. with
+    the `bytes` transferred) before the span ends.
+    """
+    if not enabled():
+        yield args
+        return
+    start_time = time.time()
+    try:
+        yield args
+    except BaseException as e:
+        args['error'] = str(e) or repr(e)
+        raise
+    finally:
+        record(name, start_time, time.time() - start_time, category, host,
+               **args)
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def operation(function):
+    """A decorator to trace the Fabric operation `function` (`run`,
+    `local`, `put` or `get`), named after the program it runs, or the
+    bytes it transfers.
+    """
+    kind = function.__name__
+
+    @functools.wraps(function)
+    def decorator(*args, **kwargs):
+        if not enabled() or not args:
+            return function(*args, **kwargs)
+        first = str(args[0])
+        if kind in ('run', 'local'):
+            program = first.split(' ', 1)[0]
+            name = '%s %s' % (kind, os.path.basename(program))
+            span_args = {'command': first[:MAX_COMMAND_LENGTH]}
+        else:
+            name = kind
+            span_args = {'source': first,
+                         'destination': str(args[1]) if len(args) > 1
+                         else None}
+        # Local operations run on the local host whatever the current
+        # host is
+        host = 'localhost' if kind == 'local' else None
+        with span(name, host=host, **span_args) as span_args:
+            result = function(*args, **kwargs)
+            if kind == 'put':
+                span_args['bytes'] = file_size(first)
+            elif kind == 'get':
+                span_args['bytes'] = sum(file_size(path) or 0
+                                         for path in result)
+            return result
+    return decorator
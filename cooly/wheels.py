@@ -0,0 +1,181 @@
+"""A wheel cache shared by all build hosts.
+
+Platter caches the wheels it builds in a directory on each build host,
+so a new build host builds all of them from scratch. The shared cache
+keeps the wheels on the local host instead: before a build, the wheels
+compatible with the build host and missing in its cache are pushed to
+it, and after the build, the wheels built there are pulled back.
+
+A wheel is identified by its filename, which holds its name, version,
+Python tag, ABI tag and platform tag (see PEP 427), so the wheels in the
+cache are never overwritten. The least recently used wheels are evicted
+once the total size of the cache exceeds `max_size` megabytes.
+"""
+
+import os
+import re
+import time
+import uuid
+import shutil
+
+
+DEFAULT_CACHE_DIR = '~/.cache/cooly/wheels'
+
+WHEEL_FILENAME = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(-\d[^-]*)?-(?P<python>[^-]+)-'
+    r'(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$'
+)
+
+# Print the Python tag, the platform tag and the ABI tag of a Python
+# interpreter, where the ABI tag of Python 2 (e.g. `cp27mu`) is made of
+# its build flags as pip does
+TAGS_SCRIPT = (
+    "import sys, sysconfig; "
+    "var = sysconfig.get_config_var; "
+    "soabi = var('SOABI'); "
+    "print('cp%s%s' % sys.version_info[:2]); "
+    "print(sysconfig.get_platform().replace('-', '_').replace('.', '_')); "
+    "print('cp' + soabi.split('-')[1] if soabi else 'cp%s%s%s%s%s' % ("
+    "sys.version_info[0], sys.version_info[1], "
+    "'d' if var('Py_DEBUG') else '', 'm' if var('WITH_PYMALLOC') else '', "
+    "'u' if sys.maxunicode == 0x10ffff else ''))"
+)
+
+
+def inspect_command(wheel_cache, toolbin):
+    """Get the command to print the tags of the Python interpreter of
+    `toolbin` (or the default one), followed by the wheels in
+    `wheel_cache`, to be parsed by `parse_inspection`.
+    """
+    pythons = [os.path.join(toolbin, 'python'), 'python', 'python3']
+    return ('for python in {pythons}; do '
+            'command -v $python > /dev/null && break; done && '
+            '$python -c "{script}" && {list}'
+            .format(pythons=' '.join(pythons), script=TAGS_SCRIPT,
+                    list=list_command(wheel_cache)))
+
+
+def list_command(wheel_cache):
+    """Get the command to print the wheels in `wheel_cache`."""
+    return 'mkdir -p {0} && cd {0} && find . -name "*.whl"'.format(
+        wheel_cache
+    )
+
+
+def parse_inspection(output):
+    """Parse the `output` of the inspection command into the tags and
+    the set of the wheels.
+    """
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    tags = tuple(lines[:3])
+    wheels = set(os.path.normpath(line) for line in lines[3:])
+    return tags, wheels
+
+
+def is_compatible(wheel, tags):
+    """Whether `wheel` can be installed by the interpreter with `tags`,
+    i.e. the Python tag (e.g. `cp27`), the platform tag (e.g.
+    `linux_x86_64`) and the ABI tag (e.g. `cp27mu`).
+    """
+    match = WHEEL_FILENAME.match(os.path.basename(wheel))
+    if not match:
+        return False
+    python_tag, platform_tag, abi_tag = tags
+    platforms = match.group('platform').split('.')
+    if 'any' not in platforms and platform_tag not in platforms:
+        return False
+    # The stable ABI of Python 3 is compatible with all later versions
+    abis = ('none', abi_tag, 'abi3') if python_tag.startswith('cp3') \
+        else ('none', abi_tag)
+    if not any(abi in abis for abi in match.group('abi').split('.')):
+        return False
+    # e.g. `cp27`, `py27` or `py2` for CPython 2.7
+    version = python_tag[2:]
+    accepted = (python_tag, 'py' + version, 'py' + version[:1])
+    return any(tag in accepted for tag in match.group('python').split('.'))
+
+
+class SharedWheelCache(object):
+    """The wheels shared by all build hosts in local `cache_dir`."""
+
+    def __init__(self, cache_dir=None, max_size=None):
+        self.cache_dir = os.path.expanduser(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_size = max_size
+
+    def wheels(self):
+        """Get the set of the wheels, as the paths relative to the cache
+        directory.
+        """
+        wheels = set()
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            # Skip the incoming directories
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.')]
+            for filename in filenames:
+                if filename.endswith('.whl'):
+                    wheels.add(os.path.relpath(
+                        os.path.join(dirpath, filename), self.cache_dir
+                    ))
+        return wheels
+
+    def missing(self, wheels, tags):
+        """Get the wheels compatible with `tags` but not in `wheels`."""
+        return sorted(wheel for wheel in self.wheels() - wheels
+                      if is_compatible(wheel, tags))
+
+    def touch(self, wheels):
+        """Mark `wheels` as recently used."""
+        now = time.time()
+        for wheel in wheels:
+            os.utime(os.path.join(self.cache_dir, wheel), (now, now))
+
+    def add(self, incoming_dir):
+        """Move the wheels in `incoming_dir` into the cache, unless they
+        are already there, and return the number of the wheels added.
+        """
+        added = 0
+        for dirpath, _, filenames in os.walk(incoming_dir):
+            for filename in filenames:
+                if not filename.endswith('.whl'):
+                    continue
+                source = os.path.join(dirpath, filename)
+                wheel = os.path.relpath(source, incoming_dir)
+                target = os.path.join(self.cache_dir, wheel)
+                if os.path.exists(target):
+                    continue
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                # Only complete wheels appear in the cache
+                os.rename(source, target)
+                added += 1
+        return added
+
+    def evict(self):
+        """Remove the least recently used wheels until the total size of
+        the cache is within `max_size` megabytes.
+        """
+        if not self.max_size:
+            return
+        paths = [os.path.join(self.cache_dir, wheel)
+                 for wheel in self.wheels()]
+        paths.sort(key=os.path.getmtime)
+        sizes = dict((path, os.path.getsize(path)) for path in paths)
+        total = sum(sizes.values())
+        for path in paths:
+            if total <= self.max_size * 1024 * 1024:
+                break
+            print('Evicting wheel %s (%s bytes)' % (path, sizes[path]))
+            os.remove(path)
+            total -= sizes[path]
+
+    def make_incoming_dir(self):
+        """Make a directory to receive wheels in, on the same filesystem
+        as the cache to move them in atomically.
+        """
+        path = os.path.join(self.cache_dir, '.incoming-%s' % uuid.uuid4())
+        os.makedirs(path)
+        return path
+
+    @staticmethod
+    def remove_incoming_dir(path):
+        shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,160 @@
+"""Build a project incrementally in a persistent workspace.
+
+Instead of a throwaway scratchpad, each build of the project happens in
+the source tree of the same workspace on the build host. The new package
+is extracted aside, and only its files which changed are applied to the
+source tree (by `rsync` if available), so that the outputs of the
+previous build (e.g. the compiled extensions in `build/`) stay valid
+for the unchanged files.
+
+Platter always builds in a virtualenv of its own, so the dependencies
+can not be reused by the virtualenv. Instead, if the requirements (the
+requirements file and the metadata files) are unchanged since the last
+successful build, the dependencies are resolved from the wheel cache
+only, without reaching the package index.
+
+A workspace is locked by a lock directory while a build uses it. A lock
+older than `LOCK_TIMEOUT` seconds is considered stale and broken. When
+deploying, each project builds in a workspace of its own under the one
+specified, named after its repository. A leading `~/` of a workspace is
+left to the shell of the build host to expand.
+"""
+
+import os
+import re
+import pipes
+import hashlib
+
+from cooly.remote import quote_path
+
+
+SOURCE_DIR = 'src'
+INCOMING_DIR = '.incoming'
+LOCK_DIR = '.lock'
+REQUIREMENTS_HASH = '.requirements.sha1'
+
+LOCK_TIMEOUT = 3600
+
+# The outputs of the previous build in the source tree, which are kept
+# while the changes are applied
+KEPT_OUTPUTS = ('/build/', '/*.egg-info/')
+
+# The files the requirements are read from, besides the requirements file
+METADATA_FILES = ('setup.py', 'setup.cfg', 'pyproject.toml')
+
+LOCK_SCRIPT = '''\
+mkdir -p %(workspace)s
+until mkdir %(lock)s 2>/dev/null; do
+    if [ -n "$(find %(lock)s -maxdepth 0 -mmin +%(minutes)s 2>/dev/null)" ]
+    then
+        echo "Breaking the stale lock of %(workspace)s"
+        rm -rf %(lock)s
+        continue
+    fi
+    [ -n "$waiting" ] || echo "Waiting for the lock of %(workspace)s"
+    waiting=1
+    sleep 1
+done
+'''
+
+# The changed files are written with the current time instead of the
+# one in the package (no `--times`), so that they look newer than the
+# outputs of the previous build
+APPLY_SCRIPT = '''\
+cd %(workspace)s
+if command -v rsync >/dev/null 2>&1 && [ -d %(source)s ]; then
+    count=$(rsync -rlpD --delete --checksum %(excludes)s --out-format=%%n \\
+            %(incoming)s/ %(source)s/ | grep -vc '/$')
+    rm -rf %(incoming)s %(source)s/dist
+    echo "Applied $count changed files to the workspace"
+else
+    rm -rf %(source)s && mv %(incoming)s %(source)s
+    echo 'Replaced the whole source tree of the workspace'
+fi
+'''
+
+
+def bash(script):
+    return 'bash -c %s' % pipes.quote(script)
+
+
+def project_path(workspace, repo):
+    """Get the workspace of the project archived from `repo` under the
+    `workspace` shared by projects, so that different projects do not
+    contend for the same lock and source tree.
+    """
+    path = repo.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')].rstrip('/')
+    name = re.sub(r'[^\w.-]+', '-',
+                  os.path.basename(path.replace(':', '/'))) or 'project'
+    digest = hashlib.sha1(repo.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(workspace, '%s-%s' % (name, digest))
+
+
+def incoming_path(workspace):
+    """Get the path to extract the new package into."""
+    return os.path.join(workspace, INCOMING_DIR)
+
+
+def source_path(workspace):
+    """Get the path to the source tree to build in."""
+    return os.path.join(workspace, SOURCE_DIR)
+
+
+def lock_command(workspace):
+    """Get the command to wait for and take the lock of `workspace`."""
+    return bash(LOCK_SCRIPT % {
+        'workspace': quote_path(workspace),
+        'lock': quote_path(os.path.join(workspace, LOCK_DIR)),
+        'minutes': LOCK_TIMEOUT // 60,
+    })
+
+
+def unlock_command(workspace):
+    """Get the command to release the lock of `workspace`."""
+    return 'rm -rf %s' % quote_path(os.path.join(workspace, LOCK_DIR))
+
+
+def prepare_command(workspace):
+    """Get the command to prepare an empty directory to extract the new
+    package into.
+    """
+    incoming = quote_path(incoming_path(workspace))
+    return 'rm -rf %s && mkdir -p %s' % (incoming, incoming)
+
+
+def apply_command(workspace):
+    """Get the command to apply the changed files of the new package to
+    the source tree, and remove the rest of the new package.
+    """
+    return bash(APPLY_SCRIPT % {
+        'workspace': quote_path(workspace),
+        'source': SOURCE_DIR,
+        'incoming': INCOMING_DIR,
+        'excludes': ' '.join('--exclude=%s' % pipes.quote(pattern)
+                             for pattern in KEPT_OUTPUTS),
+    })
+
+
+def requirements_hash_command(workspace, requirements=None):
+    """Get the command to print the hash of the requirements of the
+    source tree, followed by the one of the last successful build.
+    """
+    files = ([requirements] if requirements else []) + list(METADATA_FILES)
+    return bash('cd %s && { cat %s 2>/dev/null | sha1sum | cut -d " " -f 1;'
+                ' cat ../%s 2>/dev/null; true; }' % (
+                    quote_path(source_path(workspace)),
+                    ' '.join(pipes.quote(f) for f in files),
+                    REQUIREMENTS_HASH,
+                ))
+
+
+def save_requirements_hash_command(workspace, requirements_hash):
+    """Get the command to save the hash of the requirements of the
+    successful build.
+    """
+    return 'echo %s > %s' % (
+        requirements_hash,
+        quote_path(os.path.join(workspace, REQUIREMENTS_HASH))
+    )
@@ -0,0 +1,36 @@
+import pytest
+
+from cooly.compression import Compression
+
+
+def test_parse_default():
+    compression = Compression.parse(None)
+    assert compression.codec.name == 'gzip'
+    assert compression.extension == '.tar.gz'
+    assert compression.is_builtin
+
+
+@pytest.mark.parametrize('spec, level, threads', [
+    ('zstd', None, None),
+    ('zstd:19', 19, None),
+    ('zstd::4', None, 4),
+    ('zstd:19:4', 19, 4),
+])
+def test_parse_options(spec, level, threads):
+    compression = Compression.parse(spec)
+    assert compression.codec.name == 'zstd'
+    assert (compression.level, compression.threads) == (level, threads)
+    assert str(compression) == spec
+
+
+@pytest.mark.parametrize('spec', [
+    'rar', 'gzip:1:2:3', 'gzip:fast', 'none:3', 'lz4::2',
+])
+def test_parse_invalid(spec):
+    with pytest.raises(RuntimeError):
+        Compression.parse(spec)
+
+
+def test_compress_command():
+    assert Compression.parse('zstd:3:2').compress_command == 'zstd -qc -3 -T2'
+    assert Compression.parse('none').compress_command == 'cat'
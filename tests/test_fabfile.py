@@ -0,0 +1,48 @@
+from cooly.fabfile import split_into_waves, fanout_levels
+
+
+HOSTS = ['host%s' % i for i in range(10)]
+
+
+def test_split_into_waves_all_at_once():
+    assert split_into_waves(HOSTS) == [HOSTS]
+
+
+def test_split_into_waves_by_number():
+    assert split_into_waves(HOSTS[:5], wave=2) == [
+        HOSTS[0:2], HOSTS[2:4], HOSTS[4:5]
+    ]
+
+
+def test_split_into_waves_by_percentage_with_canary():
+    assert split_into_waves(HOSTS, wave='30%', canary=1) == [
+        HOSTS[0:1], HOSTS[1:4], HOSTS[4:7], HOSTS[7:10]
+    ]
+
+
+def test_split_into_waves_at_least_one_host():
+    assert split_into_waves(HOSTS[:3], wave='10%') == [
+        HOSTS[0:1], HOSTS[1:2], HOSTS[2:3]
+    ]
+
+
+def test_fanout_levels_binary_tree():
+    levels = fanout_levels(HOSTS[:7], 2)
+    assert [dict(level) for level in levels] == [
+        {None: HOSTS[0:2]},
+        {HOSTS[0]: HOSTS[2:4], HOSTS[1]: HOSTS[4:6]},
+        {HOSTS[2]: HOSTS[6:7]},
+    ]
+
+
+def test_fanout_levels_chain():
+    levels = fanout_levels(HOSTS[:3], 1)
+    assert [dict(level) for level in levels] == [
+        {None: HOSTS[0:1]},
+        {HOSTS[0]: HOSTS[1:2]},
+        {HOSTS[1]: HOSTS[2:3]},
+    ]
+
+
+def test_fanout_levels_all_at_top():
+    assert fanout_levels(HOSTS[:3], 5) == [{None: HOSTS[:3]}]
@@ -0,0 +1,33 @@
+from cooly.manifest import CURRENT_MARK, Version, parse
+
+
+def test_parse_manifest():
+    output = '\n'.join([
+        '%s /srv/app/v2' % CURRENT_MARK,
+        'v1\tabc\t100\t2048',
+        'v2\t-\t200\t-',
+    ])
+    current, versions = parse(output)
+    assert current == 'v2'
+    assert versions == [
+        Version('v2', None, 200, None),
+        Version('v1', 'abc', 100, 2048),
+    ]
+
+
+def test_parse_names_without_manifest():
+    current, versions = parse('%s \nv1\nv2\n' % CURRENT_MARK)
+    assert current is None
+    assert versions == [Version('v2', None, None, None),
+                        Version('v1', None, None, None)]
+
+
+def test_parse_latest_record_wins():
+    current, versions = parse('v1\t-\t100\t-\nv2\t-\t200\t-\n'
+                              'v1\t-\t300\t-\n')
+    assert [version.name for version in versions] == ['v1', 'v2']
+    assert versions[0].installed_at == 300
+
+
+def test_parse_nothing():
+    assert parse('') == (None, [])
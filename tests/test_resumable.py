@@ -0,0 +1,54 @@
+import hashlib
+
+from cooly.resumable import CHUNK_SIZE, file_hashes, parse_hashes, \
+    resume_offset
+
+
+HASHES = ['a', 'b', 'c']
+# Three complete chunks and an incomplete one
+SIZE = 3 * CHUNK_SIZE + 100
+
+
+def test_resume_offset_from_scratch():
+    assert resume_offset(0, [], SIZE, HASHES) == 0
+
+
+def test_resume_offset_after_matching_chunks():
+    received = 2 * CHUNK_SIZE + 10
+    assert resume_offset(received, ['a', 'b'], SIZE, HASHES) == \
+        2 * CHUNK_SIZE
+
+
+def test_resume_offset_at_first_mismatch():
+    assert resume_offset(SIZE, ['a', 'x', 'c'], SIZE, HASHES) == CHUNK_SIZE
+
+
+def test_resume_offset_fully_received():
+    assert resume_offset(SIZE, HASHES, SIZE, HASHES) == SIZE
+
+
+def test_resume_offset_drops_incomplete_chunk():
+    received = 3 * CHUNK_SIZE + 50
+    assert resume_offset(received, HASHES, SIZE, HASHES) == 3 * CHUNK_SIZE
+
+
+def test_resume_offset_longer_than_source():
+    received = SIZE + 1
+    assert resume_offset(received, HASHES, SIZE, HASHES) == 3 * CHUNK_SIZE
+
+
+def test_parse_hashes():
+    assert parse_hashes('10\nh1\nh2\ndigest d\n') == (10, ['h1', 'h2'], 'd')
+    assert parse_hashes('10\nh1\n') == (10, ['h1'], None)
+    assert parse_hashes('0\n') == (0, [], None)
+
+
+def test_file_hashes(tmpdir):
+    content = b'x' * 10 + b'y' * 10 + b'z' * 5
+    path = tmpdir.join('file')
+    path.write_binary(content)
+    size, hashes, digest = file_hashes(str(path), chunk_size=10)
+    assert size == 25
+    assert hashes == [hashlib.sha1(b'x' * 10).hexdigest(),
+                      hashlib.sha1(b'y' * 10).hexdigest()]
+    assert digest == hashlib.sha1(content).hexdigest()
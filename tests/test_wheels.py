@@ -0,0 +1,24 @@
+import pytest
+
+from cooly.wheels import is_compatible
+
+
+PY27 = ('cp27', 'linux_x86_64', 'cp27mu')
+PY38 = ('cp38', 'linux_x86_64', 'cp38')
+
+
+@pytest.mark.parametrize('wheel, tags, compatible', [
+    ('six-1.16.0-py2.py3-none-any.whl', PY27, True),
+    ('six-1.16.0-py2.py3-none-any.whl', PY38, True),
+    ('./cache/lxml-4.9.2-cp27-cp27mu-linux_x86_64.whl', PY27, True),
+    # Built for the other ABI of Python 2.7
+    ('lxml-4.9.2-cp27-cp27m-linux_x86_64.whl', PY27, False),
+    ('lxml-4.9.2-cp27-cp27mu-macosx_10_9_x86_64.whl', PY27, False),
+    ('lxml-4.9.2-cp38-cp38-linux_x86_64.whl', PY27, False),
+    ('cryptography-41.0.0-cp38-abi3-linux_x86_64.whl', PY38, True),
+    ('cryptography-41.0.0-cp27-abi3-linux_x86_64.whl', PY27, False),
+    ('futures-3.4.0-py2-none-any.whl', PY38, False),
+    ('not-a-wheel.tar.gz', PY27, False),
+])
+def test_is_compatible(wheel, tags, compatible):
+    assert is_compatible(wheel, tags) is compatible